@@ -0,0 +1,399 @@
+"""A small agent that runs on the machine that owns the data and answers
+    listing, scanning and hashing requests over TCP, so that comparing with
+    a remote root only moves metadata and digests over the network instead
+    of every byte. Run it with `python -m model.agent ROOT --port 7878` and
+    compare with agent://host:7878.
+    
+    Messages are JSON objects with a 4-byte big-endian length in front.
+    The agent uses the same scanning and hashing code as everything else,
+    and keeps its scanned tree, so hashes it found once are answered from
+    the cache. Anyone who can connect can read the tree's metadata and
+    hashes, so it only listens on localhost unless told otherwise, and can
+    require a token."""
+
+import argparse
+import datetime
+import hmac
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from pathlib import PurePath
+
+from model.directory import Directory, File
+from model.ratelimit import limiter
+from model.stats import stats
+
+URL_PREFIX = "agent://"
+DEFAULT_PORT = 7878
+# Largest message either side accepts
+MAX_MESSAGE_SIZE = 2 ** 30
+# Largest message the agent accepts before a client has sent the token
+UNAUTHENTICATED_MESSAGE_SIZE = 2 ** 16
+# Hashes requested from the agent in a single message at most
+HASH_BATCH_SIZE = 512
+
+_LENGTH = struct.Struct(">I")
+
+def is_agent_url(path):
+    """ Returns whether path names an agent rather than a local path """
+    return str(path).startswith(URL_PREFIX)
+
+def parse_agent_url(url):
+    """ Returns (host, port) of an agent://host[:port] URL """
+    address = url[len(URL_PREFIX):].rstrip("/")
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+def send_message(sock, message):
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+def _receive_exactly(sock, num_bytes):
+    chunks = []
+    while num_bytes > 0:
+        chunk = sock.recv(min(num_bytes, 2 ** 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by the other side")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b"".join(chunks)
+
+def receive_message(sock, max_size=MAX_MESSAGE_SIZE):
+    """ Returns the next message, or None if the connection was closed
+        between messages. Messages longer than max_size bytes raise
+        ConnectionError before they are read. """
+    header = sock.recv(_LENGTH.size)
+    if not header:
+        return None
+    if len(header) < _LENGTH.size:
+        header += _receive_exactly(sock, _LENGTH.size - len(header))
+    length, = _LENGTH.unpack(header)
+    if length > max_size:
+        raise ConnectionError("Message of {} bytes is too large".format(length))
+    return json.loads(_receive_exactly(sock, length).decode("utf-8"))
+
+def _entry(rel_path, isdir, size, modified):
+    """ The form files take in messages """
+    return [str(rel_path), isdir, size, modified.timestamp()]
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        # Nobody gets to send large messages before sending the token
+        max_size = (MAX_MESSAGE_SIZE if agent.token is None
+                    else UNAUTHENTICATED_MESSAGE_SIZE)
+        while True:
+            try:
+                message = receive_message(self.request, max_size)
+            except (ValueError, ConnectionError):
+                # Not a message, or the client went away; the server closes
+                # the connection once handle returns
+                stats.count("agent_bad_connections")
+                return
+            if message is None:
+                return
+            if agent.authenticated(message):
+                max_size = MAX_MESSAGE_SIZE
+            try:
+                reply = agent.answer(message)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                reply = {"error": str(e)}
+            try:
+                send_message(self.request, reply)
+            except ConnectionError:
+                return
+
+class _AgentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Agent():
+    """ Answers requests about the tree under root_path """
+    def __init__(self, root_path, token=None):
+        self.root_path = PurePath(root_path)
+        self.token = token
+        self.directory = None
+        # Held while scanning, so that a request never sees half a tree
+        self._lock = threading.Lock()
+        self.server = None
+    
+    def rel_path(self, path):
+        """ A relative path from a request, which may not leave the root """
+        rel_path = PurePath(path)
+        if rel_path.is_absolute() or ".." in rel_path.parts:
+            raise ValueError("Path outside of the root: {}".format(path))
+        return rel_path
+    
+    def inside_root(self, full_path):
+        """ Returns whether full_path, with every symbolic link resolved,
+            is the root or below it """
+        real_root = os.path.realpath(self.root_path)
+        real_path = os.path.realpath(full_path)
+        return os.path.commonpath([real_root, real_path]) == real_root
+    
+    def scanned_directory(self, refresh=False):
+        """ The scanned tree, scanning it first if needed """
+        with self._lock:
+            if self.directory is None or refresh:
+                directory = Directory(self.root_path)
+                directory.scan()
+                self.directory = directory
+            return self.directory
+    
+    def authenticated(self, message):
+        """ Returns whether message is a request with the right token, if
+            the agent has one """
+        return isinstance(message, dict) and (
+            self.token is None or
+            hmac.compare_digest(str(message.get("token")), self.token))
+    
+    def answer(self, message):
+        """ Returns the reply to one request """
+        if not isinstance(message, dict):
+            return {"error": "Not a request"}
+        if not self.authenticated(message):
+            return {"error": "Wrong token"}
+        
+        op = message["op"]
+        stats.count("agent_requests_served")
+        if op == "scan":
+            # Everything at once, parents before their children
+            directory = self.scanned_directory(message.get("refresh", False))
+            return {"entries": [_entry(file_.get_path(), file_.isdir,
+                                       file_.size, file_.modified)
+                                for file_ in directory.file_list]}
+        
+        if op == "list":
+            # One directory as it is now, without touching the scanned tree
+            rel_path = self.rel_path(message["path"])
+            full_path = self.root_path.joinpath(rel_path)
+            if not self.inside_root(full_path):
+                raise ValueError("Path outside of the root: {}".format(
+                    message["path"]))
+            entries = []
+            with os.scandir(full_path) as dir_entries:
+                for entry in dir_entries:
+                    # Links that lead out of the root are not shown
+                    if (entry.is_symlink() and
+                            not self.inside_root(entry.path)):
+                        continue
+                    try:
+                        stat_info = limiter.stat(entry.path)
+                    except (FileNotFoundError, PermissionError):
+                        continue
+                    isdir = entry.is_dir()
+                    entries.append(_entry(rel_path.joinpath(entry.name),
+                        isdir, -1 if isdir else stat_info.st_size,
+                        datetime.datetime.fromtimestamp(stat_info.st_mtime)))
+            return {"entries": entries}
+        
+        if op == "hash":
+            # [rel_path, "1k" or "full"] -> hex digest, or None if the file
+            # is not in the scanned tree or could not be read
+            directory = self.scanned_directory()
+            digests = []
+            for path, kind in message["files"]:
+                rel_path = self.rel_path(path)
+                file_ = directory.find_file(rel_path)
+                digest = None
+                if (file_ is not None and not file_.isdir and
+                        self.inside_root(self.root_path.joinpath(rel_path))):
+                    if kind == "1k":
+                        digest = file_.find_hash_1k(directory.root_path)
+                    else:
+                        digest = file_.find_hash_full(directory.root_path)
+                digests.append(digest.hex() if digest is not None else None)
+            stats.count("agent_hashes", len(digests))
+            return {"digests": digests}
+        
+        return {"error": "Unknown request: {}".format(op)}
+    
+    def listen(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """ Opens the listening socket. A port of 0 picks a free one, which
+            is in self.address afterwards. """
+        self.server = _AgentServer((host, port), _AgentHandler)
+        self.server.agent = self
+        self.address = self.server.server_address
+    
+    def serve(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """ Answers clients until shutdown is called """
+        self.listen(host, port)
+        self.server.serve_forever()
+    
+    def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """ Serves from a daemon thread; returns once it is listening """
+        self.listen(host, port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class AgentClient():
+    """ One connection to an agent; safe to share between threads """
+    def __init__(self, host, port=DEFAULT_PORT, token=None):
+        self.address = (host, port)
+        self.token = token
+        self._sock = None
+        self._lock = threading.Lock()
+    
+    def request(self, message):
+        """ Sends a request and returns the reply. Raises OSError if the
+            agent could not be reached or refused the request. """
+        if self.token is not None:
+            message = dict(message, token=self.token)
+        with self._lock:
+            if self._sock is None:
+                self._sock = socket.create_connection(self.address)
+            try:
+                send_message(self._sock, message)
+                reply = receive_message(self._sock)
+            except OSError:
+                self.close()
+                raise
+            if reply is None:
+                self.close()
+                raise ConnectionError("Agent closed the connection")
+        stats.count("agent_requests")
+        if "error" in reply:
+            raise OSError("Agent error: {}".format(reply["error"]))
+        return reply
+    
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+class AgentFile(File):
+    """ A File whose hashes are found by the agent, next to the data """
+    def __init__(self, agent_dir, path, size, modified, isdir, parent=None):
+        File.__init__(self, path, size, modified, isdir, parent)
+        self.agent_dir = agent_dir
+        # Kinds of hash ("1k", "full") the agent could not find, so that
+        # they are not asked for again
+        self.unavailable = set()
+    
+    def find_hash_1k(self, root_dir=None):
+        if self.hash_1k is not None:
+            stats.count("hash_cache_hits")
+        elif "1k" not in self.unavailable:
+            self.agent_dir.fetch_hashes(self, "1k")
+        return self.hash_1k
+    
+    def find_hash_full(self, root_dir=None):
+        if self.hash_full is not None:
+            stats.count("hash_cache_hits")
+        elif "full" not in self.unavailable:
+            self.agent_dir.fetch_hashes(self, "full")
+        return self.hash_full
+
+class AgentDirectory(Directory):
+    """ A Directory whose tree and hashes come from an agent. Hashes are
+        fetched in batches: Matcher prefetches the ones it is going to need,
+        and asking for one file's hash also fetches those of the other files
+        of its size, which are the ones that matching compares next. """
+    batched_hashes = True
+    local = False
+    
+    def __init__(self, url, token=None):
+        Directory.__init__(self, url)
+        self.url = url
+        host, port = parse_agent_url(url)
+        self.client = AgentClient(host, port,
+            token if token is not None
+            else os.environ.get("ALREADYHAVE_AGENT_TOKEN"))
+    
+    def scan(self, update_function=None, finish_function=None):
+        """ Asks the agent for its whole tree in one request """
+        with stats.phase("scan"):
+            entries = self.client.request({"op": "scan"})["entries"]
+            for entries_done, (path, isdir, size, mtime) in enumerate(entries):
+                rel_path = PurePath(path)
+                parent = (None if rel_path == PurePath(".")
+                          else self.directory_map_file[rel_path.parent])
+                self.add_file(AgentFile(self, path=path, size=size,
+                    modified=datetime.datetime.fromtimestamp(mtime),
+                    isdir=isdir, parent=parent))
+                
+                if entries_done % 100 == 0 and update_function is not None:
+                    update_function(entries_done, len(entries), path)
+        
+        if update_function is not None:
+            update_function(1, 1, None)
+        
+        if finish_function is not None:
+            finish_function()
+    
+    def fetch_hashes(self, file_, kind):
+        """ Fetches the kind ("1k" or "full") hash of file_, along with the
+            ones still missing for the other files of its size """
+        attribute = "hash_1k" if kind == "1k" else "hash_full"
+        batch = [file_] + [other for other in self.size_map.get(file_.size, [])
+                           if other is not file_
+                           and getattr(other, attribute) is None
+                           and kind not in other.unavailable]
+        self._request_hashes(batch[:HASH_BATCH_SIZE], kind)
+    
+    def prefetch_hashes(self, files, kind):
+        """ Fetches the kind hash of every file in files that is missing
+            it, in as few requests as possible """
+        attribute = "hash_1k" if kind == "1k" else "hash_full"
+        files = [file_ for file_ in files if getattr(file_, attribute) is None
+                 and kind not in file_.unavailable]
+        for start in range(0, len(files), HASH_BATCH_SIZE):
+            self._request_hashes(files[start:start + HASH_BATCH_SIZE], kind)
+    
+    def _request_hashes(self, files, kind):
+        reply = self.client.request({"op": "hash", "files": [
+            [str(file_.get_path()), kind] for file_ in files]})
+        for file_, digest in zip(files, reply["digests"]):
+            if digest is None:
+                # Missing or unreadable on the agent's machine
+                file_.unavailable.add(kind)
+                if file_.size <= 1024:
+                    file_.unavailable.add("full" if kind == "1k" else "1k")
+                continue
+            digest = bytes.fromhex(digest)
+            if file_.size <= 1024:
+                # The first 1KiB is the whole file
+                file_.hash_1k = file_.hash_full = digest
+            elif kind == "1k":
+                file_.hash_1k = digest
+            else:
+                file_.hash_full = digest
+    
+    def list_dir(self, rel_path):
+        """ Lists one directory as it is now on the agent's machine, as
+            (rel_path, isdir, size, modified) tuples """
+        entries = self.client.request({"op": "list",
+                                       "path": str(rel_path)})["entries"]
+        return [(PurePath(path), isdir, size,
+                 datetime.datetime.fromtimestamp(mtime))
+                for path, isdir, size, mtime in entries]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", help="Directory to answer requests about")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (0.0.0.0 for every "
+                             "interface)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="TCP port to listen on")
+    parser.add_argument("--token", default=None,
+                        help="Require clients to send this token (clients "
+                             "take it from ALREADYHAVE_AGENT_TOKEN)")
+    args = parser.parse_args()
+    
+    agent = Agent(args.root, args.token)
+    # Scan up front, so that the first client does not wait for it
+    agent.scanned_directory()
+    print("Serving {} on {}:{}".format(args.root, args.host, args.port))
+    agent.serve(args.host, args.port)
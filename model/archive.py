@@ -0,0 +1,175 @@
+"""Lets the contents of .tar(.gz/.bz2/.xz) and .zip archives be compared like
+    a directory, without extracting them to disk."""
+
+import os
+import datetime
+import tarfile
+import zipfile
+
+from pathlib import PurePath, PurePosixPath
+
+from model.directory import Directory, File
+from model.stats import stats
+
+def is_archive(path):
+    """ Returns whether path is a tar or zip archive """
+    if not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+def member_path(name):
+    """ Converts an archive member name to a relative PurePath, or returns None
+        if the name points outside of the archive """
+    parts = [part for part in PurePosixPath(name).parts
+             if part not in ("", ".", "/")]
+    if not parts or ".." in parts:
+        return None
+    return PurePath(*parts)
+
+class ArchiveDirectory(Directory):
+    """ A Directory whose files are the members of an archive.
+        The tree is built from the archive's index. If hash_members is True,
+        both hashes of every member are found during the scan by streaming
+        the members once, in archive order, so that matching never needs
+        random access into the archive. """
+    local = False
+    
+    def __init__(self, path, hash_members=False):
+        Directory.__init__(self, path)
+        self.hash_members = hash_members
+        
+        # Member path -> File, for members that are regular files
+        self.member_files = {}
+    
+    def add_member(self, rel_path, size, modified, isdir):
+        """ Adds one archive member, creating any parent directories that
+            the archive does not list itself. Returns its File, or None if
+            it was left out. """
+        if rel_path in self.directory_map_file or rel_path in self.member_files:
+            # Archives may list a path more than once; keep the first
+            # TODO: Use the last one, which is the one that gets extracted
+            return None
+        
+        parent = self._parent_directory(rel_path.parent, modified)
+        if parent is None:
+            # One of its directories is a file member, as in a and a/b
+            stats.count("archive_members_skipped")
+            return None
+        
+        file_ = File(path=str(rel_path),
+                     size=size,
+                     modified=modified,
+                     isdir=isdir,
+                     parent=parent)
+        self.add_file(file_)
+        if not isdir:
+            self.member_files[rel_path] = file_
+        return file_
+    
+    def _parent_directory(self, rel_path, modified):
+        """ Returns the File of the directory at rel_path, adding it and its
+            parents if the archive does not list them, or None if a file
+            member is in the way """
+        if rel_path in self.directory_map_file:
+            return self.directory_map_file[rel_path]
+        if rel_path in self.member_files:
+            return None
+        
+        parent = self._parent_directory(rel_path.parent, modified)
+        if parent is None:
+            return None
+        file_ = File(path=str(rel_path), size=-1, modified=modified,
+                     isdir=True, parent=parent)
+        self.add_file(file_)
+        return file_
+    
+    def scan(self, update_function=None, finish_function=None):
+        """ Builds the tree from the archive index, then hashes the members
+            if required """
+        root_stat_info = os.stat(self.root_path)
+        root_folder = File(path=".",
+            size=-1,
+            modified=datetime.datetime.fromtimestamp(root_stat_info.st_mtime),
+            isdir=True,
+            parent=None)
+        self.add_file(root_folder)
+        
+        with stats.phase("scan"):
+            if zipfile.is_zipfile(self.root_path):
+                self._scan_zip(update_function)
+            else:
+                self._scan_tar(update_function)
+        
+        if update_function is not None:
+            update_function(1, 1, None)
+        
+        if finish_function is not None:
+            finish_function()
+    
+    def _scan_zip(self, update_function):
+        with zipfile.ZipFile(self.root_path) as archive:
+            # The central directory lists everything up front
+            infos = archive.infolist()
+            for info in infos:
+                rel_path = member_path(info.filename)
+                if rel_path is not None:
+                    self.add_member(rel_path, -1 if info.is_dir() else info.file_size,
+                                    datetime.datetime(*info.date_time),
+                                    info.is_dir())
+            
+            if not self.hash_members:
+                return
+            
+            # Read the members in the order they are stored
+            infos.sort(key=lambda info: info.header_offset)
+            for entries_done, info in enumerate(infos):
+                _file = self.member_files.get(member_path(info.filename))
+                if _file is None or _file.hash_full is not None:
+                    # Directory, or a repeated name that was already hashed
+                    continue
+                
+                with archive.open(info) as f:
+                    _file.find_hashes_stream(f)
+                
+                if entries_done % 100 == 0 and update_function is not None:
+                    update_function(entries_done, len(infos),
+                        self.root_path.joinpath(_file.get_path()))
+    
+    def _scan_tar(self, update_function):
+        # A compressed tar has no index, so its members are listed and hashed
+        # in the same pass
+        with tarfile.open(self.root_path, "r:*") as archive:
+            for entries_done, member in enumerate(archive):
+                rel_path = member_path(member.name)
+                if rel_path is None:
+                    continue
+                
+                target = None
+                if member.islnk():
+                    # A hard link has the data of a member before it
+                    target = self.member_files.get(
+                        member_path(member.linkname))
+                    if target is None:
+                        stats.count("archive_members_skipped")
+                        continue
+                elif not (member.isfile() or member.isdir()):
+                    continue
+                
+                if target is not None:
+                    size = target.size
+                else:
+                    size = member.size if member.isfile() else -1
+                _file = self.add_member(rel_path, size,
+                    datetime.datetime.fromtimestamp(member.mtime),
+                    member.isdir())
+                
+                if _file is not None and target is not None:
+                    _file.hash_1k = target.hash_1k
+                    _file.hash_full = target.hash_full
+                elif _file is not None and member.isfile() and self.hash_members:
+                    with archive.extractfile(member) as f:
+                        _file.find_hashes_stream(f)
+                
+                if entries_done % 100 == 0 and update_function is not None:
+                    # The total is unknown until the end of the archive
+                    update_function(0, 1, self.root_path.joinpath(rel_path))
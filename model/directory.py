@@ -2,11 +2,73 @@
     directories."""
 
 import os
+import errno
+import stat
 import datetime
 import hashlib
+import concurrent.futures
 
 from pathlib import PurePath
 
+from model.parallel_match import process_context
+from model.ratelimit import limiter
+from model.stats import stats
+from model.trace import tracer, call_traced
+
+# Zeros fed to the hash for the holes of sparse files
+_ZEROS = bytes(2 ** 20)
+
+def _describe_file(file_, *args):
+    """ Span arguments for a method of File """
+    return {"path": str(file_.get_path()), "size": file_.size}
+
+def _is_sparse(f):
+    """ Returns whether an open file has fewer bytes allocated than its
+        size and the platform can find its holes. Leaves the file at its
+        start. """
+    if not hasattr(os, "SEEK_DATA"):
+        return False
+    stat_info = os.fstat(f.fileno())
+    if stat_info.st_blocks * 512 >= stat_info.st_size:
+        return False
+    
+    # Some filesystems refuse SEEK_DATA (EINVAL, EOPNOTSUPP), so the file
+    # is read in full there. ENXIO only means it is all one hole.
+    try:
+        f.seek(0, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            stats.count("sparse_seek_failures")
+            f.seek(0)
+            return False
+    f.seek(0)
+    return True
+
+def _update_zeros(h, num_bytes):
+    """ Hashes num_bytes zeros without reading them from anywhere """
+    zeros = memoryview(_ZEROS)
+    while num_bytes > 0:
+        chunk = min(num_bytes, len(zeros))
+        h.update(zeros[:chunk])
+        num_bytes -= chunk
+
+def _data_extents(f):
+    """ Yields the (start, end) of every run of data in an open file, as
+        told by SEEK_DATA and SEEK_HOLE. Everything else reads as zeros. """
+    size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset < size:
+        try:
+            start = f.seek(offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                return
+            raise
+        end = f.seek(start, os.SEEK_HOLE)
+        yield start, end
+        offset = end
+
 class File():
     def __init__(self, path, size, modified, isdir, parent=None):
         self.basename = os.path.basename(path)
@@ -45,14 +107,19 @@ class File():
                 parent.to_match_total += amount
             parent = parent.parent_dir
     
+    @tracer.traced("find_hash_1k", _describe_file)
     def find_hash_1k(self, root_dir):
         """ Finds a hash using the first 1KiB of data in the file """
         if self.hash_1k is not None:
+            stats.count("hash_cache_hits")
             return self.hash_1k
         
         try:
+            limiter.wait_op()
             with open(root_dir.joinpath(self.get_path()), "rb") as f:
-                first_kib = f.read(1024)
+                stats.count("files_opened")
+                first_kib = limiter.read(f, 1024)
+                stats.count("bytes_read_hash_1k", len(first_kib))
                 
                 # Hash it
                 h = hashlib.sha256()
@@ -64,8 +131,13 @@ class File():
         
         return self.hash_1k
     
+    @tracer.traced("find_hash_full", _describe_file)
     def find_hash_full(self, root_dir):
         """ Finds the complete hash of a file """
+        if self.hash_full is not None:
+            stats.count("hash_cache_hits")
+            return self.hash_full
+        
         if self.size <= 1024:
             # Skip reading the file again if we already have the full hash
             self.hash_full = self.find_hash_1k(root_dir)
@@ -73,17 +145,14 @@ class File():
         
         # TODO: Error handling
         try:
+            limiter.wait_op()
             with open(root_dir.joinpath(self.get_path()), "rb") as f:
-                # Read the file in chunks to keep memory usage low
-                buffer_size = 2 ** 16
+                stats.count("files_opened")
                 h = hashlib.sha256()
-                
-                while True:
-                    data = f.read(buffer_size)
-                    if not data:
-                        break
-                    h.update(data)
-                
+                if _is_sparse(f):
+                    self._hash_sparse(f, h)
+                else:
+                    self._hash_data(f, h)
                 self.hash_full = h.digest()
         
         except (FileNotFoundError, PermissionError):
@@ -92,6 +161,84 @@ class File():
             
         return self.hash_full
     
+    def _hash_data(self, f, h, num_bytes=None):
+        """ Hashes num_bytes (everything if None) of an open file from its
+            current position """
+        # Read the file in chunks to keep memory usage low
+        buffer_size = 2 ** 16
+        while num_bytes is None or num_bytes > 0:
+            data = limiter.read(f, buffer_size if num_bytes is None
+                                else min(buffer_size, num_bytes))
+            if not data:
+                break
+            h.update(data)
+            stats.count("bytes_read_hash_full", len(data))
+            if num_bytes is not None:
+                num_bytes -= len(data)
+    
+    def _hash_sparse(self, f, h):
+        """ Hashes an open sparse file, reading only its runs of data and
+            hashing zeros for its holes, which gives the same digest as
+            reading all of it """
+        position = 0
+        for start, end in _data_extents(f):
+            _update_zeros(h, start - position)
+            stats.count("bytes_skipped_holes", start - position)
+            f.seek(start)
+            self._hash_data(f, h, end - start)
+            position = end
+        size = os.fstat(f.fileno()).st_size
+        _update_zeros(h, size - position)
+        stats.count("bytes_skipped_holes", size - position)
+    
+    @tracer.traced("find_hashes_whole", _describe_file)
+    def find_hashes_whole(self, root_dir):
+        """ Finds both hashes of a small file in one pass, by reading all
+            of it at once """
+        try:
+            limiter.wait_op()
+            with open(root_dir.joinpath(self.get_path()), "rb") as f:
+                stats.count("files_opened")
+                chunks = []
+                while True:
+                    chunk = limiter.read(f, 2 ** 16)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+        except (FileNotFoundError, PermissionError):
+            return None
+        
+        data = b"".join(chunks)
+        stats.count("bytes_read_small", len(data))
+        self.hash_full = hashlib.sha256(data).digest()
+        if len(data) <= 1024:
+            self.hash_1k = self.hash_full
+        else:
+            self.hash_1k = hashlib.sha256(data[:1024]).digest()
+        return self.hash_full
+    
+    @tracer.traced("find_hashes_stream", _describe_file)
+    def find_hashes_stream(self, f):
+        """ Finds both hashes by reading an open binary file object once,
+            from its current position to the end """
+        buffer_size = 2 ** 16
+        h = hashlib.sha256()
+        
+        first_kib = limiter.read(f, 1024)
+        h.update(first_kib)
+        self.hash_1k = hashlib.sha256(first_kib).digest()
+        stats.count("bytes_read_stream", len(first_kib))
+        
+        while True:
+            data = limiter.read(f, buffer_size)
+            if not data:
+                break
+            h.update(data)
+            stats.count("bytes_read_stream", len(data))
+        
+        self.hash_full = h.digest()
+        return self.hash_full
+    
     @staticmethod
     def equals(file1, file1_root_dir, file2, file2_root_dir, match_reqs={}):
         """ Compares two files to see if they are equal
@@ -127,6 +274,27 @@ class File():
         # Matched!
         return True
 
+class FileList():
+    """ The files of a directory structure, in the order they were added.
+        Kept in a dict instead of a list, so that removing a file is O(1). """
+    def __init__(self, files=()):
+        self._files = dict.fromkeys(files)
+    
+    def append(self, file_):
+        self._files[file_] = None
+    
+    def remove(self, file_):
+        del self._files[file_]
+    
+    def __contains__(self, file_):
+        return file_ in self._files
+    
+    def __iter__(self):
+        return iter(self._files)
+    
+    def __len__(self):
+        return len(self._files)
+
 class Directory():
     """ A class representing all the files in a directory and all its
         subdirectories.
@@ -134,59 +302,319 @@ class Directory():
         * Be able to store files
         * Be able to list files by directory
         * Be able to look up files by size """
+    # Whether prefetch_hashes finds hashes faster than one at a time
+    batched_hashes = False
+    # Whether the files are on this machine's filesystem, so that they can
+    # be opened, copied into and watched
+    local = True
+    
     def __init__(self, path):
         """ Initialize a Directory object with a root path """
         self.root_path = PurePath(path)
         
         # Set up the data structures
-        self.file_list = []
+        self.file_list = FileList()
         self.directory_map = {}
         self.directory_map_file = {}
-        self.filename_map = {}
+        # (size, basename) -> files, for matching that requires filenames.
+        # None until find_candidates first needs it.
+        self.filename_map = None
         self.size_map = {}
+        
+        # Relative path of the part of the tree that was scanned
+        self.shard_path = PurePath(".")
+        # Number of os.stat calls made while scanning
+        self.stat_calls = 0
     
     def add_file(self, file_):
         """ Adds a file to the directory structure """
+        self._index_file(file_)
+        
+        if not file_.isdir:
+            # Increment the number of matches required for all parent directories
+            file_.set_match(1, True)
+    
+    def _index_file(self, file_, path=None, parent_path=None):
+        """ Adds a file to the lookup structures without changing any
+            match counts. path (for a directory) and parent_path spare
+            working out paths that the caller already knows. """
         self.file_list.append(file_)
         
         if file_.isdir:
             # Create directory mapping
-            self.directory_map_file[file_.get_path()] = file_
-            self.directory_map[file_.get_path()] = []
+            if path is None:
+                path = file_.get_path()
+            self.directory_map_file[path] = file_
+            self.directory_map[path] = []
         else:
             # Add to size map
             if file_.size not in self.size_map:
                 self.size_map[file_.size] = []
             self.size_map[file_.size].append(file_)
-        
-            # Increment the number of matches required for all parent directories
-            file_.set_match(1, True)
             
-            # TODO: Add to filename map, if necessary
+            # Add to filename map, once there is one
+            if self.filename_map is not None:
+                key = (file_.size, file_.basename)
+                if key not in self.filename_map:
+                    self.filename_map[key] = []
+                self.filename_map[key].append(file_)
         
         # Add to parent directory's directory_map entry
         if file_.parent_dir is not None:
-            self.directory_map[file_.parent_dir.get_path()].append(file_)
+            if parent_path is None:
+                parent_path = file_.parent_dir.get_path()
+            self.directory_map[parent_path].append(file_)
+    
+    def find_file(self, rel_path):
+        """ Returns the File at rel_path (relative to the root path), or None
+            Runtime: O(k), where k = number of entries in its directory """
+        rel_path = PurePath(rel_path)
+        if rel_path in self.directory_map_file:
+            return self.directory_map_file[rel_path]
+        
+        for file_ in self.directory_map.get(rel_path.parent, []):
+            if file_.basename == rel_path.name:
+                return file_
+        return None
+    
+    def find_candidates(self, file_, match_reqs={}):
+        """ Returns the files that could match file_ under match_reqs, using
+            the most selective index that the requirements allow.
+            Runtime: O(1) """
+        if match_reqs.get("filename"):
+            if self.filename_map is None:
+                self._build_filename_map()
+            return self.filename_map.get((file_.size, file_.basename), [])
+        return self.size_map.get(file_.size, [])
+    
+    def _build_filename_map(self):
+        """ Builds filename_map from size_map, keeping the order of the
+            files within each size """
+        self.filename_map = {}
+        for files in self.size_map.values():
+            for file_ in files:
+                self.filename_map.setdefault((file_.size, file_.basename),
+                                             []).append(file_)
+    
+    def find_hashes_whole(self, files, workers=8, batch_size=256):
+        """ Finds both hashes of each of files (small files of this
+            directory) that does not have its full hash yet, reading each
+            one whole. Batches of files are read by a pool of threads, so
+            that many opens are in flight at once. """
+        files = [file_ for file_ in files if file_.hash_full is None]
+        batches = [files[start:start + batch_size]
+                   for start in range(0, len(files), batch_size)]
+        
+        def hash_batch(batch):
+            for file_ in batch:
+                file_.find_hashes_whole(self.root_path)
+        
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            # Raise anything a worker raised
+            for _ in executor.map(hash_batch, batches):
+                pass
+        stats.count("small_files_hashed", len(files))
+    
+    def walk_file(self, file_):
+        """ Yields a file and, for a directory, everything below it """
+        yield file_
+        if file_.isdir:
+            for child in self.directory_map[file_.get_path()]:
+                yield from self.walk_file(child)
+    
+    def remove_file(self, file_):
+        """ Removes a file, or a directory and everything below it, from the
+            directory structure. Removed files must not be matched.
+            Removing from file_list is O(1), but the lists in size_map,
+            filename_map and directory_map are searched, which is linear in
+            the files of the same size, of the same name and size, and in the
+            same directory. """
+        if file_.isdir:
+            path = file_.get_path()
+            for child in list(self.directory_map[path]):
+                self.remove_file(child)
+            del self.directory_map[path]
+            del self.directory_map_file[path]
+        else:
+            size_files = self.size_map[file_.size]
+            size_files.remove(file_)
+            if not size_files:
+                del self.size_map[file_.size]
+            
+            if self.filename_map is not None:
+                key = (file_.size, file_.basename)
+                name_files = self.filename_map[key]
+                name_files.remove(file_)
+                if not name_files:
+                    del self.filename_map[key]
+            
+            file_.set_match(-1, True)
+        
+        self.file_list.remove(file_)
+        if file_.parent_dir is not None:
+            self.directory_map[file_.parent_dir.get_path()].remove(file_)
+    
+    def add_path(self, rel_path):
+        """ Adds whatever is at rel_path on the filesystem (relative to the root
+            path), including everything below it for a directory. The parent
+            directory must already be in the directory structure.
+            Returns the list of added files. """
+        rel_path = PurePath(rel_path)
+        parent = self.directory_map_file.get(rel_path.parent)
+        if parent is None:
+            return []
+        
+        full_path = self.root_path.joinpath(rel_path)
+        stats.count("stat_calls")
+        try:
+            stat_info = limiter.stat(full_path)
+        except (FileNotFoundError, PermissionError, NotADirectoryError):
+            return []
+        
+        if stat.S_ISDIR(stat_info.st_mode):
+            # Scan it as a shard, which brings its contents along
+            shard = Directory(self.root_path)
+            shard.scan_shard(rel_path)
+            self.merge(shard)
+            # Shard directories that already existed here were not added
+            return [file_ for file_ in shard.file_list
+                    if file_ in self.file_list]
+        
+        _file = File(path=str(full_path),
+                     size=stat_info.st_size,
+                     modified=datetime.datetime.fromtimestamp(stat_info.st_mtime),
+                     isdir=False,
+                     parent=parent)
+        self.add_file(_file)
+        return [_file]
+    
+    def merge(self, shard):
+        """ Merges a shard (a Directory filled by scan_shard with the same
+            root path) into this directory structure. Directories that
+            already exist here replace their copies in the shard, and the
+            shard's match counts are added to them.
+            Runtime: O(n), where n = number of entries in the shard """
+        # Shard directories that were replaced by one of our own
+        replaced = {}
+        # Shard directory -> its path, so that no path is worked out again
+        dir_paths = {dir_file: path for path, dir_file
+                     in shard.directory_map_file.items()}
+        
+        # Parents always come before their children in file_list
+        for file_ in shard.file_list:
+            parent_path = dir_paths.get(file_.parent_dir)
+            if file_.parent_dir in replaced:
+                file_.parent_dir = replaced[file_.parent_dir]
+            
+            path = dir_paths.get(file_)
+            if file_.isdir:
+                existing = self.directory_map_file.get(path)
+                if existing is not None:
+                    # Each shard directory counts every file below it in the
+                    # shard, so adding the counts keeps the totals right
+                    existing.to_match += file_.to_match
+                    existing.to_match_total += file_.to_match_total
+                    replaced[file_] = existing
+                    continue
+            
+            self._index_file(file_, path, parent_path)
     
     def scan(self, update_function=None, finish_function=None):
         """ Scan the directory and all subdirectories for files and folders,
             periodically sending updates with update_function """
+        with stats.phase("scan"):
+            self.scan_shard(PurePath("."), update_function)
+        
+        if update_function is not None:
+            update_function(1, 1, None)
+        
+        if finish_function is not None:
+            finish_function()
+    
+    def scan_sharded(self, processes=None, update_function=None,
+                     finish_function=None):
+        """ Scan the directory by giving each top-level subdirectory to a
+            separate process, then merge the shards into this directory
+            structure. processes defaults to the number of CPUs, and the
+            read limits are split between them.
+            A shard that cannot be scanned (its directory was removed or
+            cannot be read) is left empty, like a subdirectory that os.walk
+            cannot list in scan. """
+        # Top level first, so the shards can be attached to it
+        self.scan_shard(PurePath("."), recursive=False)
+        shard_paths = [file_.get_path() for file_ in
+                       self.directory_map[PurePath(".")] if file_.isdir]
+        
+        num_workers = min(processes or os.cpu_count() or 1,
+                          max(len(shard_paths), 1))
+        limits = limiter.shares(num_workers)
+        with stats.phase("scan"), \
+             concurrent.futures.ProcessPoolExecutor(
+                 num_workers, mp_context=process_context()) as executor:
+            futures = {executor.submit(call_traced, tracer.worker_start(),
+                                       _scan_shard_worker, self.root_path,
+                                       shard_path, limits): shard_path
+                       for shard_path in shard_paths}
+            for shards_done, future in enumerate(
+                    concurrent.futures.as_completed(futures), 1):
+                try:
+                    shard, spans = future.result()
+                except OSError:
+                    # Left empty, as scan leaves directories it cannot list
+                    pass
+                else:
+                    tracer.add_events(spans)
+                    self.merge(shard)
+                    # Counted in the worker process, which has its own stats
+                    stats.count("stat_calls", shard.stat_calls)
+                
+                if update_function is not None:
+                    update_function(shards_done, len(shard_paths),
+                        self.root_path.joinpath(futures[future]))
+        
+        if update_function is not None:
+            update_function(1, 1, None)
+        
+        if finish_function is not None:
+            finish_function()
+    
+    def scan_shard(self, shard_path, update_function=None, recursive=True):
+        """ Scan only the subdirectory shard_path (relative to the root path)
+            and everything below it. The directories between the root and
+            shard_path are added as well, so that the result can later be
+            combined with other shards using merge.
+            If recursive is False, subdirectories are added but not scanned. """
+        self.shard_path = PurePath(shard_path)
+        
         # Files and folders left to read (initialized to 1 to read the root
         # directory)
         entries_total = 1
         # Files and folders read so far
         entries_done = 0
         
-        # Add root folder
-        root_stat_info = os.stat(self.root_path)
-        root_folder = File(path=".",
-            size=-1,
-            modified=datetime.datetime.fromtimestamp(root_stat_info.st_mtime),
-            isdir=True,
-            parent=None)
-        self.add_file(root_folder)
+        # Add root folder and the folders leading down to the shard
+        parent = None
+        for depth in range(len(self.shard_path.parts) + 1):
+            rel_path = PurePath(".", *self.shard_path.parts[:depth])
+            stat_info = limiter.stat(self.root_path.joinpath(rel_path))
+            folder = File(path=str(rel_path),
+                size=-1,
+                modified=datetime.datetime.fromtimestamp(stat_info.st_mtime),
+                isdir=True,
+                parent=parent)
+            self.add_file(folder)
+            parent = folder
+        self.stat_calls += len(self.shard_path.parts) + 1
+        stats.count("stat_calls", len(self.shard_path.parts) + 1)
+        
+        if self.shard_path.parts and os.path.islink(
+                self.root_path.joinpath(self.shard_path)):
+            # os.walk in a scan from the root lists links to directories but
+            # does not follow them, so neither does a shard
+            return
         
-        for path, subdirs, files in os.walk(self.root_path):
+        for path, subdirs, files in os.walk(self.root_path.joinpath(self.shard_path)):
+            span_start = tracer.begin()
             entries_done += 1
             entries_total += len(subdirs) + len(files)
             
@@ -195,7 +623,7 @@ class Directory():
             # Add subdirectories
             for subdir in subdirs:
                 try:
-                    stat_info = os.stat(os.path.join(path, subdir))
+                    stat_info = limiter.stat(os.path.join(path, subdir))
                     mdate = datetime.datetime.fromtimestamp(stat_info.st_mtime)
                     
                     # A negative file size tells the renderer to ignore it
@@ -210,12 +638,12 @@ class Directory():
                 
                 if entries_done % 100 == 0 and update_function is not None:
                     update_function(entries_done, entries_total,
-                        self.root_path.joinpath(dirfile.get_path()))
+                                    os.path.join(path, subdir))
             
             # Add files
             for filename in files:
                 try:
-                    stat_info = os.stat(os.path.join(path, filename))
+                    stat_info = limiter.stat(os.path.join(path, filename))
                     mdate = datetime.datetime.fromtimestamp(stat_info.st_mtime)
                     _file = File(path=os.path.join(path, filename),
                                  size=stat_info.st_size,
@@ -230,14 +658,27 @@ class Directory():
                 
                 if entries_done % 100 == 0 and update_function is not None:
                     update_function(entries_done, entries_total,
-                        self.root_path.joinpath(_file.get_path()))
+                                    os.path.join(path, filename))
             
             # Reset some of these
             entries_done -= len(files) + 1
             entries_total -= len(files) + 1
-        
-        if update_function is not None:
-            update_function(1, 1, None)
-        
-        if finish_function is not None:
-            finish_function()
+            
+            # Every entry was stat'ed once
+            self.stat_calls += len(subdirs) + len(files)
+            stats.count("stat_calls", len(subdirs) + len(files))
+            tracer.end("scan directory", span_start, path=path,
+                       entries=len(subdirs) + len(files))
+            
+            if not recursive:
+                # Keep os.walk from descending into the subdirectories
+                subdirs.clear()
+
+def _scan_shard_worker(root_path, shard_path, limits):
+    """ Scans one shard in a worker process, within its share of the read
+        limits (see IOLimiter.shares), and returns it """
+    limiter.set_limits(*limits)
+    shard = Directory(root_path)
+    with tracer.span("scan shard", path=str(shard_path)):
+        shard.scan_shard(shard_path)
+    return shard
@@ -0,0 +1,200 @@
+"""Estimates how much of one directory is already in another from a random
+    sample of its files, long before a full comparison would finish.
+    Samples are stratified by top-level directory and by size, and the
+    estimates come with confidence intervals that narrow as samples arrive."""
+
+import datetime
+import heapq
+import math
+import random
+import time
+
+from model.directory import File
+from model.matcher import Matcher
+from model.ratelimit import limiter
+
+# Size classes are powers of two to this power (16x apart)
+SIZE_CLASS_BITS = 4
+
+def _stratum_key(file_):
+    """ (top-level directory, size class) of a file """
+    parts = file_.get_path().parts
+    top = parts[0] if len(parts) > 1 else "."
+    size_class = (file_.size.bit_length() - 1) // SIZE_CLASS_BITS
+    return (top, size_class)
+
+def _detached_file(root_path, rel_path, stat_info):
+    """ A File for rel_path with a chain of parent directories of its own,
+        without adding anything to a Directory """
+    date = datetime.datetime.fromtimestamp(0)
+    parent = File(".", -1, date, True)
+    for part in rel_path.parent.parts:
+        parent = File(part, -1, date, True, parent)
+    return File(str(root_path.joinpath(rel_path)), stat_info.st_size,
+                datetime.datetime.fromtimestamp(stat_info.st_mtime), False,
+                parent)
+
+class _Stratum():
+    def __init__(self, files):
+        self.files = files
+        self.max_size = max(file_.size for file_ in files)
+        # Results of the samples so far: 1 or 0, and matched bytes
+        self.matches = []
+        self.matched_bytes = []
+    
+    def mean_variance(self, values, high, confidence_z):
+        """ Mean of values, which are between 0 and high, and the variance
+            of that mean as an estimate of the mean of the whole stratum.
+            Like the Agresti-Coull interval, the variance is that of the
+            samples plus confidence_z ** 2 / 2 made up samples at each end,
+            so that a few samples that are all the same do not make it 0. """
+        num_samples = len(values)
+        extra = confidence_z ** 2 / 2
+        adjusted_samples = num_samples + 2 * extra
+        adjusted_mean = (sum(values) + extra * high) / adjusted_samples
+        variance = ((sum(value ** 2 for value in values) + extra * high ** 2)
+                    / adjusted_samples - adjusted_mean ** 2)
+        mean = sum(values) / num_samples if num_samples else high / 2
+        # Finite population correction, since files are not sampled twice
+        return mean, ((1 - num_samples / len(self.files)) * max(variance, 0.0)
+                      / adjusted_samples)
+
+class Estimator():
+    """ Samples files of sample_dir (a scanned Directory) and looks for a
+        matching file in other_dir, following match_reqs like File.equals.
+        If other_dir was scanned, its index is searched like Matcher
+        does. Otherwise only the same relative path is stat'ed, so files
+        that moved count as missing, but nothing has to be scanned. """
+    def __init__(self, sample_dir, other_dir, match_reqs, seed=None,
+                 confidence_z=1.96):
+        """ confidence_z: Width of the confidence intervals in standard
+                          deviations (1.96 for 95%) """
+        self.sample_dir = sample_dir
+        self.other_dir = other_dir
+        self.match_reqs = match_reqs
+        self.confidence_z = confidence_z
+        self.rng = random.Random(seed)
+        # Only used for which files to ignore
+        self.matcher = Matcher([sample_dir, other_dir], match_reqs)
+        
+        strata_files = {}
+        for file_ in sample_dir.file_list:
+            if file_.isdir or self.matcher.ignore_file(file_):
+                continue
+            strata_files.setdefault(_stratum_key(file_), []).append(file_)
+        
+        self.strata = []
+        for key in sorted(strata_files):
+            files = strata_files[key]
+            # Sampling without replacement is taking them in a random order
+            self.rng.shuffle(files)
+            self.strata.append(_Stratum(files))
+        self.total_files = sum(len(stratum.files) for stratum in self.strata)
+        self.total_bytes = sum(file_.size for stratum in self.strata
+                               for file_ in stratum.files)
+        self.samples = 0
+        
+        # Proportional allocation: the next sample comes from the stratum
+        # that is furthest behind its share
+        self._queue = [(-len(stratum.files), index)
+                       for index, stratum in enumerate(self.strata)]
+        heapq.heapify(self._queue)
+    
+    def find_counterpart(self, file_):
+        """ Returns a file of other_dir that matches file_, or None """
+        sample_root = self.sample_dir.root_path
+        other_root = self.other_dir.root_path
+        if self.other_dir.file_list:
+            for file2 in self.other_dir.find_candidates(file_,
+                                                        self.match_reqs):
+                if File.equals(file_, sample_root, file2, other_root,
+                               self.match_reqs):
+                    return file2
+            return None
+        
+        rel_path = file_.get_path()
+        try:
+            stat_info = limiter.stat(other_root.joinpath(rel_path))
+        except (FileNotFoundError, PermissionError, NotADirectoryError):
+            return None
+        file2 = _detached_file(other_root, rel_path, stat_info)
+        if File.equals(file_, sample_root, file2, other_root, self.match_reqs):
+            return file2
+        return None
+    
+    def sample(self, num_samples=1):
+        """ Takes up to num_samples more samples. Returns the number taken,
+            which is less once every file has been sampled. """
+        taken = 0
+        while taken < num_samples and self._queue:
+            _, index = heapq.heappop(self._queue)
+            stratum = self.strata[index]
+            file_ = stratum.files[len(stratum.matches)]
+            
+            matched = self.find_counterpart(file_) is not None
+            stratum.matches.append(1 if matched else 0)
+            stratum.matched_bytes.append(file_.size if matched else 0)
+            self.samples += 1
+            taken += 1
+            
+            if len(stratum.matches) < len(stratum.files):
+                heapq.heappush(self._queue, (-len(stratum.files) /
+                                             (len(stratum.matches) + 1), index))
+        return taken
+    
+    def result(self):
+        """ Returns the current estimates as a dictionary. Intervals are
+            (low, high) and clipped to what is possible. """
+        fraction = fraction_variance = 0.0
+        matched_bytes = bytes_variance = 0.0
+        for stratum in self.strata:
+            weight = len(stratum.files) / self.total_files
+            mean, variance = stratum.mean_variance(stratum.matches, 1,
+                                                   self.confidence_z)
+            fraction += weight * mean
+            fraction_variance += weight ** 2 * variance
+            
+            mean, variance = stratum.mean_variance(stratum.matched_bytes,
+                                                   stratum.max_size,
+                                                   self.confidence_z)
+            matched_bytes += len(stratum.files) * mean
+            bytes_variance += len(stratum.files) ** 2 * variance
+        
+        fraction_margin = self.confidence_z * math.sqrt(fraction_variance)
+        bytes_margin = self.confidence_z * math.sqrt(bytes_variance)
+        return {
+            "samples": self.samples,
+            "total_files": self.total_files,
+            "total_bytes": self.total_bytes,
+            "matched_fraction": fraction,
+            "matched_fraction_interval": (max(fraction - fraction_margin, 0.0),
+                                          min(fraction + fraction_margin, 1.0)),
+            "matched_bytes": matched_bytes,
+            "matched_bytes_interval": (
+                max(matched_bytes - bytes_margin, 0.0),
+                min(matched_bytes + bytes_margin, self.total_bytes))
+        }
+    
+    def run(self, max_samples=None, time_limit=None, target_margin=None,
+            update_function=None, batch_size=50):
+        """ Samples until max_samples were taken, time_limit seconds passed,
+            the matched fraction is known to within target_margin (either
+            side), or every file was sampled. Calls update_function(result)
+            after every batch of samples and returns the last result. """
+        start = time.monotonic()
+        while True:
+            if max_samples is not None:
+                batch_size = min(batch_size, max_samples - self.samples)
+            taken = self.sample(batch_size) if batch_size > 0 else 0
+            result = self.result()
+            if update_function is not None:
+                update_function(result)
+            
+            low, high = result["matched_fraction_interval"]
+            if (taken == 0 or
+                    (max_samples is not None and self.samples >= max_samples) or
+                    (time_limit is not None and
+                     time.monotonic() - start >= time_limit) or
+                    (target_margin is not None and
+                     (high - low) / 2 <= target_margin)):
+                return result
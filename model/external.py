@@ -0,0 +1,172 @@
+"""Out-of-core matching for trees whose metadata does not fit in memory.
+    Scan records are spilled to sorted runs on disk and merge-joined across
+    the roots, so that only one group of candidate files is held in memory
+    at a time."""
+
+import os
+import heapq
+import pickle
+import tempfile
+import itertools
+
+from pathlib import PurePath
+
+from model.directory import File
+from model.ratelimit import limiter
+from model.stats import stats
+
+# Approximate number of bytes a scan record takes in memory, excluding the
+# characters of its strings
+RECORD_OVERHEAD = 250
+
+def record_key(match_reqs):
+    """ Returns a function giving the join key of a scan record
+        (size, basename, mtime, rel_path). Only the properties required by
+        match_reqs are part of the key, so records that could match each
+        other are always adjacent once sorted. """
+    def key(record):
+        size, basename, mtime, _ = record
+        return (size,
+                basename if match_reqs.get("filename") else "",
+                mtime if match_reqs.get("modtime") else 0.0)
+    return key
+
+def scan_records(root_path, match_reqs):
+    """ Yields a scan record (size, basename, mtime, rel_path) for every file
+        below root_path that is not ignored """
+    for path, subdirs, files in os.walk(root_path):
+        # Skip .git folders
+        # TODO: Move to configurable settings
+        subdirs[:] = [subdir for subdir in subdirs if subdir != ".git"]
+        
+        for filename in files:
+            full_path = os.path.join(path, filename)
+            stats.count("stat_calls")
+            try:
+                stat_info = limiter.stat(full_path)
+            except (FileNotFoundError, PermissionError):
+                continue
+            
+            if stat_info.st_size == 0 and not match_reqs.get("zero"):
+                continue
+            
+            yield (stat_info.st_size, filename, stat_info.st_mtime,
+                   os.path.relpath(full_path, root_path))
+
+def write_runs(records, key, run_dir, memory_limit):
+    """ Splits records into sorted runs of roughly memory_limit bytes each,
+        written to files in run_dir. Returns the paths of the runs. """
+    run_paths = []
+    buffer = []
+    buffer_bytes = 0
+    for record in records:
+        buffer.append(record)
+        buffer_bytes += RECORD_OVERHEAD + len(record[1]) + len(record[3])
+        
+        if buffer_bytes >= memory_limit:
+            run_paths.append(_write_run(buffer, key, run_dir))
+            buffer = []
+            buffer_bytes = 0
+    
+    if buffer:
+        run_paths.append(_write_run(buffer, key, run_dir))
+    
+    return run_paths
+
+def _write_run(buffer, key, run_dir):
+    """ Sorts buffer and writes it to a new run file """
+    buffer.sort(key=lambda record: (key(record), record[3]))
+    fd, run_path = tempfile.mkstemp(suffix=".run", dir=run_dir)
+    with os.fdopen(fd, "wb") as f:
+        for record in buffer:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return run_path
+
+def read_run(run_path):
+    """ Yields the records of a run file in order """
+    with open(run_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def sorted_records(run_paths, key):
+    """ Merges several runs into a single sorted stream of records """
+    return heapq.merge(*[read_run(run_path) for run_path in run_paths],
+                       key=lambda record: (key(record), record[3]))
+
+def external_match(root_paths, match_reqs, memory_limit=256 * 2 ** 20,
+                   tmp_dir=None):
+    """ Finds the files that match across root_paths without keeping every
+        scan record in memory.
+        memory_limit: Approximate number of bytes of scan records to buffer
+                      before spilling a sorted run to disk. Candidate groups
+                      (files sharing a join key) are held in memory whole.
+        tmp_dir: Where to put the runs (defaults to the system temp folder)
+        Yields (matched, members) tuples, where members is a list of
+        (root_index, rel_path) that all match each other. Every file is
+        yielded exactly once; unmatched files are yielded on their own. """
+    key = record_key(match_reqs)
+    
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        streams = []
+        for root_path in root_paths:
+            run_paths = write_runs(scan_records(root_path, match_reqs), key,
+                                   run_dir, memory_limit)
+            streams.append(itertools.groupby(sorted_records(run_paths, key),
+                                             key=key))
+        
+        # Merge-join the streams one key at a time
+        heads = [next(stream, None) for stream in streams]
+        while any(head is not None for head in heads):
+            min_key = min(head[0] for head in heads if head is not None)
+            
+            group = []
+            for root_index, head in enumerate(heads):
+                if head is not None and head[0] == min_key:
+                    group.extend((root_index, record) for record in head[1])
+                    heads[root_index] = next(streams[root_index], None)
+            
+            yield from _match_group(group, root_paths, match_reqs)
+
+def _match_group(group, root_paths, match_reqs):
+    """ Splits a group of records sharing a join key into match groups """
+    if len(set(root_index for root_index, _ in group)) < 2:
+        # Nothing to match against in the other roots
+        for root_index, record in group:
+            yield False, [(root_index, record[3])]
+        return
+    
+    if not match_reqs.get("hash"):
+        yield True, [(root_index, record[3]) for root_index, record in group]
+        return
+    
+    # Only now are the files themselves needed
+    candidates = []
+    for root_index, (size, basename, mtime, rel_path) in group:
+        file_ = File(rel_path, size, mtime, False)
+        file_root = PurePath(root_paths[root_index]).joinpath(
+            PurePath(rel_path).parent)
+        candidates.append((root_index, rel_path, file_, file_root))
+    
+    buckets = [candidates]
+    for hash_function in (File.find_hash_1k, File.find_hash_full):
+        by_digest = {}
+        for bucket_index, bucket in enumerate(buckets):
+            for candidate in bucket:
+                digest = hash_function(candidate[2], candidate[3])
+                by_digest.setdefault((bucket_index, digest), []).append(candidate)
+        
+        # Keep only buckets that can still match across roots
+        buckets = []
+        for (_, digest), bucket in by_digest.items():
+            if (digest is not None
+                and len(set(candidate[0] for candidate in bucket)) > 1):
+                buckets.append(bucket)
+            else:
+                for candidate in bucket:
+                    yield False, [(candidate[0], candidate[1])]
+    
+    for bucket in buckets:
+        yield True, [(candidate[0], candidate[1]) for candidate in bucket]
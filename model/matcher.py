@@ -0,0 +1,351 @@
+"""Finds the files that match across several directories and keeps the match
+    counts of their parent directories up to date."""
+
+import concurrent.futures
+import itertools
+import math
+import time
+
+from model.directory import File
+from model.parallel_match import (SharedColumns, match_pairs, process_context,
+                                  TASKS_PER_PROCESS)
+from model.stats import stats
+from model.trace import tracer
+
+class Matcher():
+    """ Matches the files of a list of Directory objects against each other.
+        Files only match files in other directories, never in their own. """
+    def __init__(self, dirs, match_reqs, processes=0, small_file_size=4096,
+                 small_file_workers=8):
+        """ dirs: List of Directory objects (may be filled in later)
+            match_reqs: Dictionary of match requirements, see File.equals
+            processes: If above 0, find_duplicates finds candidates with
+                       this many worker processes
+            small_file_size: When hashes are required, files up to this
+                             many bytes are read whole in batches and
+                             matched in bulk by their hashes (0 turns this
+                             off)
+            small_file_workers: Threads reading small files """
+        self.dirs = dirs
+        self.match_reqs = match_reqs
+        self.processes = processes
+        self.small_file_size = small_file_size
+        self.small_file_workers = small_file_workers
+        
+        # File -> list of all the files it matches, including itself. Every
+        # file in the list shares the same list object.
+        self.match_dict = {}
+    
+    def ignore_file(self, file_):
+        """ Returns whether this file should be ignored """
+        if file_.size == 0 and not self.match_reqs.get("zero"):
+            return True
+        
+        # Hide .git folder
+        # TODO: Move to configurable settings
+        if ".git" in file_.get_path().parts:
+            return True
+        
+        return False
+    
+    def ignored_flags(self, files):
+        """ ignore_file for each of files, without finding every file's
+            path: whether a directory is inside a .git folder is worked out
+            once and shared by everything below it """
+        # Directory -> whether it is a .git folder or inside one
+        in_git = {None: False}
+        def dir_in_git(dir_file):
+            if dir_file not in in_git:
+                in_git[dir_file] = (dir_file.basename == ".git"
+                                    or dir_in_git(dir_file.parent_dir))
+            return in_git[dir_file]
+        
+        match_zero = self.match_reqs.get("zero")
+        return [(file_.size == 0 and not match_zero)
+                or file_.basename == ".git" or dir_in_git(file_.parent_dir)
+                for file_ in files]
+    
+    def propagate_matched(self, _file, empty=False):
+        """ Propagates to parent directories that the file was matched
+            If empty is True, then the to_match_total will also be
+            decreased """
+        if _file.matched:
+            return
+        _file.matched = True
+        if not _file.isdir:
+            _file.set_match(-1, affect_total=empty)
+    
+    def add_match(self, _file, _file2):
+        """ Records that two files match each other """
+        self.propagate_matched(_file)
+        self.propagate_matched(_file2)
+        
+        # Add to match dictionary
+        if _file in self.match_dict:
+            if _file2 not in self.match_dict:
+                self.match_dict[_file].append(_file2)
+                self.match_dict[_file2] = self.match_dict[_file]
+        elif _file2 in self.match_dict:
+            self.match_dict[_file2].append(_file)
+            self.match_dict[_file] = self.match_dict[_file2]
+        else:
+            # Add both
+            self.match_dict[_file] = [_file, _file2]
+            self.match_dict[_file2] = self.match_dict[_file]
+    
+    @tracer.traced("match bucket", lambda self, _file, dir_1, dir_2: {
+        "size": _file.size,
+        "candidates": len(dir_2.find_candidates(_file, self.match_reqs))})
+    def match_file(self, _file, dir_1, dir_2):
+        """ Matches one file of dir_1 against the files of dir_2 """
+        # Use the size (and filename) index to reduce the number of checks
+        # required by a large proportion to begin with
+        for _file2 in dir_2.find_candidates(_file, self.match_reqs):
+            # Do not count ignored files
+            file1_ignore = self.ignore_file(_file)
+            file2_ignore = self.ignore_file(_file2)
+            
+            if file1_ignore or file2_ignore:
+                continue
+            
+            # Do equals check on these files
+            stats.count("candidate_pairs")
+            if File.equals(_file, dir_1.root_path, _file2, dir_2.root_path,
+                           self.match_reqs):
+                stats.count("matches")
+                self.add_match(_file, _file2)
+    
+    def mark_ignored(self, files):
+        """ Counts the ignored files among files as matched, so that they do
+            not keep their directories from being complete """
+        for file_, ignored in zip(files, self.ignored_flags(files)):
+            if ignored:
+                self.propagate_matched(file_, True)
+    
+    def prefetch_hashes(self, dir_1, dir_2):
+        """ Has directories that find hashes in batches (see
+            Directory.batched_hashes) find the hashes that matching dir_1
+            with dir_2 is going to need up front, instead of one at a time
+            while matching """
+        if not self.match_reqs.get("hash"):
+            return
+        
+        for dir_, other_dir in [(dir_1, dir_2), (dir_2, dir_1)]:
+            if not dir_.batched_hashes:
+                continue
+            files = [file_ for file_ in dir_.file_list
+                     if not file_.isdir and not self.ignore_file(file_)
+                     and other_dir.find_candidates(file_, self.match_reqs)]
+            dir_.prefetch_hashes(files, "1k")
+            
+            # Full hashes are only compared once the first 1KiB matched
+            dir_.prefetch_hashes([
+                file_ for file_ in files
+                if file_.size > 1024 and any(
+                    candidate.find_hash_1k(other_dir.root_path) == file_.hash_1k
+                    for candidate in other_dir.find_candidates(
+                        file_, self.match_reqs))], "full")
+    
+    def is_small(self, file_):
+        """ Returns whether a file is matched by match_small_files """
+        return bool(self.match_reqs.get("hash") and self.small_file_size > 0
+                    and not file_.isdir and file_.size <= self.small_file_size)
+    
+    @tracer.traced("prefetch small hashes")
+    def prefetch_small_hashes(self, dir_1, dir_2):
+        """ Finds the hashes of the small files of dir_1 that have
+            candidates in dir_2, and of those candidates, in batches.
+            Returns (the small files of dir_1 that have candidates, in
+            file_list order, and their candidates). """
+        small_files = []
+        # Candidates in dir_2, in the order find_candidates gives them
+        candidates = {}
+        # Whether each file of dir_2 is ignored, since every file of a size
+        # bucket looks at the same ones
+        ignored = {}
+        for file_ in dir_1.file_list:
+            if not self.is_small(file_) or self.ignore_file(file_):
+                continue
+            file_candidates = []
+            for file2 in dir_2.find_candidates(file_, self.match_reqs):
+                if file2 not in ignored:
+                    ignored[file2] = self.ignore_file(file2)
+                # Only files that match on everything but the hash
+                if not ignored[file2] and (not self.match_reqs.get("modtime")
+                                           or file2.modified == file_.modified):
+                    file_candidates.append(file2)
+            if file_candidates:
+                small_files.append(file_)
+                candidates.update(dict.fromkeys(file_candidates))
+        
+        # Directories that fetch hashes in batches already did
+        for dir_, files in [(dir_1, small_files), (dir_2, list(candidates))]:
+            if not dir_.batched_hashes:
+                dir_.find_hashes_whole(files, self.small_file_workers)
+        return small_files, list(candidates)
+    
+    @tracer.traced("match small files")
+    def match_small_files(self, dir_1, dir_2):
+        """ Matches the small files of dir_1 with dir_2 by grouping them on
+            their hashes, instead of comparing them pair by pair. Finds the
+            same matches in the same order as match_file would. """
+        small_files, candidates = self.prefetch_small_hashes(dir_1, dir_2)
+        
+        def key(file_):
+            return (file_.size,
+                    file_.basename if self.match_reqs.get("filename") else None,
+                    file_.modified if self.match_reqs.get("modtime") else None,
+                    file_.hash_full)
+        groups = {}
+        for file2 in candidates:
+            if file2.hash_full is not None:
+                groups.setdefault(key(file2), []).append(file2)
+        
+        for _file in small_files:
+            if _file.hash_full is None:
+                continue
+            for _file2 in groups.get(key(_file), []):
+                stats.count("matches")
+                self.add_match(_file, _file2)
+    
+    def find_duplicates(self, update_function=None):
+        """ Finds duplicate files in separate directories, periodically
+            sending updates with update_function(fraction, text) """
+        with stats.phase("match"):
+            if self.processes > 0:
+                self._find_duplicates_parallel(update_function)
+            else:
+                self._find_duplicates(update_function)
+    
+    def _find_duplicates(self, update_function):
+        dir_num_combos = (math.factorial(len(self.dirs))
+                          // math.factorial(2)
+                          // math.factorial(len(self.dirs) - 2))
+        last_updated_time = time.time()
+        # Update progress bar 5 times per second
+        progress_update_interval = 0.2
+        for dir_combo_i, (dir_1, dir_2) in enumerate(itertools.combinations(self.dirs, r=2)):
+            self.prefetch_hashes(dir_1, dir_2)
+            self.match_small_files(dir_1, dir_2)
+            for file_i, _file in enumerate(dir_1.file_list):
+                
+                # Update the progress bar
+                if (update_function is not None
+                    and time.time() - last_updated_time > progress_update_interval):
+                    fraction = (dir_combo_i / dir_num_combos
+                        + (file_i / len(dir_1.file_list)) / dir_num_combos)
+                    update_function(fraction, _file.get_path())
+                    last_updated_time = time.time()
+                
+                if not self.is_small(_file):
+                    self.match_file(_file, dir_1, dir_2)
+            
+            # Ignore files that were not matched before
+            if update_function is not None:
+                update_function((dir_combo_i + 1) / dir_num_combos,
+                                "Checking for ignored files...")
+            self.mark_ignored(dir_1.file_list)
+            self.mark_ignored(dir_2.file_list)
+    
+    def _find_duplicates_parallel(self, update_function):
+        """ Like _find_duplicates, with the candidates found by worker
+            processes (see model.parallel_match). Hashes are still compared
+            here, where the File objects are. """
+        name_ids = {}
+        modified_ids = {}
+        columns = []
+        try:
+            with tracer.span("share columns"):
+                for dir_ in self.dirs:
+                    files = [file_ for file_ in dir_.file_list
+                             if not file_.isdir]
+                    columns.append(SharedColumns(files, name_ids, modified_ids,
+                                                 self.ignored_flags(files)))
+            
+            combos = list(itertools.combinations(range(len(self.dirs)), r=2))
+            with concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=process_context()) as executor:
+                for combo_i, (index_1, index_2) in enumerate(combos):
+                    dir_1, dir_2 = self.dirs[index_1], self.dirs[index_2]
+                    self.prefetch_hashes(dir_1, dir_2)
+                    # Found here, so that comparing pairs below reads nothing
+                    self.prefetch_small_hashes(dir_1, dir_2)
+                    # The workers' own spans are added to the trace too
+                    span_start = tracer.begin()
+                    for position_1, position_2 in match_pairs(
+                            columns[index_1], columns[index_2],
+                            self.match_reqs, executor,
+                            self.processes * TASKS_PER_PROCESS):
+                        _file = columns[index_1].files[position_1]
+                        _file2 = columns[index_2].files[position_2]
+                        stats.count("candidate_pairs")
+                        if (not self.match_reqs.get("hash")
+                            or File.equals(_file, dir_1.root_path, _file2,
+                                           dir_2.root_path, self.match_reqs)):
+                            stats.count("matches")
+                            self.add_match(_file, _file2)
+                    tracer.end("match pairs", span_start,
+                               dirs=[str(dir_1.root_path),
+                                     str(dir_2.root_path)])
+                    
+                    if update_function is not None:
+                        update_function((combo_i + 1) / len(combos),
+                                        "Checking for ignored files...")
+                    self.mark_ignored(dir_1.file_list)
+                    self.mark_ignored(dir_2.file_list)
+        finally:
+            for dir_columns in columns:
+                dir_columns.close()
+    
+    def reset_match(self, file_):
+        """ Forgets every match of a file, returning it to the unmatched
+            state (ignored files included) """
+        if file_.matched:
+            file_.matched = False
+            # Ignored files also left the total when they were marked
+            file_.set_match(1, affect_total=self.ignore_file(file_))
+        
+        group = self.match_dict.pop(file_, None)
+        if group is not None:
+            group.remove(file_)
+    
+    def rematch_sizes(self, sizes):
+        """ Matches every file with one of these sizes again, without
+            touching any other file """
+        for size in sizes:
+            for dir_ in self.dirs:
+                for file_ in dir_.size_map.get(size, []):
+                    self.reset_match(file_)
+            
+            for dir_1, dir_2 in itertools.combinations(self.dirs, r=2):
+                for _file in dir_1.size_map.get(size, []):
+                    self.match_file(_file, dir_1, dir_2)
+            
+            for dir_ in self.dirs:
+                self.mark_ignored(dir_.size_map.get(size, []))
+    
+    def refresh_paths(self, dir_index, rel_paths):
+        """ Brings the given paths of one directory up to date with the
+            filesystem, then matches the affected sizes again.
+            Runtime: proportional to the changed files and the size buckets
+            they are in, not to the size of the trees """
+        with stats.phase("rematch"):
+            self._refresh_paths(dir_index, rel_paths)
+    
+    def _refresh_paths(self, dir_index, rel_paths):
+        dir_ = self.dirs[dir_index]
+        sizes = set()
+        for rel_path in rel_paths:
+            existing = dir_.find_file(rel_path)
+            if existing is not None:
+                for file_ in dir_.walk_file(existing):
+                    if not file_.isdir:
+                        self.reset_match(file_)
+                        sizes.add(file_.size)
+                dir_.remove_file(existing)
+            
+            for file_ in dir_.add_path(rel_path):
+                if not file_.isdir:
+                    sizes.add(file_.size)
+        
+        self.rematch_sizes(sizes)
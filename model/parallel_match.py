@@ -0,0 +1,172 @@
+"""Matching spread over several processes, for trees with millions of files
+    where matching on names, sizes and dates is bound by the CPU. Each
+    directory's metadata is put in shared memory as columns of integers,
+    every worker matches a disjoint range of sizes, and only pairs of
+    positions come back. File objects never leave the parent process.
+    
+    Worker processes are only worth starting for trees far larger than
+    their startup cost, and on machines with cores to spare; time both
+    with `python -m test.benchmark --match-processes N` first."""
+
+import array
+import bisect
+import itertools
+import multiprocessing
+import operator
+
+from multiprocessing import shared_memory
+
+from model.trace import tracer, call_traced
+
+# Columns of a directory's shared memory block, each an int64 per file
+SIZE, NAME_ID, MODIFIED_ID, IGNORED, POSITION = range(5)
+NUM_COLUMNS = 5
+# Tasks per worker process, so that slow size ranges even out
+TASKS_PER_PROCESS = 4
+
+def process_context():
+    """ The multiprocessing context for pools of worker processes. A forked
+        copy of a process that runs other threads (GTK, scans, watchers)
+        can deadlock on a lock one of them held, so workers are started by
+        a fork server where there is one, and spawned elsewhere. """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+def _value_ids(values, ids):
+    """ The integer id of each of values, adding new values to ids (value
+        -> id) as needed. Equal values get equal ids. """
+    new_values = dict.fromkeys(values).keys() - ids.keys()
+    ids.update(zip(new_values, itertools.count(len(ids))))
+    return list(map(ids.__getitem__, values))
+
+class SharedColumns():
+    """ The files of a directory that could match, as columns in shared
+        memory, sorted by size and then by position in file_list order.
+        Built with maps and sorts over whole columns rather than a loop
+        over the files. """
+    def __init__(self, files, name_ids, modified_ids, ignored):
+        """ files: The directory's files (not directories), in file_list
+                   order
+            name_ids, modified_ids: Dictionaries of basename or modification
+                                    time -> integer, shared by every
+                                    directory, added to as needed
+            ignored: Whether each of files is ignored, in the same order """
+        self.files = files
+        self.length = len(files)
+        sizes = list(map(operator.attrgetter("size"), files))
+        # Sorting is stable, so files of one size stay in file_list order
+        rows = sorted(range(self.length), key=sizes.__getitem__)
+        
+        by_row = lambda column: map(column.__getitem__, rows)
+        columns = array.array("q", itertools.chain(
+            by_row(sizes),
+            by_row(_value_ids(list(map(operator.attrgetter("basename"),
+                                       files)), name_ids)),
+            by_row(_value_ids(list(map(operator.attrgetter("modified"),
+                                       files)), modified_ids)),
+            by_row(ignored),
+            rows))
+        # Kept in the parent, for splitting the work by size
+        self.sizes = columns[:self.length].tolist()
+        
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(len(columns) * 8, 8))
+        self.shm.buf[:len(columns) * 8] = columns.tobytes()
+    
+    def rows_of_sizes(self, size_low, size_high):
+        """ (first row, end row) of the files with size_low <= size <
+            size_high """
+        return (bisect.bisect_left(self.sizes, size_low),
+                bisect.bisect_left(self.sizes, size_high))
+    
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+@tracer.traced("match rows", lambda name_1, length_1, rows_1, *args: {
+    "rows": list(rows_1)})
+def _match_rows(name_1, length_1, rows_1, name_2, length_2, rows_2,
+                match_filename, match_modtime):
+    """ Worker: finds the candidate pairs between rows_1 of one directory
+        and rows_2 of another. Returns the (position 1, position 2) pairs as
+        the bytes of an int64 array. """
+    shm_1 = shared_memory.SharedMemory(name=name_1)
+    shm_2 = shared_memory.SharedMemory(name=name_2)
+    columns_1 = shm_1.buf.cast("q")
+    columns_2 = shm_2.buf.cast("q")
+    try:
+        def column(columns, length, index, rows):
+            start = index * length
+            return columns[start + rows[0]:start + rows[1]].tolist()
+        
+        # The same index Directory.find_candidates would use
+        candidates = {}
+        for size, name_id, modified_id, ignored, position in zip(
+                *(column(columns_2, length_2, index, rows_2)
+                  for index in range(NUM_COLUMNS))):
+            if ignored:
+                continue
+            key = (size, name_id) if match_filename else size
+            candidates.setdefault(key, []).append((modified_id, position))
+        
+        pairs = array.array("q")
+        for size, name_id, modified_id, ignored, position in zip(
+                *(column(columns_1, length_1, index, rows_1)
+                  for index in range(NUM_COLUMNS))):
+            if ignored:
+                continue
+            key = (size, name_id) if match_filename else size
+            for modified_id_2, position_2 in candidates.get(key, ()):
+                if not match_modtime or modified_id == modified_id_2:
+                    pairs.append(position)
+                    pairs.append(position_2)
+        return pairs.tobytes()
+    finally:
+        columns_1.release()
+        columns_2.release()
+        shm_1.close()
+        shm_2.close()
+
+def split_sizes(columns, num_tasks):
+    """ Splits the sizes in columns into up to num_tasks disjoint
+        [low, high) ranges with about the same number of files each """
+    ranges = []
+    target = max(columns.length // num_tasks, 1)
+    start = 0
+    while start < columns.length:
+        end = min(start + target, columns.length)
+        # Never split the files of one size
+        end = bisect.bisect_right(columns.sizes, columns.sizes[end - 1])
+        ranges.append((columns.sizes[start], columns.sizes[end - 1] + 1))
+        start = end
+    return ranges
+
+def match_pairs(columns_1, columns_2, match_reqs, executor, num_tasks):
+    """ Yields the candidate pairs of positions (into columns_1.files and
+        columns_2.files) that match on everything but hashes, in the order
+        the serial matcher would find them """
+    futures = []
+    for size_low, size_high in split_sizes(columns_1, num_tasks):
+        rows_2 = columns_2.rows_of_sizes(size_low, size_high)
+        if rows_2[0] == rows_2[1]:
+            continue
+        futures.append(executor.submit(call_traced, tracer.worker_start(),
+            _match_rows,
+            columns_1.shm.name, columns_1.length,
+            columns_1.rows_of_sizes(size_low, size_high),
+            columns_2.shm.name, columns_2.length, rows_2,
+            bool(match_reqs.get("filename")), bool(match_reqs.get("modtime"))))
+    
+    pairs = array.array("q")
+    for future in futures:
+        rows_pairs, spans = future.result()
+        tracer.add_events(spans)
+        pairs.frombytes(rows_pairs)
+    # Serial order: by file of the first directory, then by candidate.
+    # Sorted as single integers, which is much faster than sorting tuples.
+    length_2 = max(columns_2.length, 1)
+    keys = sorted(map(operator.add, map(operator.mul, pairs[0::2],
+                                        itertools.repeat(length_2)),
+                      pairs[1::2]))
+    yield from map(divmod, keys, itertools.repeat(length_2))
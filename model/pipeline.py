@@ -0,0 +1,202 @@
+"""An asyncio scan and hash pipeline for high-latency filesystems (such as SMB
+    or NFS mounts), where each os.stat or open waits on a network round trip.
+    Blocking calls run on a thread pool with many of them in flight at once.
+    The stages (list -> stat -> head hash -> full hash) are connected by
+    bounded queues, so a slow stage holds back the ones before it."""
+
+import os
+import stat
+import asyncio
+import datetime
+import concurrent.futures
+
+from model.directory import File
+from model.ratelimit import limiter
+from model.stats import stats
+
+# Values for hash_mode
+HASH_NONE = None
+HASH_1K = "1k"
+HASH_FULL = "full"
+
+async def _worker(queue, handle):
+    """ Runs handle on every item of queue until cancelled """
+    while True:
+        item = await queue.get()
+        try:
+            await handle(item)
+        except Exception:
+            # Keep the worker alive for the other items, or the queues are
+            # never done
+            stats.count("scan_pipeline_errors")
+        finally:
+            queue.task_done()
+
+class _Pipeline():
+    def __init__(self, directory, update_function, hash_mode, limits,
+                 queue_size):
+        self.directory = directory
+        self.update_function = update_function
+        self.hash_mode = hash_mode
+        self.limits = limits
+        
+        # Directories are never held back, since the stat stage feeds them
+        # and waiting on it from here could deadlock
+        self.list_queue = asyncio.Queue()
+        self.stat_queue = asyncio.Queue(queue_size)
+        self.head_hash_queue = asyncio.Queue(queue_size)
+        self.full_hash_queue = asyncio.Queue(queue_size)
+        
+        self.entries_done = 0
+        self.entries_total = 1
+        
+        # Directories and entries not yet listed or stat'ed. Listing feeds
+        # stat and stat feeds listing, so neither queue alone says when the
+        # scan is over.
+        self.pending = 0
+        self.scanned = asyncio.Event()
+    
+    def finish_pending(self):
+        """ Marks one directory or entry as handled """
+        self.pending -= 1
+        if self.pending == 0:
+            self.scanned.set()
+    
+    async def call(self, function, *args):
+        """ Runs a blocking call on the thread pool """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+    
+    async def list_dir(self, dir_file):
+        try:
+            full_path = self.directory.root_path.joinpath(dir_file.get_path())
+            try:
+                entries = await self.call(_list_dir, full_path)
+            except (FileNotFoundError, PermissionError, NotADirectoryError):
+                return
+            
+            self.entries_total += len(entries)
+            for name, is_dir, is_symlink in entries:
+                self.pending += 1
+                await self.stat_queue.put((dir_file, name, is_dir, is_symlink))
+        finally:
+            self.finish_pending()
+    
+    async def stat_entry(self, item):
+        try:
+            await self._stat_entry(*item)
+        finally:
+            self.finish_pending()
+    
+    async def _stat_entry(self, parent, name, is_dir, is_symlink):
+        full_path = os.path.join(self.directory.root_path.joinpath(
+            parent.get_path()), name)
+        stats.count("stat_calls")
+        try:
+            stat_info = await self.call(limiter.stat, full_path)
+        except (FileNotFoundError, PermissionError):
+            return
+        finally:
+            self.entries_done += 1
+        
+        mdate = datetime.datetime.fromtimestamp(stat_info.st_mtime)
+        # Only this thread adds files, so parents always come first
+        _file = File(path=full_path,
+                     size=-1 if is_dir else stat_info.st_size,
+                     modified=mdate,
+                     isdir=is_dir,
+                     parent=parent)
+        self.directory.add_file(_file)
+        
+        if self.entries_done % 100 == 0 and self.update_function is not None:
+            self.update_function(self.entries_done, self.entries_total,
+                                 full_path)
+        
+        if is_dir:
+            # Like os.walk, don't follow symbolic links to directories
+            if not is_symlink:
+                self.pending += 1
+                self.list_queue.put_nowait(_file)
+        elif self.hash_mode is not None and stat.S_ISREG(stat_info.st_mode):
+            await self.head_hash_queue.put(_file)
+    
+    async def head_hash(self, _file):
+        await self.call(_file.find_hash_1k, self.directory.root_path)
+        if self.hash_mode == HASH_FULL:
+            await self.full_hash_queue.put(_file)
+    
+    async def full_hash(self, _file):
+        await self.call(_file.find_hash_full, self.directory.root_path)
+    
+    async def run(self, root_folder):
+        workers = []
+        for queue, handle, limit in [
+                (self.list_queue, self.list_dir, self.limits["list"]),
+                (self.stat_queue, self.stat_entry, self.limits["stat"]),
+                (self.head_hash_queue, self.head_hash, self.limits["head_hash"]),
+                (self.full_hash_queue, self.full_hash, self.limits["full_hash"])]:
+            workers.extend(asyncio.create_task(_worker(queue, handle))
+                           for _ in range(limit))
+        
+        self.pending = 1
+        self.list_queue.put_nowait(root_folder)
+        
+        # Files are queued for hashing before they count as scanned
+        await self.scanned.wait()
+        await self.head_hash_queue.join()
+        await self.full_hash_queue.join()
+        
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def _list_dir(path):
+    """ Lists a directory as (name, is_dir, is_symlink) tuples """
+    with os.scandir(path) as it:
+        return [(entry.name, entry.is_dir(), entry.is_symlink())
+                for entry in it]
+
+def scan_pipelined(directory, update_function=None, finish_function=None,
+                   hash_mode=HASH_NONE, list_limit=16, stat_limit=256,
+                   head_hash_limit=64, full_hash_limit=16, queue_size=4096):
+    """ Fills an empty Directory like Directory.scan, but with many blocking
+        calls in flight at once. The order of files within a directory may
+        differ from Directory.scan.
+        hash_mode: HASH_1K or HASH_FULL also find those hashes of every file
+        *_limit: Number of calls of each stage in flight at once
+        queue_size: Items waiting between two stages before the earlier
+                    stage has to wait """
+    limits = {
+        "list": list_limit,
+        "stat": stat_limit,
+        "head_hash": head_hash_limit,
+        "full_hash": full_hash_limit
+    }
+    
+    async def main():
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(sum(limits.values()))
+        loop.set_default_executor(executor)
+        
+        root_stat_info = await loop.run_in_executor(None, limiter.stat,
+                                                    directory.root_path)
+        stats.count("stat_calls")
+        root_folder = File(path=".",
+            size=-1,
+            modified=datetime.datetime.fromtimestamp(root_stat_info.st_mtime),
+            isdir=True,
+            parent=None)
+        directory.add_file(root_folder)
+        
+        pipeline = _Pipeline(directory, update_function, hash_mode, limits,
+                             queue_size)
+        await pipeline.run(root_folder)
+    
+    with stats.phase("scan"):
+        asyncio.run(main())
+    
+    if update_function is not None:
+        update_function(1, 1, None)
+    
+    if finish_function is not None:
+        finish_function()
@@ -0,0 +1,58 @@
+"""Progress and events passed from worker threads to whatever shows them.
+    Workers only replace their latest counters and queue events, which costs
+    the same however often they do it, and the reader polls at its own pace
+    (such as once per frame), so showing progress costs the same however
+    fast the workers go."""
+
+import collections
+
+class Progress():
+    """ The latest (done, total, item) of one task, where item is whatever
+        the task is on (only turned into text by the reader). Publishing
+        replaces a single reference, so it needs no lock and a reader never
+        sees half of one update and half of another. """
+    def __init__(self):
+        self.state = None
+        self.finished = False
+        # What the task raised, if it failed
+        self.error = None
+    
+    def publish(self, done, total, item=None):
+        """ Replaces the latest progress; safe to call from any thread """
+        self.state = (done, total, item)
+    
+    def finish(self):
+        """ Marks the task as finished """
+        self.finished = True
+    
+    def fail(self, error):
+        """ Marks the task as finished because it raised error """
+        self.error = error
+        self.finished = True
+    
+    def fraction(self):
+        """ Fraction of the task done so far """
+        state = self.state
+        if state is None or not state[1]:
+            return 0.0
+        return state[0] / state[1]
+
+class EventBus():
+    """ Events (a name and arguments) posted from any thread and delivered
+        in batches """
+    def __init__(self):
+        # deque.append and popleft are atomic, so no lock is needed
+        self._events = collections.deque()
+    
+    def post(self, name, *args):
+        """ Queues an event; safe to call from any thread """
+        self._events.append((name, args))
+    
+    def drain(self):
+        """ Returns every event posted since the last drain, oldest first """
+        events = []
+        while True:
+            try:
+                events.append(self._events.popleft())
+            except IndexError:
+                return events
@@ -0,0 +1,177 @@
+"""Limits how hard scanning and hashing hit the disks, so that comparisons can
+    run on live file servers without starving the services on them."""
+
+import os
+import threading
+import time
+
+class TokenBucket():
+    """ Allows rate units per second on average, with bursts of up to burst
+        units. A rate of None means unlimited. """
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate, burst)
+    
+    def set_rate(self, rate, burst=None):
+        """ Changes the rate; safe to call while other threads wait """
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is not None:
+                # Keep what was earned at the old rate
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            
+            was_unlimited = self.rate is None
+            self.rate = rate
+            # One second's worth by default
+            self.burst = burst if burst is not None else rate
+            if rate is not None:
+                self.tokens = (self.burst if was_unlimited
+                               else min(self.tokens, self.burst))
+    
+    def acquire(self, amount=1):
+        """ Waits until amount units may be used """
+        if self.rate is None:
+            return
+        
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt lets amounts larger than the burst through,
+            # while the wait keeps the average rate
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait > 0:
+            time.sleep(wait)
+
+class IOLimiter():
+    """ A byte rate and an operation rate for all file reads and stat calls.
+        If latency_threshold (seconds) is set, both rates are cut in half
+        whenever a read or stat takes longer than that, and slowly recover
+        once they are fast again. Backing off needs a rate to scale, so it
+        only applies to limits that are set. """
+    # Lowest fraction of the configured rates that backing off goes down to
+    MIN_FACTOR = 1 / 64
+    # How much of the configured rates is recovered after each fast call
+    RECOVERY = 1 / 256
+    
+    def __init__(self):
+        self.bytes = TokenBucket()
+        self.ops = TokenBucket()
+        self.bytes_per_second = None
+        self.ops_per_second = None
+        self.latency_threshold = None
+        self.factor = 1.0
+        # Goes up whenever the limits are set or scaled, for showing them
+        self.limits_version = 0
+        self._lock = threading.Lock()
+        # Factors from request_scale, not yet applied
+        self._requested_scales = []
+    
+    def set_limits(self, bytes_per_second=None, ops_per_second=None,
+                   latency_threshold=None):
+        """ Sets the limits; None means unlimited (or no backing off) """
+        with self._lock:
+            self.bytes_per_second = bytes_per_second
+            self.ops_per_second = ops_per_second
+            self.latency_threshold = latency_threshold
+            self.factor = 1.0
+            self.limits_version += 1
+            self._apply()
+    
+    def _apply(self):
+        """ Sets the bucket rates from the limits and the backoff factor """
+        for bucket, rate in [(self.bytes, self.bytes_per_second),
+                             (self.ops, self.ops_per_second)]:
+            bucket.set_rate(rate * self.factor if rate is not None else None,
+                            rate)
+    
+    def scale_limits(self, factor):
+        """ Multiplies the limits that are set by factor """
+        with self._lock:
+            if self.bytes_per_second is not None:
+                self.bytes_per_second *= factor
+            if self.ops_per_second is not None:
+                self.ops_per_second *= factor
+            self.limits_version += 1
+            self._apply()
+    
+    def request_scale(self, factor):
+        """ Asks for scale_limits(factor), which happens before the next
+            wait or in apply_requested_scales. Takes no lock, so that a
+            signal handler can call it while the thread it interrupted holds
+            one. """
+        self._requested_scales.append(factor)
+    
+    def apply_requested_scales(self):
+        """ Scales the limits by the factors asked for with request_scale """
+        while True:
+            try:
+                factor = self._requested_scales.pop()
+            except IndexError:
+                return
+            self.scale_limits(factor)
+    
+    def shares(self, num_shares):
+        """ Limits (arguments for set_limits) for each of num_shares worker
+            processes, which have limiters of their own, so that together
+            they stay within these limits """
+        with self._lock:
+            split = lambda rate: rate / num_shares if rate is not None else None
+            return (split(self.bytes_per_second), split(self.ops_per_second),
+                    self.latency_threshold)
+    
+    def wait_bytes(self, num_bytes):
+        """ Waits until num_bytes more bytes may be read """
+        if self._requested_scales:
+            self.apply_requested_scales()
+        self.bytes.acquire(num_bytes)
+    
+    def wait_op(self):
+        """ Waits until one more open or stat call may be made """
+        if self._requested_scales:
+            self.apply_requested_scales()
+        self.ops.acquire(1)
+    
+    def record_latency(self, seconds):
+        """ Reports how long a read or stat took, for backing off """
+        if self.latency_threshold is None:
+            return
+        
+        with self._lock:
+            if seconds > self.latency_threshold:
+                factor = max(self.factor / 2, self.MIN_FACTOR)
+            else:
+                factor = min(self.factor + self.RECOVERY, 1.0)
+            if factor != self.factor:
+                self.factor = factor
+                self._apply()
+    
+    def stat(self, path):
+        """ os.stat within the limits """
+        self.wait_op()
+        start = time.perf_counter()
+        stat_info = os.stat(path)
+        self.record_latency(time.perf_counter() - start)
+        return stat_info
+    
+    def read(self, f, num_bytes):
+        """ f.read(num_bytes) within the limits """
+        self.wait_bytes(num_bytes)
+        start = time.perf_counter()
+        data = f.read(num_bytes)
+        self.record_latency(time.perf_counter() - start)
+        return data
+
+# Shared by everything in the process
+limiter = IOLimiter()
@@ -0,0 +1,69 @@
+"""Starts scanning a directory before anything is ready to show it, so that
+    slow startup work (such as loading the GUI toolkit) overlaps with the
+    scan instead of delaying it."""
+
+import threading
+
+from model.directory import Directory
+from model.archive import ArchiveDirectory, is_archive
+from model.agent import AgentDirectory, is_agent_url
+from model.progress import Progress
+
+class ScanJob():
+    """ Scans one directory on a thread of its own, publishing its progress
+        for whoever looks at it later """
+    def __init__(self, directory):
+        self.directory = directory
+        self.progress = Progress()
+    
+    def start(self, scan_function, *args, **kwargs):
+        """ Runs scan_function(*args, update_function, finish_function,
+            **kwargs) on a daemon thread. If it raises, the progress is
+            finished with the error. """
+        thread = threading.Thread(target=self._run,
+                                  args=(scan_function, args, kwargs))
+        thread.daemon = True
+        thread.start()
+    
+    def _run(self, scan_function, args, kwargs):
+        try:
+            scan_function(*args, self.progress.publish, self.progress.finish,
+                          **kwargs)
+        except Exception as e:
+            self.progress.fail(e)
+            raise
+
+def restored_scan(directory):
+    """ A finished ScanJob for a directory that needs no scanning, such as
+        one restored from a session """
+    job = ScanJob(directory)
+    job.progress.finish()
+    return job
+
+def start_scan(path, match_reqs, scan_processes=0, pipeline_options=None):
+    """ Starts scanning path (a directory or archive) the way the options
+        ask for and returns its ScanJob """
+    if is_agent_url(path):
+        # The agent scans on its own machine and sends the whole tree
+        job = ScanJob(AgentDirectory(path))
+        job.start(job.directory.scan)
+    elif is_archive(path):
+        # Hash while streaming through the archive, since its members
+        # cannot be read in any order later on
+        job = ScanJob(ArchiveDirectory(path,
+                                       hash_members=match_reqs.get("hash")))
+        job.start(job.directory.scan)
+    elif pipeline_options is not None:
+        # Many filesystem calls in flight for high-latency mounts. asyncio
+        # takes a while to import, so only when it is needed.
+        from model.pipeline import scan_pipelined
+        job = ScanJob(Directory(path))
+        job.start(scan_pipelined, job.directory, **pipeline_options)
+    elif scan_processes > 0:
+        # Split the scan by top-level subdirectory
+        job = ScanJob(Directory(path))
+        job.start(job.directory.scan_sharded, scan_processes)
+    else:
+        job = ScanJob(Directory(path))
+        job.start(job.directory.scan)
+    return job
@@ -0,0 +1,582 @@
+"""Saves a finished comparison (the scanned trees, the hashes found so far,
+    the match groups and the match requirements) to one binary file, and
+    restores it without scanning, hashing or matching anything again.
+    
+    Each directory is stored as an array of fixed-size records, the
+    children of each directory, its files sorted by size, a table of names
+    and an array of hashes. The file is memory-mapped, and a restored
+    directory only makes a File of a record when something looks it up,
+    such as the contents of the directory on screen or the files of a
+    size. A restored session can then be brought up to date with
+    changed_paths and Matcher.refresh_paths, which only rematch what
+    changed."""
+
+import bisect
+import collections.abc
+import datetime
+import json
+import mmap
+import os
+import stat
+import struct
+import threading
+
+from pathlib import PurePath
+
+from model.directory import Directory, File, FileList
+from model.matcher import Matcher
+from model.ratelimit import limiter
+from model.stats import stats
+
+MAGIC = b"AHSESS\0\0"
+VERSION = 2
+
+# Magic, version, number of directories, offset and length of the JSON
+# metadata
+_HEADER = struct.Struct("<8sIIQQ")
+# Parent index (-1 for the root), size, modified (microseconds since 1970),
+# name offset, hash slot (-1 for none), match group (-1 for none),
+# to_match, to_match_total, first child in the children array, name
+# length, flags, number of children
+_RECORD = struct.Struct("<9q3I4x")
+# (size, record index) of every file that is not a directory, sorted, so
+# that the files of a size are found without reading the others
+_SIZE_ENTRY = struct.Struct("<qq")
+# The 1KiB hash and then the full hash of a file, zeros where missing
+HASH_SIZE = 32
+_HASH_SLOT = 2 * HASH_SIZE
+
+# Record flags
+ISDIR = 1
+MATCHED = 2
+HAS_HASH_1K = 4
+HAS_HASH_FULL = 8
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_NO_HASH = bytes(HASH_SIZE)
+
+class SnapshotDirectory(Directory):
+    """ A restored directory whose files are not on this machine's
+        filesystem (it was an archive or an agent's tree), so it can be
+        looked at but not refreshed, copied into or watched """
+    local = False
+
+def _align(f):
+    """ Pads the file to a multiple of 8 bytes, so that arrays start
+        aligned """
+    f.write(bytes(-f.tell() % 8))
+    return f.tell()
+
+def _pack_ints(values):
+    """ values as an array of 64 bit integers """
+    return struct.pack("<{}q".format(len(values)), *values)
+
+def _pack_directory(dir_, dir_index, match_dict, group_ids, groups,
+                    locations):
+    """ Returns the (records, children, sizes, names, hashes) of a
+        directory. Match groups it has files in are numbered in group_ids
+        and added to groups, and where their files are saved is noted in
+        locations. """
+    indexes = {file_: index for index, file_ in enumerate(dir_.file_list)}
+    dir_paths = {file_: path for path, file_
+                 in dir_.directory_map_file.items()}
+    records = bytearray(_RECORD.size * len(indexes))
+    children = []
+    sizes = []
+    names = bytearray()
+    hashes = bytearray()
+    for index, file_ in enumerate(dir_.file_list):
+        name = os.fsencode(file_.basename)
+        flags = (ISDIR if file_.isdir else 0) | (MATCHED if file_.matched else 0)
+        
+        hash_slot = -1
+        if file_.hash_1k is not None or file_.hash_full is not None:
+            hash_slot = len(hashes) // _HASH_SLOT
+            if file_.hash_1k is not None:
+                flags |= HAS_HASH_1K
+            if file_.hash_full is not None:
+                flags |= HAS_HASH_FULL
+            hashes += file_.hash_1k or _NO_HASH
+            hashes += file_.hash_full or _NO_HASH
+        
+        group = match_dict.get(file_)
+        group_id = -1
+        if group is not None:
+            if id(group) not in group_ids:
+                group_ids[id(group)] = len(groups)
+                groups.append(group)
+            group_id = group_ids[id(group)]
+            locations[file_] = (dir_index, index)
+        
+        # The children of a directory are saved next to each other
+        children_start = len(children)
+        if file_.isdir:
+            children.extend(indexes[child]
+                            for child in dir_.directory_map[dir_paths[file_]])
+        else:
+            sizes.append((file_.size, index))
+        
+        # Parents always come before their children in file_list
+        _RECORD.pack_into(records, index * _RECORD.size,
+            indexes[file_.parent_dir] if file_.parent_dir is not None else -1,
+            file_.size,
+            (file_.modified - _EPOCH) // datetime.timedelta(microseconds=1),
+            len(names), hash_slot, group_id, file_.to_match,
+            file_.to_match_total, children_start, len(name), flags,
+            len(children) - children_start)
+        names += name
+    
+    sizes.sort()
+    return (records, _pack_ints(children),
+            _pack_ints([value for entry in sizes for value in entry]),
+            names, hashes)
+
+def save_session(path, matcher):
+    """ Saves the directories of matcher, their match groups and the match
+        requirements to path. The file is replaced at once, so a session
+        that was there stays readable until the new one is complete. """
+    with stats.phase("save session"):
+        # Match group list -> its number, the groups in that order, and
+        # file -> (directory index, record index)
+        group_ids = {}
+        groups = []
+        locations = {}
+        dirs_meta = []
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "wb") as f:
+            f.write(bytes(_HEADER.size))
+            for dir_index, dir_ in enumerate(matcher.dirs):
+                records, children, sizes, names, hashes = _pack_directory(
+                    dir_, dir_index, matcher.match_dict, group_ids, groups,
+                    locations)
+                dir_meta = {
+                    "root": str(dir_.root_path),
+                    "local": dir_.local,
+                    "num_files": len(dir_.file_list),
+                    "records": _align(f)
+                }
+                f.write(records)
+                dir_meta["children"] = _align(f)
+                f.write(children)
+                dir_meta["sizes"] = _align(f)
+                dir_meta["num_sizes"] = len(sizes) // _SIZE_ENTRY.size
+                f.write(sizes)
+                dir_meta["hashes"] = _align(f)
+                f.write(hashes)
+                dir_meta["names"] = _align(f)
+                dir_meta["names_length"] = len(names)
+                f.write(names)
+                dirs_meta.append(dir_meta)
+            
+            # The (directory index, record index) of the files of every
+            # group in the group's order, and where each group starts
+            group_starts = [0]
+            members = []
+            for group in groups:
+                for file_ in group:
+                    members.extend(locations[file_])
+                group_starts.append(len(members) // 2)
+            groups_meta = {"starts": _align(f)}
+            f.write(_pack_ints(group_starts))
+            groups_meta["members"] = _align(f)
+            f.write(_pack_ints(members))
+            
+            meta = json.dumps({"match_reqs": matcher.match_reqs,
+                               "dirs": dirs_meta,
+                               "groups": groups_meta}).encode("utf-8")
+            meta_offset = _align(f)
+            f.write(meta)
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, VERSION, len(dirs_meta), meta_offset,
+                                 len(meta)))
+        os.replace(temp_path, path)
+
+class _SavedSizes():
+    """ The sorted sizes of a directory's files, read from the session
+        file when indexed, for bisect """
+    def __init__(self, session_map, offset, length):
+        self._map = session_map
+        self._offset = offset
+        self._length = length
+    
+    def __len__(self):
+        return self._length
+    
+    def __getitem__(self, position):
+        return _SIZE_ENTRY.unpack_from(
+            self._map, self._offset + position * _SIZE_ENTRY.size)[0]
+    
+    def record_index(self, position):
+        return _SIZE_ENTRY.unpack_from(
+            self._map, self._offset + position * _SIZE_ENTRY.size)[1]
+
+class _Records():
+    """ The saved records of one directory. A record becomes a File the
+        first time something asks for it, and only once, so that every
+        lookup structure and match group shares the same File. """
+    def __init__(self, session, dir_meta):
+        self.session = session
+        self.num_files = dir_meta["num_files"]
+        self._map = session._map
+        self._records = dir_meta["records"]
+        self._children = dir_meta["children"]
+        self._hashes = dir_meta["hashes"]
+        self._names = dir_meta["names"]
+        self.sizes = _SavedSizes(self._map, dir_meta["sizes"],
+                                 dir_meta["num_sizes"])
+        self._files = [None] * self.num_files
+        
+        # Relative path -> record index, of the directories found so far.
+        # The root comes first.
+        self._dir_indexes = {}
+        if self.num_files and self._record(0)[10] & ISDIR:
+            self._dir_indexes[PurePath(self._name(self._record(0)))] = 0
+    
+    def _record(self, index):
+        return _RECORD.unpack_from(self._map,
+                                   self._records + index * _RECORD.size)
+    
+    def _name(self, record):
+        start = self._names + record[3]
+        return os.fsdecode(self._map[start:start + record[9]])
+    
+    def child_indexes(self, index):
+        """ Record indexes of the children of the directory at index """
+        record = self._record(index)
+        return struct.unpack_from("<{}q".format(record[11]), self._map,
+                                  self._children + record[8] * 8)
+    
+    def file(self, index):
+        """ The File of the record at index """
+        file_ = self._files[index]
+        if file_ is None:
+            with self.session.lock:
+                file_ = self._files[index]
+                if file_ is None:
+                    file_ = self._make_file(index)
+        return file_
+    
+    def _make_file(self, index):
+        (parent_index, size, modified, _, hash_slot, group_id, to_match,
+         to_match_total, _, _, flags, _) = record = self._record(index)
+        parent = self.file(parent_index) if parent_index >= 0 else None
+        file_ = File(self._name(record), size,
+                     _EPOCH + datetime.timedelta(microseconds=modified),
+                     bool(flags & ISDIR), parent)
+        file_.matched = bool(flags & MATCHED)
+        file_.to_match = to_match
+        file_.to_match_total = to_match_total
+        
+        if hash_slot >= 0:
+            start = self._hashes + hash_slot * _HASH_SLOT
+            if flags & HAS_HASH_1K:
+                file_.hash_1k = self._map[start:start + HASH_SIZE]
+            if flags & HAS_HASH_FULL:
+                file_.hash_full = self._map[start + HASH_SIZE:
+                                            start + _HASH_SLOT]
+        
+        self._files[index] = file_
+        stats.count("session_files_loaded")
+        if group_id >= 0:
+            self.session._load_group(group_id)
+        return file_
+    
+    def dir_index(self, rel_path):
+        """ Record index of the directory at rel_path, or None """
+        rel_path = PurePath(rel_path)
+        index = self._dir_indexes.get(rel_path)
+        if index is not None or rel_path.parent == rel_path:
+            return index
+        
+        parent_index = self.dir_index(rel_path.parent)
+        if parent_index is None:
+            return None
+        for child_index in self.child_indexes(parent_index):
+            record = self._record(child_index)
+            if record[10] & ISDIR and self._name(record) == rel_path.name:
+                self._dir_indexes[rel_path] = child_index
+                return child_index
+        return None
+    
+    def dir_file(self, rel_path):
+        """ directory_map_file[rel_path] """
+        index = self.dir_index(rel_path)
+        if index is None:
+            raise KeyError(rel_path)
+        return self.file(index)
+    
+    def dir_children(self, rel_path):
+        """ directory_map[rel_path] """
+        index = self.dir_index(rel_path)
+        if index is None:
+            raise KeyError(rel_path)
+        return [self.file(child_index)
+                for child_index in self.child_indexes(index)]
+    
+    def files_of_size(self, size):
+        """ size_map[size] """
+        start = bisect.bisect_left(self.sizes, size)
+        end = bisect.bisect_right(self.sizes, size)
+        if start == end:
+            raise KeyError(size)
+        return [self.file(self.sizes.record_index(position))
+                for position in range(start, end)]
+    
+    def all_dirs(self):
+        """ Yields the (relative path, record index) of every directory """
+        paths = {}
+        for index in range(self.num_files):
+            record = self._record(index)
+            if record[10] & ISDIR:
+                name = self._name(record)
+                paths[index] = (PurePath(name) if record[0] < 0
+                                else paths[record[0]].joinpath(name))
+                yield paths[index], index
+    
+    def all_sizes(self):
+        """ Yields every (size, size_map[size]) """
+        size = files = None
+        for position in range(len(self.sizes)):
+            if self.sizes[position] != size:
+                if files is not None:
+                    yield size, files
+                size = self.sizes[position]
+                files = []
+            files.append(self.file(self.sizes.record_index(position)))
+        if files is not None:
+            yield size, files
+
+class _LazyMap(collections.abc.MutableMapping):
+    """ A dict of a restored directory whose entries are made from the
+        saved records the first time they are looked up. Going through all
+        of them, or changing the map, makes all of them first. """
+    def __init__(self, lock, find, find_all):
+        """ find: Makes the value of a key, raising KeyError if there is none
+            find_all: Yields every (key, value) """
+        self._entries = {}
+        self._complete = False
+        self._lock = lock
+        self._find = find
+        self._find_all = find_all
+    
+    def __getitem__(self, key):
+        if not self._complete and key not in self._entries:
+            with self._lock:
+                if not self._complete and key not in self._entries:
+                    self._entries[key] = self._find(key)
+        return self._entries[key]
+    
+    def _complete_entries(self):
+        if not self._complete:
+            with self._lock:
+                if not self._complete:
+                    for key, value in self._find_all():
+                        self._entries.setdefault(key, value)
+                    self._complete = True
+    
+    def __setitem__(self, key, value):
+        self._complete_entries()
+        self._entries[key] = value
+    
+    def __delitem__(self, key):
+        self._complete_entries()
+        del self._entries[key]
+    
+    def __iter__(self):
+        self._complete_entries()
+        return iter(self._entries)
+    
+    def __len__(self):
+        self._complete_entries()
+        return len(self._entries)
+
+class _LazyFileList(FileList):
+    """ file_list of a restored directory. Its length is known from the
+        records; anything else makes every File first. """
+    def __init__(self, records):
+        self._records = records
+        self._loaded_files = None
+    
+    @property
+    def _files(self):
+        if self._loaded_files is None:
+            with self._records.session.lock:
+                if self._loaded_files is None:
+                    self._loaded_files = dict.fromkeys(
+                        self._records.file(index)
+                        for index in range(self._records.num_files))
+        return self._loaded_files
+    
+    def __len__(self):
+        if self._loaded_files is None:
+            return self._records.num_files
+        return len(self._loaded_files)
+
+class Session():
+    """ A saved session, memory-mapped. The files of a directory are made
+        from their records as they are looked up, so restoring costs
+        nothing up front. """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped
+                raise ValueError("Not a session file: {}".format(path))
+        
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError("Not a session file: {}".format(path))
+        magic, version, num_dirs, meta_offset, meta_length = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a session file of version {}: {}".format(
+                VERSION, path))
+        meta = json.loads(self._map[meta_offset:meta_offset + meta_length]
+                          .decode("utf-8"))
+        self.match_reqs = meta["match_reqs"]
+        self._dirs_meta = meta["dirs"]
+        self._groups_meta = meta["groups"]
+        self.root_paths = [PurePath(dir_meta["root"])
+                           for dir_meta in self._dirs_meta]
+        
+        self._dirs = [None] * num_dirs
+        self._records = [None] * num_dirs
+        # Held while records become Files, which can happen from any thread
+        self.lock = threading.RLock()
+        # Filled in with the saved match groups as their files are made
+        self.match_dict = {}
+        self._groups_loaded = set()
+    
+    def directory(self, dir_index):
+        """ Returns the restored Directory """
+        if self._dirs[dir_index] is None:
+            with self.lock:
+                if self._dirs[dir_index] is None:
+                    self._dirs[dir_index] = self._restore_directory(dir_index)
+        return self._dirs[dir_index]
+    
+    def _restore_directory(self, dir_index):
+        dir_meta = self._dirs_meta[dir_index]
+        if dir_meta["local"]:
+            dir_ = Directory(dir_meta["root"])
+        else:
+            dir_ = SnapshotDirectory(dir_meta["root"])
+        records = _Records(self, dir_meta)
+        self._records[dir_index] = records
+        
+        def find_all_dir_files():
+            for rel_path, index in records.all_dirs():
+                yield rel_path, records.file(index)
+        
+        def find_all_dir_children():
+            for rel_path, index in records.all_dirs():
+                yield rel_path, records.dir_children(rel_path)
+        
+        dir_.file_list = _LazyFileList(records)
+        dir_.directory_map_file = _LazyMap(self.lock, records.dir_file,
+                                           find_all_dir_files)
+        dir_.directory_map = _LazyMap(self.lock, records.dir_children,
+                                      find_all_dir_children)
+        dir_.size_map = _LazyMap(self.lock, records.files_of_size,
+                                 records.all_sizes)
+        return dir_
+    
+    def _load_group(self, group_id):
+        """ Makes the files of a saved match group and adds it to
+            match_dict """
+        with self.lock:
+            if group_id in self._groups_loaded:
+                return
+            self._groups_loaded.add(group_id)
+            start, end = struct.unpack_from(
+                "<2q", self._map, self._groups_meta["starts"] + group_id * 8)
+            locations = struct.unpack_from(
+                "<{}q".format(2 * (end - start)), self._map,
+                self._groups_meta["members"] + start * 16)
+            group = []
+            for position in range(0, len(locations), 2):
+                dir_index, index = locations[position:position + 2]
+                self.directory(dir_index)
+                group.append(self._records[dir_index].file(index))
+            for file_ in group:
+                self.match_dict[file_] = group
+    
+    def matcher(self, processes=0, match_options=None):
+        """ Returns a Matcher with the saved match groups, as if
+            find_duplicates had just run
+            processes, match_options: As for load_session """
+        matcher = Matcher([self.directory(dir_index)
+                           for dir_index in range(len(self._dirs))],
+                          self.match_reqs, processes, **(match_options or {}))
+        matcher.match_dict = self.match_dict
+        return matcher
+    
+    def close(self):
+        """ Unmaps the file. Restored directories read from it as they are
+            used, so only close it once they are no longer needed. """
+        self._map.close()
+
+def load_session(path, processes=0, match_options=None):
+    """ Restores a saved session and returns its Matcher. The session file
+        stays mapped for as long as the restored directories are in use.
+        processes: Worker processes for matching (see Matcher)
+        match_options: Other keyword arguments for the Matcher, such as
+                       small_file_size """
+    return Session(path).matcher(processes, match_options)
+
+def changed_paths(dir_):
+    """ Returns the paths (relative to the root path) that were added,
+        removed or changed on the filesystem since dir_ was scanned, to be
+        given to Matcher.refresh_paths. Every directory is listed and every
+        entry stat'ed, but nothing is read or hashed. Symbolic links are
+        treated as Directory.scan treats them: links to files and
+        directories are followed for their stat, but the contents of a
+        linked directory are not listed, and broken links are left out. """
+    changed = set()
+    with stats.phase("refresh"):
+        for rel_path, children in list(dir_.directory_map.items()):
+            full_path = dir_.root_path.joinpath(rel_path)
+            if rel_path != dir_.shard_path:
+                # The scan does not descend into linked directories (os.walk
+                # does not follow links below the root)
+                stats.count("stat_calls")
+                if os.path.islink(full_path):
+                    continue
+            try:
+                names = set(os.listdir(full_path))
+            except (FileNotFoundError, PermissionError, NotADirectoryError):
+                # Gone; its parent reports it, unless it is the root
+                continue
+            
+            for file_ in children:
+                if file_.basename not in names:
+                    changed.add(rel_path.joinpath(file_.basename))
+                    continue
+                names.discard(file_.basename)
+                
+                stats.count("stat_calls")
+                try:
+                    stat_info = limiter.stat(full_path.joinpath(file_.basename))
+                except (FileNotFoundError, PermissionError):
+                    changed.add(rel_path.joinpath(file_.basename))
+                    continue
+                if stat.S_ISDIR(stat_info.st_mode) != file_.isdir:
+                    changed.add(rel_path.joinpath(file_.basename))
+                elif not file_.isdir and (
+                        stat_info.st_size != file_.size or
+                        datetime.datetime.fromtimestamp(stat_info.st_mtime)
+                        != file_.modified):
+                    changed.add(rel_path.joinpath(file_.basename))
+            
+            # New entries, unless the scan would skip them too
+            for name in names:
+                stats.count("stat_calls")
+                try:
+                    limiter.stat(full_path.joinpath(name))
+                except (FileNotFoundError, PermissionError):
+                    continue
+                changed.add(rel_path.joinpath(name))
+    return changed
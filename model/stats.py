@@ -0,0 +1,57 @@
+"""Counters and timers that show where the time of a run goes."""
+
+import contextlib
+import threading
+import time
+
+from model.trace import tracer
+
+class Stats():
+    """ A thread-safe set of named counters and phase timers """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """ Sets every counter and timer back to zero """
+        with self._lock:
+            self.counters = {}
+            # Phase name -> {"wall_seconds", "cpu_seconds", "count"}
+            self.phases = {}
+    
+    def count(self, name, amount=1):
+        """ Adds amount to the counter called name """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Times the code inside the with block as part of the phase called
+            name. Phases that run in several threads at once add up. """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            with tracer.span(name):
+                yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            with self._lock:
+                phase = self.phases.setdefault(name, {"wall_seconds": 0.0,
+                                                      "cpu_seconds": 0.0,
+                                                      "count": 0})
+                phase["wall_seconds"] += wall
+                phase["cpu_seconds"] += cpu
+                phase["count"] += 1
+    
+    def snapshot(self):
+        """ Returns a copy of everything, suitable for JSON """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "phases": {name: dict(phase)
+                           for name, phase in self.phases.items()}
+            }
+
+# Shared by everything in the process
+stats = Stats()
@@ -0,0 +1,278 @@
+"""A compact summary of a reference root, for asking whether the files of
+    another folder are already in it without holding the reference root in
+    memory. The summary is built once and saved: a Bloom filter over the
+    match key of every file answers most lookups, and a table of keys
+    sorted on disk confirms the positives and gives the matching paths.
+    Building and checking both stream over the scan like external_match,
+    so neither needs memory in proportion to the reference root."""
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from pathlib import PurePath
+
+from model.directory import File
+from model.external import scan_records, write_runs, sorted_records
+from model.stats import stats
+
+MAGIC = b"AHSUMM\0\0"
+VERSION = 1
+
+# Magic, version, number of bit positions per key, bits in the filter,
+# bits in the prefilter (0 for none), number of entries, offset and length
+# of the JSON metadata
+_HEADER = struct.Struct("<8sIIQQQQQ")
+# Key digest, size, mtime, path offset, path length
+_ENTRY = struct.Struct("<16sqdQI4x")
+DIGEST_SIZE = 16
+
+def key_digest(match_reqs, size, basename, mtime, full_hash=None):
+    """ Digest of the match key of a file: its size and whichever of
+        modification time, full hash and name match_reqs requires. Files
+        can only match if their digests are equal. """
+    key = struct.pack("<q", size)
+    if match_reqs.get("modtime"):
+        key += struct.pack("<d", mtime)
+    if full_hash is not None:
+        key += full_hash
+    if match_reqs.get("filename"):
+        key += os.fsencode(basename)
+    return hashlib.blake2b(key, digest_size=DIGEST_SIZE).digest()
+
+def bloom_positions(digest, num_bits, num_hashes):
+    """ The bits a digest sets in a Bloom filter, by double hashing """
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+def bloom_size(num_keys, error_rate):
+    """ Returns (bits, positions per key) of a Bloom filter holding
+        num_keys keys with about error_rate false positives """
+    num_bits = max(int(-num_keys * math.log(error_rate) / math.log(2) ** 2),
+                   64)
+    num_hashes = max(int(round(num_bits / max(num_keys, 1) * math.log(2))), 1)
+    return num_bits, num_hashes
+
+def _full_hash(root_path, size, basename, mtime, rel_path):
+    """ The full hash of a file from a scan record, or None if it could not
+        be read """
+    file_ = File(rel_path, size, mtime, False)
+    return file_.find_hash_full(
+        PurePath(root_path).joinpath(PurePath(rel_path).parent))
+
+def _keyed_records(root_path, match_reqs):
+    """ Scan records of root_path with the digest of their match key added
+        at the end """
+    for size, basename, mtime, rel_path in scan_records(root_path, match_reqs):
+        full_hash = None
+        if match_reqs.get("hash"):
+            full_hash = _full_hash(root_path, size, basename, mtime, rel_path)
+            if full_hash is None:
+                continue
+        yield (size, basename, mtime, rel_path,
+               key_digest(match_reqs, size, basename, mtime, full_hash))
+
+def build_summary(root_path, summary_path, match_reqs, error_rate=0.01,
+                  memory_limit=256 * 2 ** 20, tmp_dir=None):
+    """ Scans root_path and saves a summary of it to summary_path.
+        error_rate: Fraction of lookups of files that are not in root_path
+                    which the filter lets through to the sorted table
+        memory_limit, tmp_dir: As for external_match, for sorting the keys
+        Returns the number of files in the summary. """
+    with stats.phase("build summary"), \
+         tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        num_entries = 0
+        def counted(records):
+            nonlocal num_entries
+            for record in records:
+                num_entries += 1
+                yield record
+        
+        key = lambda record: record[4]
+        run_paths = write_runs(counted(_keyed_records(root_path, match_reqs)),
+                               key, run_dir, memory_limit)
+        
+        num_bits, num_hashes = bloom_size(num_entries, error_rate)
+        bits = bytearray((num_bits + 7) // 8)
+        # With hashes in the key, a second filter on the key without the
+        # hash spares hashing files that cannot be in the reference root
+        prefilter_bits = 0
+        if match_reqs.get("hash"):
+            prefilter_bits = num_bits
+        prefilter = bytearray((prefilter_bits + 7) // 8)
+        
+        entries_offset = _HEADER.size + len(bits) + len(prefilter)
+        entries_offset += -entries_offset % 8
+        temp_path = "{}.tmp".format(summary_path)
+        # Paths go after every entry, so they wait in a file of their own
+        with open(temp_path, "wb") as f, \
+             open(os.path.join(run_dir, "paths"), "w+b") as paths:
+            f.seek(entries_offset)
+            for size, basename, mtime, rel_path, digest in sorted_records(
+                    run_paths, key):
+                for position in bloom_positions(digest, num_bits, num_hashes):
+                    bits[position >> 3] |= 1 << (position & 7)
+                if prefilter_bits:
+                    for position in bloom_positions(
+                            key_digest(match_reqs, size, basename, mtime),
+                            prefilter_bits, num_hashes):
+                        prefilter[position >> 3] |= 1 << (position & 7)
+                
+                path = os.fsencode(rel_path)
+                f.write(_ENTRY.pack(digest, size, mtime, paths.tell(),
+                                    len(path)))
+                paths.write(path)
+            
+            paths.seek(0)
+            shutil.copyfileobj(paths, f)
+            meta = json.dumps({"root": str(root_path),
+                               "match_reqs": match_reqs}).encode("utf-8")
+            meta_offset = f.tell()
+            f.write(meta)
+            
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, VERSION, num_hashes, num_bits,
+                                 prefilter_bits, num_entries, meta_offset,
+                                 len(meta)))
+            f.write(bits)
+            f.write(prefilter)
+        os.replace(temp_path, summary_path)
+    stats.count("summary_entries", num_entries)
+    return num_entries
+
+class Summary():
+    """ A saved summary, memory-mapped, so that only the pages lookups touch
+        are read """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped
+            self._file.close()
+            raise ValueError("Not a summary file: {}".format(path))
+        
+        if len(self._map) < _HEADER.size:
+            self.close()
+            raise ValueError("Not a summary file: {}".format(path))
+        (magic, version, self.num_hashes, self.num_bits, self.prefilter_bits,
+         self.num_entries, meta_offset, meta_length) = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a summary file of version {}: {}".format(
+                VERSION, path))
+        meta = json.loads(self._map[meta_offset:meta_offset + meta_length]
+                          .decode("utf-8"))
+        self.root_path = PurePath(meta["root"])
+        self.match_reqs = meta["match_reqs"]
+        
+        self._bits_offset = _HEADER.size
+        self._prefilter_offset = self._bits_offset + (self.num_bits + 7) // 8
+        self._entries_offset = (self._prefilter_offset
+                                + (self.prefilter_bits + 7) // 8)
+        self._entries_offset += -self._entries_offset % 8
+        self._paths_offset = (self._entries_offset
+                              + self.num_entries * _ENTRY.size)
+    
+    def _bits_set(self, offset, num_bits, digest):
+        for position in bloom_positions(digest, num_bits, self.num_hashes):
+            if not self._map[offset + (position >> 3)] >> (position & 7) & 1:
+                return False
+        return True
+    
+    def might_contain(self, digest):
+        """ Returns False if no file has this key digest, and True if one
+            probably has """
+        return self._bits_set(self._bits_offset, self.num_bits, digest)
+    
+    def might_contain_unhashed(self, digest):
+        """ Like might_contain, for the digest of a key without the hash.
+            Always True if the summary has no such filter. """
+        if not self.prefilter_bits:
+            return True
+        return self._bits_set(self._prefilter_offset, self.prefilter_bits,
+                              digest)
+    
+    def _entry(self, index):
+        return _ENTRY.unpack_from(self._map,
+                                  self._entries_offset + index * _ENTRY.size)
+    
+    def lookup(self, digest):
+        """ Returns the (size, mtime, rel_path) of every file with this key
+            digest, by binary search in the sorted table """
+        low, high = 0, self.num_entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        stats.count("summary_lookups")
+        
+        found = []
+        for index in range(low, self.num_entries):
+            entry_digest, size, mtime, path_offset, path_length = \
+                self._entry(index)
+            if entry_digest != digest:
+                break
+            start = self._paths_offset + path_offset
+            found.append((size, mtime,
+                          os.fsdecode(self._map[start:start + path_length])))
+        return found
+    
+    def find_matches(self, size, basename, mtime, full_hash=None):
+        """ Returns the relative paths of the files in the summary that
+            match a file, checking everything the match requirements ask for
+            except the hash, which only the digest carries """
+        digest = key_digest(self.match_reqs, size, basename, mtime, full_hash)
+        if not self.might_contain(digest):
+            stats.count("summary_filter_negatives")
+            return []
+        matches = [rel_path for entry_size, entry_mtime, rel_path
+                   in self.lookup(digest)
+                   if entry_size == size
+                   and (not self.match_reqs.get("modtime")
+                        or entry_mtime == mtime)
+                   and (not self.match_reqs.get("filename")
+                        or os.path.basename(rel_path) == basename)]
+        if not matches:
+            stats.count("summary_false_positives")
+        return matches
+    
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+def check_summary(summary, root_path):
+    """ Checks every file below root_path against a summary, with the
+        summary's match requirements. Yields (rel_path, matching relative
+        paths in the summarized root), with an empty list for files that
+        are not there. """
+    match_reqs = summary.match_reqs
+    with stats.phase("check summary"):
+        for size, basename, mtime, rel_path in scan_records(root_path,
+                                                            match_reqs):
+            full_hash = None
+            if match_reqs.get("hash"):
+                # Only read files whose size (and name) is in the summary
+                if not summary.might_contain_unhashed(
+                        key_digest(match_reqs, size, basename, mtime)):
+                    stats.count("summary_filter_negatives")
+                    yield rel_path, []
+                    continue
+                full_hash = _full_hash(root_path, size, basename, mtime,
+                                       rel_path)
+                if full_hash is None:
+                    yield rel_path, []
+                    continue
+            yield rel_path, summary.find_matches(size, basename, mtime,
+                                                 full_hash)
@@ -0,0 +1,194 @@
+"""Copies the files that were not matched from one directory into another."""
+
+import os
+import shutil
+import concurrent.futures
+
+from pathlib import PurePath
+
+from model.directory import File
+from model.ratelimit import TokenBucket
+from model.stats import stats
+
+# Results of copying a single file
+COPIED = "copied"
+EXISTS = "exists"
+CHANGED = "changed"
+FAILED = "failed"
+VERIFY_FAILED = "verify failed"
+
+def _remove_copy(target_path):
+    """ Removes a copy that failed, if it is still there """
+    try:
+        os.remove(target_path)
+    except OSError:
+        stats.count("copy_cleanup_errors")
+
+def _root_file(file_):
+    """ The File of the root of the directory structure file_ is in """
+    while file_.parent_dir is not None:
+        file_ = file_.parent_dir
+    return file_
+
+def plan_copies(source_dir, target_dir, matcher):
+    """ Returns a copy plan for every file in source_dir that has no match in
+        target_dir, as a list of (File, source path, target path). Files
+        that only match files of some other directory are copied too.
+        Files keep their path relative to the root. Ignored files are not
+        copied. A source directory that is not on the local filesystem
+        (an archive or an agent's tree) cannot be copied from, so nothing
+        is planned for it. """
+    if not source_dir.local:
+        return []
+    
+    target_root_file = target_dir.directory_map_file.get(PurePath("."))
+    plan = []
+    for file_ in source_dir.file_list:
+        if file_.isdir or matcher.ignore_file(file_):
+            continue
+        if any(_root_file(match) is target_root_file
+               for match in matcher.match_dict.get(file_, [])):
+            continue
+        rel_path = file_.get_path()
+        plan.append((file_, source_dir.root_path.joinpath(rel_path),
+                     target_dir.root_path.joinpath(rel_path)))
+    return plan
+
+class Copier():
+    """ Runs a copy plan with several threads. Data is copied inside the
+        kernel when possible (copy_file_range, then sendfile), and copies are
+        verified with the hashes that matching already found. """
+    def __init__(self, workers=4, bandwidth_limit=None, chunk_size=2 ** 20):
+        """ workers: Number of files copied at the same time
+            bandwidth_limit: Total bytes per second for all workers, or None
+            chunk_size: Bytes copied by a single system call """
+        self.workers = workers
+        self.bandwidth_limit = bandwidth_limit
+        self.chunk_size = chunk_size
+        self._bucket = TokenBucket(bandwidth_limit or None)
+    
+    def _throttle(self, num_bytes):
+        """ Waits until num_bytes more bytes fit within the bandwidth limit """
+        self._bucket.acquire(num_bytes)
+    
+    def _copy_data(self, src_fd, dst_fd, size):
+        """ Copies size bytes, falling back to slower methods when the
+            kernel or filesystem does not support the faster ones """
+        use_copy_file_range = hasattr(os, "copy_file_range")
+        use_sendfile = hasattr(os, "sendfile")
+        offset = 0
+        while offset < size:
+            num_bytes = min(self.chunk_size, size - offset)
+            self._throttle(num_bytes)
+            
+            copied = None
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, num_bytes,
+                                                offset, offset)
+                except OSError:
+                    use_copy_file_range = False
+            if copied is None and use_sendfile:
+                try:
+                    os.lseek(dst_fd, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, offset, num_bytes)
+                except OSError:
+                    use_sendfile = False
+            if copied is None:
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.write(dst_fd, os.read(src_fd, num_bytes))
+            
+            if copied == 0:
+                # The source file shrank
+                break
+            offset += copied
+        
+        return offset
+    
+    def copy_file(self, file_, source_path, target_path):
+        """ Copies one file from the plan and returns the result """
+        try:
+            src_fd = os.open(source_path, os.O_RDONLY)
+        except OSError:
+            return FAILED
+        
+        try:
+            if os.fstat(src_fd).st_size != file_.size:
+                # Modified since the scan, so the match results are stale
+                return CHANGED
+            
+            os.makedirs(target_path.parent, exist_ok=True)
+            try:
+                # Never overwrite a file that appeared while copying
+                dst_fd = os.open(target_path,
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                return EXISTS
+            
+            try:
+                copied = self._copy_data(src_fd, dst_fd, file_.size)
+            except OSError:
+                # Don't leave a partial copy behind
+                _remove_copy(target_path)
+                stats.count("copy_errors")
+                return FAILED
+            finally:
+                os.close(dst_fd)
+        except OSError:
+            stats.count("copy_errors")
+            return FAILED
+        finally:
+            os.close(src_fd)
+        
+        try:
+            verified = copied == file_.size and self.verify(file_, target_path)
+        except OSError:
+            # Such as the copy vanishing before it was checked
+            _remove_copy(target_path)
+            stats.count("copy_errors")
+            return FAILED
+        if not verified:
+            _remove_copy(target_path)
+            return VERIFY_FAILED
+        
+        try:
+            shutil.copystat(source_path, target_path)
+        except OSError:
+            # Some filesystems (FAT, NTFS mounts) refuse the times or the
+            # mode; the data was copied and verified all the same
+            stats.count("copystat_failures")
+        return COPIED
+    
+    def verify(self, file_, target_path):
+        """ Checks a copy against the hash found while matching, or only its
+            size if the file was never hashed """
+        if os.stat(target_path).st_size != file_.size:
+            return False
+        
+        expected_hash = file_.hash_full
+        if expected_hash is None and file_.size <= 1024:
+            # The 1KiB hash covers the whole file
+            expected_hash = file_.hash_1k
+        if expected_hash is None:
+            return True
+        
+        copy = File(target_path, file_.size, None, False)
+        return copy.find_hash_full(target_path.parent) == expected_hash
+    
+    def run(self, plan, update_function=None):
+        """ Copies every file in the plan and returns a list of
+            (plan entry, result) """
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            futures = {executor.submit(self.copy_file, *entry): entry
+                       for entry in plan}
+            for files_done, future in enumerate(
+                    concurrent.futures.as_completed(futures), 1):
+                entry = futures[future]
+                results.append((entry, future.result()))
+                
+                if update_function is not None:
+                    update_function(files_done, len(plan), entry[2])
+        
+        return results
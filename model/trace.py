@@ -0,0 +1,141 @@
+"""Optional span tracing, exported in the Chrome trace event format (open the
+    file in chrome://tracing or https://ui.perfetto.dev). Tracing costs one
+    attribute check per span while it is disabled."""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+class _Span():
+    """ Records one complete ("X") event when its with block ends """
+    __slots__ = ("tracer", "name", "args", "start")
+    
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.tracer.end(self.name, self.start, **self.args)
+
+# Returned by span while tracing is disabled
+_NULL_SPAN = contextlib.nullcontext()
+
+class Tracer():
+    """ Collects spans from any thread """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._start = time.perf_counter()
+        self._thread_names = {}
+    
+    def enable(self):
+        """ Starts recording spans """
+        self._start = time.perf_counter()
+        self.enabled = True
+    
+    def span(self, name, **args):
+        """ Returns a context manager that records the time spent inside it """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+    
+    def begin(self):
+        """ Returns a start time for end, or None if tracing is disabled.
+            Useful where a with block does not fit, such as a loop body. """
+        if not self.enabled:
+            return None
+        return time.perf_counter()
+    
+    def end(self, name, start, **args):
+        """ Records a span that started at start (from begin) """
+        if start is None:
+            return
+        end = time.perf_counter()
+        thread = threading.current_thread()
+        self._thread_names[thread.ident] = thread.name
+        # list.append is atomic, so no lock is needed
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args
+        })
+    
+    def worker_start(self):
+        """ What call_traced needs to record spans in a worker process on
+            this tracer's clock: its start time, or None while disabled """
+        return self._start if self.enabled else None
+    
+    def take_events(self):
+        """ Returns the spans recorded so far, with the names of their
+            threads, and forgets them """
+        events, self.events = self.events, []
+        events.extend({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": thread_id,
+            "args": {"name": thread_name}
+        } for thread_id, thread_name in list(self._thread_names.items()))
+        return events
+    
+    def add_events(self, events):
+        """ Adds spans recorded in a worker process (see call_traced) """
+        self.events.extend(events)
+    
+    def traced(self, name, describe=None):
+        """ Decorator that puts every call of a function in a span.
+            describe(*args, **kwargs) may return a dictionary of span
+            arguments; it is only called while tracing is enabled. """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                span_args = describe(*args, **kwargs) if describe else {}
+                with _Span(self, name, span_args):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def export(self, path):
+        """ Writes the spans recorded so far as a Chrome trace JSON file """
+        events = list(self.events)
+        for thread_id, thread_name in list(self._thread_names.items()):
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": thread_id,
+                "args": {"name": thread_name}
+            })
+        
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+# Shared by everything in the process
+tracer = Tracer()
+
+def call_traced(start, function, *args):
+    """ Calls function(*args) in a worker process and returns (its result,
+        the spans it recorded) for Tracer.add_events. Spans are only
+        recorded if start (Tracer.worker_start of the parent) is not None,
+        and are timed from it, since perf_counter is the same clock in every
+        process on a machine. """
+    tracer.enabled = start is not None
+    if start is not None:
+        tracer._start = start
+    tracer.events = []
+    result = function(*args)
+    return result, tracer.take_events()
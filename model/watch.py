@@ -0,0 +1,149 @@
+"""Watches a scanned directory for changes using inotify (Linux only)."""
+
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+
+from pathlib import PurePath
+
+# Event flags from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DONT_FOLLOW)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+EVENT_HEADER = struct.Struct("iIII")
+
+def is_supported():
+    """ Returns whether inotify can be used on this platform """
+    return hasattr(os, "uname") and os.uname().sysname == "Linux"
+
+class Watcher():
+    """ Reports the paths (relative to the root path) that changed below a
+        scanned Directory. Each change is reported as just a path; the
+        Directory is then brought up to date by looking at that path again,
+        which handles creation, deletion, modification and moves alike. """
+    def __init__(self, directory):
+        self.directory = directory
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        
+        # Watch descriptor -> relative path of the watched directory
+        self._watches = {}
+        self._closed = False
+        self._watching = False
+        
+        # Set when the kernel dropped events, so that the caller can rescan
+        self.overflowed = False
+        
+        for rel_path in list(self.directory.directory_map_file):
+            self.add_watch(rel_path)
+    
+    def add_watch(self, rel_path):
+        """ Starts watching one directory (not its subdirectories). Linked
+            directories below the root are not watched, since the scan
+            does not look inside them either. """
+        full_path = self.directory.root_path.joinpath(rel_path)
+        if PurePath(rel_path) == PurePath("."):
+            # The root is followed if it is a link
+            full_path = os.path.realpath(full_path)
+        elif os.path.islink(full_path):
+            return
+        wd = self._libc.inotify_add_watch(self._fd,
+                                          os.fsencode(str(full_path)),
+                                          WATCH_MASK)
+        if wd >= 0:
+            self._watches[wd] = PurePath(rel_path)
+    
+    def read_changes(self, timeout=None):
+        """ Waits up to timeout seconds for events and returns the set of
+            changed relative paths """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        
+        try:
+            data = os.read(self._fd, 2 ** 16)
+        except BlockingIOError:
+            return set()
+        
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                # The directory is gone
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches or not name:
+                continue
+            
+            rel_path = self._watches[wd].joinpath(os.fsdecode(name))
+            changed.add(rel_path)
+            
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch the new directory and everything already inside it
+                self.add_watch(rel_path)
+                full_path = self.directory.root_path.joinpath(rel_path)
+                for path, subdirs, files in os.walk(full_path):
+                    for subdir in subdirs:
+                        self.add_watch(PurePath(path, subdir)
+                            .relative_to(self.directory.root_path))
+        
+        return changed
+    
+    def watch(self, change_function, batch_delay=0.2):
+        """ Calls change_function(paths) with batches of changed paths until
+            close is called. Changes arriving within batch_delay seconds of
+            each other are delivered together. """
+        self._watching = True
+        while not self._closed:
+            changed = self.read_changes(timeout=1)
+            while changed and not self._closed:
+                more = self.read_changes(timeout=batch_delay)
+                if not more:
+                    break
+                changed |= more
+            
+            if changed and not self._closed:
+                change_function(changed)
+        
+        os.close(self._fd)
+    
+    def start(self, change_function):
+        """ Runs watch in a daemon thread """
+        self._watching = True
+        thread = threading.Thread(target=self.watch, args=(change_function,))
+        thread.daemon = True
+        thread.start()
+        return thread
+    
+    def close(self):
+        """ Stops watching. A running watch loop stops within a second. """
+        self._closed = True
+        if not self._watching:
+            os.close(self._fd)
@@ -0,0 +1,321 @@
+"""Performance benchmarks for scanning, hashing and matching.
+    Builds a deterministic synthetic pair of trees, times each phase
+    separately and optionally compares the results against a saved baseline.
+    Run with `python -m test.benchmark --help` from the repository root."""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import PurePath
+
+from model.directory import Directory
+from model.matcher import Matcher
+
+# Size of the identical start of files with a shared header
+HEADER_SIZE = 1024
+
+# Longest wait for the first scanned entries when timing startup, in seconds
+STARTUP_TIMEOUT = 60
+
+# Run in a fresh interpreter to time startup: the same imports as
+# alreadyhave.py, then scans until each directory has its first entry besides
+# the root, or finished without one. Prints that time since the start of the
+# interpreter, "failed" if a scan failed, or None after the timeout given as
+# the first argument, and how long loading the GUI afterwards takes.
+STARTUP_PROBE = """
+import sys, time
+start = time.perf_counter()
+import alreadyhave
+from model.scanjob import start_scan
+jobs = [start_scan(path, {}) for path in sys.argv[2:]]
+deadline = start + float(sys.argv[1])
+timed_out = False
+while any(len(job.directory.file_list) < 2 and not job.progress.finished
+          for job in jobs):
+    if time.perf_counter() > deadline:
+        timed_out = True
+        break
+    time.sleep(0.0005)
+if any(job.progress.error is not None for job in jobs):
+    print("failed", flush=True)
+else:
+    print(None if timed_out else time.perf_counter() - start, flush=True)
+gui_start = time.perf_counter()
+try:
+    import view.window
+    print(time.perf_counter() - gui_start, flush=True)
+except (ImportError, ValueError):
+    print(None, flush=True)
+"""
+
+def generate_tree(path, files=10000, depth=3, fanout=8, size_mu=8.0,
+                  size_sigma=2.0, max_size=2 ** 24, duplicate_ratio=0.5,
+                  shared_header_ratio=0.1, hardlink_ratio=0.05, seed=0):
+    """ Creates two directories, path/a and path/b, for benchmarking.
+        files: Number of files in a
+        depth, fanout: Shape of the directory tree below each root
+        size_mu, size_sigma: File sizes follow a log-normal distribution with
+                             these parameters, capped at max_size bytes
+        duplicate_ratio: Fraction of a's files copied to b at the same path
+        shared_header_ratio: Fraction of the files in b that are not copies
+                             but start with the same 1KiB as a file in a
+        hardlink_ratio: Fraction of the copies made as hard links instead
+        seed: The same seed always gives the same trees
+        Returns a dictionary describing what was generated. """
+    rng = random.Random(seed)
+    root_a = os.path.join(path, "a")
+    root_b = os.path.join(path, "b")
+    
+    # Same directory layout in both roots
+    dir_paths = [PurePath(".")]
+    level = [PurePath(".")]
+    for _ in range(depth):
+        level = [parent.joinpath("d{}".format(i))
+                 for parent in level for i in range(fanout)]
+        dir_paths.extend(level)
+    for root in (root_a, root_b):
+        for dir_path in dir_paths:
+            os.makedirs(os.path.join(root, dir_path), exist_ok=True)
+    
+    stats = {
+        "files_a": 0, "files_b": 0, "bytes_a": 0, "bytes_b": 0,
+        "duplicates": 0, "shared_headers": 0, "hardlinks": 0
+    }
+    
+    for file_i in range(files):
+        rel_path = os.path.join(rng.choice(dir_paths), "f{}.bin".format(file_i))
+        size = min(int(rng.lognormvariate(size_mu, size_sigma)), max_size)
+        data = rng.randbytes(size)
+        
+        with open(os.path.join(root_a, rel_path), "wb") as f:
+            f.write(data)
+        stats["files_a"] += 1
+        stats["bytes_a"] += size
+        
+        roll = rng.random()
+        if roll < duplicate_ratio:
+            if rng.random() < hardlink_ratio:
+                os.link(os.path.join(root_a, rel_path),
+                        os.path.join(root_b, rel_path))
+                stats["hardlinks"] += 1
+            else:
+                shutil.copy2(os.path.join(root_a, rel_path),
+                             os.path.join(root_b, rel_path))
+            stats["duplicates"] += 1
+        elif roll < duplicate_ratio + shared_header_ratio and size > HEADER_SIZE:
+            # Same name, size and first 1KiB, but different afterwards
+            with open(os.path.join(root_b, rel_path), "wb") as f:
+                f.write(data[:HEADER_SIZE])
+                f.write(rng.randbytes(size - HEADER_SIZE))
+            stats["shared_headers"] += 1
+        else:
+            # Only in b, under a different name
+            rel_path = os.path.join(rng.choice(dir_paths),
+                                    "g{}.bin".format(file_i))
+            with open(os.path.join(root_b, rel_path), "wb") as f:
+                f.write(rng.randbytes(size))
+        
+        stats["files_b"] += 1
+        stats["bytes_b"] += size
+    
+    return stats
+
+def peak_rss():
+    """ Peak resident set size of this process so far, in MiB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def time_phase(function):
+    """ Runs function and returns (result, wall seconds, CPU seconds) """
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = function()
+    return (result, time.perf_counter() - wall_start,
+            time.process_time() - cpu_start)
+
+def time_startup(roots):
+    """ Starts a new interpreter that scans roots the way alreadyhave.py
+        does, and returns a dictionary of how long it took from launching it
+        until every root had its first entry scanned (or finished scanning
+        without one) """
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", STARTUP_PROBE,
+                                str(STARTUP_TIMEOUT)] + roots,
+                               cwd=repo_root, stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    in_process = process.stdout.readline().strip()
+    seconds = time.perf_counter() - start
+    gui_import = process.stdout.readline().strip()
+    process.wait()
+    return {"seconds": seconds,
+            # None if a scan failed or the first entries did not come
+            # within STARTUP_TIMEOUT
+            "in_process_seconds": (None if in_process in ("None", "failed")
+                                   else float(in_process)),
+            "scan_failed": in_process == "failed",
+            "timed_out": in_process == "None",
+            "gui_import_seconds": (None if gui_import == "None"
+                                   else float(gui_import))}
+
+def run_benchmarks(path, match_reqs, compare_small_files=False,
+                   match_processes=0):
+    """ Times startup, scanning, hashing and matching of path/a and path/b.
+        If compare_small_files is True, matching is also timed without the
+        small file fast path (see Matcher's small_file_size).
+        If match_processes is more than 0, matching is also timed with that
+        many worker processes, with its speedup over matching in one.
+        Returns a dictionary of results for each phase. """
+    results = {}
+    roots = [os.path.join(path, "a"), os.path.join(path, "b")]
+    
+    # Before anything else, so that the trees are not all in the page cache
+    results["startup"] = time_startup([os.path.abspath(root)
+                                       for root in roots])
+    
+    dirs = [Directory(root) for root in roots]
+    _, wall, cpu = time_phase(lambda: [dir_.scan() for dir_ in dirs])
+    entries = sum(len(dir_.file_list) for dir_ in dirs)
+    results["scan"] = {"seconds": wall, "cpu_seconds": cpu,
+                       "entries_per_second": entries / wall,
+                       "peak_rss_mib": peak_rss()}
+    
+    def hash_all():
+        num_bytes = 0
+        for dir_ in dirs:
+            for file_ in dir_.file_list:
+                if not file_.isdir:
+                    file_.find_hash_full(dir_.root_path)
+                    num_bytes += file_.size
+        return num_bytes
+    num_bytes, wall, cpu = time_phase(hash_all)
+    results["hash"] = {"seconds": wall, "cpu_seconds": cpu,
+                       "mib_per_second": num_bytes / 2 ** 20 / wall,
+                       "peak_rss_mib": peak_rss()}
+    
+    # Keyword arguments for the Matcher of each phase
+    phases = [("match", {})]
+    if compare_small_files:
+        phases.append(("match_pairwise", {"small_file_size": 0}))
+    if match_processes > 0:
+        phases.append(("match_parallel", {"processes": match_processes}))
+    for phase, options in phases:
+        # Match freshly scanned trees, so that no hashes are reused
+        dirs = [Directory(root) for root in roots]
+        for dir_ in dirs:
+            dir_.scan()
+        matcher = Matcher(dirs, match_reqs, **options)
+        _, wall, cpu = time_phase(matcher.find_duplicates)
+        results[phase] = {"seconds": wall, "cpu_seconds": cpu,
+                          "entries_per_second": entries / wall,
+                          "matched": len(matcher.match_dict),
+                          "peak_rss_mib": peak_rss()}
+    if match_processes > 0:
+        # Above 1 only if the processes are worth starting on this machine
+        results["match_parallel"]["speedup"] = (
+            results["match"]["seconds"] / results["match_parallel"]["seconds"])
+    
+    return results
+
+def compare_to_baseline(results, baseline, tolerance):
+    """ Prints how each phase compares to the baseline and returns whether
+        any phase got more than tolerance (a fraction) slower """
+    regressed = False
+    for phase, phase_results in results.items():
+        if phase not in baseline:
+            continue
+        ratio = phase_results["seconds"] / baseline[phase]["seconds"]
+        slower = ratio > 1 + tolerance
+        regressed = regressed or slower
+        print("{:<8} {:8.3f} s  baseline {:8.3f} s  x{:.2f}{}".format(
+            phase, phase_results["seconds"], baseline[phase]["seconds"], ratio,
+            "  REGRESSION" if slower else ""))
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=None,
+                        help="Number of files in the first tree (10000 by "
+                             "default)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Depth of the directory tree")
+    parser.add_argument("--fanout", type=int, default=8,
+                        help="Subdirectories per directory")
+    parser.add_argument("--size-mu", type=float, default=8.0,
+                        help="Mean of the log of the file sizes")
+    parser.add_argument("--size-sigma", type=float, default=2.0,
+                        help="Standard deviation of the log of the file sizes")
+    parser.add_argument("--max-size", type=int, default=2 ** 24,
+                        help="Largest file size in bytes")
+    parser.add_argument("--duplicates", type=float, default=0.5,
+                        help="Fraction of files copied to the second tree")
+    parser.add_argument("--shared-headers", type=float, default=0.1,
+                        help="Fraction of files sharing only their first 1KiB")
+    parser.add_argument("--hardlinks", type=float, default=0.05,
+                        help="Fraction of copies made as hard links")
+    parser.add_argument("--small-files", action="store_true",
+                        help="Generate many files of under 4KiB (a million "
+                             "unless --files is given), match with hashes and "
+                             "also time matching without the small file fast "
+                             "path")
+    parser.add_argument("--match-processes", type=int, default=0,
+                        help="Also time matching with this many processes")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the generated trees")
+    parser.add_argument("--dir", default=None,
+                        help="Where to generate the trees (kept afterwards)")
+    parser.add_argument("--match-hash", action="store_true",
+                        help="Require hashes to match in the match phase")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON file with results to compare against")
+    parser.add_argument("--save-baseline", default=None,
+                        help="Save the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown before a phase counts as a "
+                             "regression (fraction)")
+    args = parser.parse_args()
+    if args.small_files:
+        # Sizes around 1KiB, all under 4KiB, with thumbnail-like buckets
+        args.files = args.files if args.files is not None else 1000000
+        args.size_mu, args.size_sigma = 7.0, 0.8
+        args.max_size = 4095
+        args.match_hash = True
+    elif args.files is None:
+        args.files = 10000
+    
+    path = args.dir if args.dir is not None else tempfile.mkdtemp()
+    try:
+        if not os.path.exists(os.path.join(path, "a")):
+            print("Generating trees in", path)
+            stats = generate_tree(path, args.files, args.depth, args.fanout,
+                                  args.size_mu, args.size_sigma, args.max_size,
+                                  args.duplicates, args.shared_headers,
+                                  args.hardlinks, args.seed)
+            print(json.dumps(stats))
+        
+        match_reqs = {"filename": True, "hash": args.match_hash}
+        results = run_benchmarks(path, match_reqs, args.small_files,
+                                 args.match_processes)
+        print(json.dumps(results, indent=4))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(path, ignore_errors=True)
+    
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4)
+    
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_to_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,12 +1,41 @@
 import unittest
+from unittest import mock
 import datetime
+import errno
+import hashlib
+import io
+import json
+import time
+import subprocess
+import sys
+import threading
 
 import os
 import shutil
+import socket
+import struct
+import tarfile
 import pathlib
 from pathlib import PurePath
 
 from model.directory import Directory, File
+from model.external import external_match, scan_records
+from model.estimate import Estimator
+from model.archive import ArchiveDirectory, is_archive
+from model.sync import Copier, plan_copies, COPIED, EXISTS, CHANGED, FAILED
+from model.matcher import Matcher
+from model.watch import Watcher, is_supported as watch_supported
+from model.stats import stats
+from model.trace import tracer
+from model.pipeline import scan_pipelined, HASH_FULL
+from model.ratelimit import TokenBucket, limiter
+from model.scanjob import start_scan
+from model.progress import Progress, EventBus
+from model.agent import (Agent, AgentDirectory, send_message,
+                         receive_message)
+from model.session import Session, save_session, load_session, changed_paths
+from model.summary import Summary, build_summary, check_summary, key_digest
+from test.benchmark import generate_tree
 
 def create_test_folder(self):
     """ Set up a hypothetical configuration """
@@ -30,7 +59,7 @@ class TestDirectory(unittest.TestCase):
         self.dir_.add_file(f)
         
         # Check that the file list contains this file
-        self.assertEqual([f], self.dir_.file_list)
+        self.assertEqual([f], list(self.dir_.file_list))
         
         # Check the size map for this file
         self.assertEqual([f], self.dir_.size_map[f.size])
@@ -64,6 +93,19 @@ class TestDirectory(unittest.TestCase):
         # Directory map accurate
         self.assertEqual([self.dir2_file1],
             self.dir_.directory_map[PurePath("dir2")])
+    
+    def test_remove_file(self):
+        for file_ in [self.root_file1, self.root_dir1, self.root_dir2,
+                      self.dir2_file1]:
+            self.dir_.add_file(file_)
+        self.dir_.remove_file(self.root_dir2)
+        
+        # The rest keep their order
+        self.assertEqual([self.root_file1, self.root_dir1],
+            list(self.dir_.file_list))
+        self.assertNotIn(self.dir2_file1, self.dir_.file_list)
+        self.assertNotIn(self.dir2_file1.size, self.dir_.size_map)
+        self.assertNotIn(PurePath("dir2"), self.dir_.directory_map)
 
 def make_small_file(path, size=100, char='a'):
     with open(str(path), "w") as f:
@@ -175,6 +217,146 @@ class TestDirectoryScan(unittest.TestCase):
         # Delete testing directory
         shutil.rmtree(self.test_path, ignore_errors=True)
 
+def describe_directory(dir_):
+    """ Summarizes a scanned Directory by relative paths, so that two scans of
+        the same tree can be compared """
+    return {
+        "files": sorted(str(file_.get_path()) for file_ in dir_.file_list),
+        "directory_map": {str(path): sorted(str(file_.get_path())
+                                            for file_ in files)
+                          for path, files in dir_.directory_map.items()},
+        "size_map": {size: sorted(str(file_.get_path()) for file_ in files)
+                     for size, files in dir_.size_map.items()},
+        "counts": {str(path): (file_.to_match, file_.to_match_total)
+                   for path, file_ in dir_.directory_map_file.items()}
+    }
+
+class TestDirectoryShards(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_3")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        os.makedirs(str(self.test_path), exist_ok=True)
+        
+        make_small_file(self.test_path.joinpath("root_file1"), size=100)
+        for top in ["a", "b", "c"]:
+            sub = self.test_path.joinpath(top, "sub", "deeper")
+            os.makedirs(str(sub))
+            make_small_file(self.test_path.joinpath(top, "file"), size=10)
+            make_small_file(sub.joinpath("file"), size=20, char='b')
+        os.makedirs(str(self.test_path.joinpath("empty")))
+        
+        self.serial = Directory(str(self.test_path))
+        self.serial.scan()
+    
+    def test_scan_pipelined(self):
+        # Small limits and queues, so that the stages have to wait on each other
+        pipelined = Directory(str(self.test_path))
+        scan_pipelined(pipelined, hash_mode=HASH_FULL, list_limit=1,
+            stat_limit=2, head_hash_limit=1, full_hash_limit=1, queue_size=1)
+        
+        self.assertEqual(describe_directory(self.serial),
+            describe_directory(pipelined))
+        self.check_parent_links(pipelined)
+        for file_ in pipelined.file_list:
+            if not file_.isdir:
+                self.assertEqual(file_.hash_full,
+                    File(file_.basename, file_.size, None, False).find_hash_full(
+                        pipelined.root_path.joinpath(file_.get_path().parent)))
+    
+    def test_scan_pipelined_errors(self):
+        # Every file failing to hash still lets the scan finish
+        pipelined = Directory(str(self.test_path))
+        stats.reset()
+        with mock.patch.object(File, "find_hash_1k", side_effect=RuntimeError):
+            scan_pipelined(pipelined, hash_mode=HASH_FULL, head_hash_limit=1)
+        self.assertEqual(describe_directory(self.serial),
+            describe_directory(pipelined))
+        self.assertEqual(stats.snapshot()["counters"]["scan_pipeline_errors"],
+            sum(1 for file_ in pipelined.file_list if not file_.isdir))
+    
+    def check_parent_links(self, dir_):
+        # Every parent must be the Directory's own object for that path
+        for file_ in dir_.file_list:
+            if file_.parent_dir is not None:
+                self.assertIs(file_.parent_dir,
+                    dir_.directory_map_file[file_.get_path().parent])
+    
+    def test_merge_equals_serial_scan(self):
+        merged = Directory(str(self.test_path))
+        merged.scan_shard(PurePath("."), recursive=False)
+        for shard_path in ["a", "b", "c", "empty"]:
+            shard = Directory(str(self.test_path))
+            shard.scan_shard(PurePath(shard_path))
+            merged.merge(shard)
+        
+        self.assertEqual(describe_directory(self.serial),
+            describe_directory(merged))
+        self.check_parent_links(merged)
+    
+    def test_merge_nested_shard(self):
+        # Shards below the top level bring their parent directories along
+        merged = Directory(str(self.test_path))
+        shard = Directory(str(self.test_path))
+        shard.scan_shard(PurePath("a/sub"))
+        merged.merge(shard)
+        
+        self.assertTrue(PurePath("a/sub/deeper") in merged.directory_map)
+        self.assertEqual(merged.directory_map_file[PurePath(".")].to_match_total, 1)
+        self.check_parent_links(merged)
+    
+    def test_scan_sharded(self):
+        sharded = Directory(str(self.test_path))
+        sharded.scan_sharded(processes=2)
+        
+        self.assertEqual(describe_directory(self.serial),
+            describe_directory(sharded))
+        self.check_parent_links(sharded)
+    
+    def test_scan_sharded_symlink(self):
+        # A linked top-level directory is listed but not scanned below, as
+        # in a serial scan
+        link_path = self.test_path.joinpath("link")
+        os.symlink(os.path.abspath(str(self.test_path.joinpath("a"))),
+                   str(link_path))
+        try:
+            serial = Directory(str(self.test_path))
+            serial.scan()
+            sharded = Directory(str(self.test_path))
+            sharded.scan_sharded(processes=2)
+        finally:
+            os.remove(str(link_path))
+        
+        self.assertEqual(serial.directory_map[PurePath("link")], [])
+        self.assertEqual(describe_directory(serial),
+            describe_directory(sharded))
+        self.check_parent_links(sharded)
+    
+    def test_scan_sharded_error(self):
+        # A shard removed after the top level was listed fails in its
+        # worker, and the others are still merged
+        gone_path = self.test_path.joinpath("gone")
+        os.makedirs(str(gone_path.joinpath("sub")))
+        make_small_file(gone_path.joinpath("sub", "file"))
+        scan_shard = Directory.scan_shard
+        def scan_top_level(dir_, *args, **kwargs):
+            scan_shard(dir_, *args, **kwargs)
+            shutil.rmtree(str(gone_path))
+        
+        sharded = Directory(str(self.test_path))
+        with mock.patch.object(Directory, "scan_shard", scan_top_level):
+            sharded.scan_sharded(processes=2)
+        
+        self.assertEqual(sharded.directory_map[PurePath("gone")], [])
+        files = describe_directory(sharded)["files"]
+        files.remove("gone")
+        self.assertEqual(files, describe_directory(self.serial)["files"])
+        self.check_parent_links(sharded)
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
 class TestFile(unittest.TestCase):
     def setUp(self):
         create_test_folder(self)
@@ -305,6 +487,58 @@ class TestFileHashing(unittest.TestCase):
         hash_full_exp = bytearray.fromhex("8290e58bcaaf60ce458c38a6858e0a843ec2011e36c818f0131486a0c8d536c6")
         self.assertEqual(hash_full, hash_full_exp)
     
+    def test_hash_sparse(self):
+        # Tests a file with holes at the start, in the middle and at the end
+        path = self.test_path.joinpath("sparse")
+        with open(str(path), "wb") as f:
+            f.seek(2 ** 20)
+            f.write(b"data" * 1000)
+            f.seek(2 ** 22)
+            f.write(b"more data")
+            f.truncate(2 ** 23)
+        with open(str(path), "rb") as f:
+            hash_exp = hashlib.sha256(f.read()).digest()
+        
+        stats.reset()
+        f = File(path, 2 ** 23, None, False)
+        self.assertEqual(f.find_hash_full(self.test_path), hash_exp)
+        counters = stats.snapshot()["counters"]
+        if os.stat(str(path)).st_blocks * 512 < 2 ** 23:
+            # The filesystem kept the holes, so they were not read
+            self.assertTrue(counters["bytes_skipped_holes"] > 0)
+            self.assertEqual(counters["bytes_skipped_holes"]
+                             + counters["bytes_read_hash_full"], 2 ** 23)
+        os.remove(str(path))
+    
+    def test_hash_sparse_unsupported(self):
+        # A filesystem that cannot find holes is read from start to end
+        path = self.test_path.joinpath("sparse")
+        with open(str(path), "wb") as f:
+            f.seek(2 ** 20)
+            f.write(b"data")
+        with open(str(path), "rb") as f:
+            hash_exp = hashlib.sha256(f.read()).digest()
+        if os.stat(str(path)).st_blocks * 512 >= 2 ** 20:
+            os.remove(str(path))
+            self.skipTest("The filesystem does not keep holes")
+        
+        class NoSeekData(io.BufferedReader):
+            def seek(self, offset, whence=os.SEEK_SET):
+                if whence in (os.SEEK_DATA, os.SEEK_HOLE):
+                    raise OSError(errno.EINVAL, "Invalid argument")
+                return io.BufferedReader.seek(self, offset, whence)
+        
+        stats.reset()
+        f = File(path, 2 ** 20 + 4, None, False)
+        with mock.patch("model.directory.open", create=True,
+                        new=lambda path, mode: NoSeekData(io.FileIO(path))):
+            self.assertEqual(f.find_hash_full(self.test_path), hash_exp)
+        counters = stats.snapshot()["counters"]
+        self.assertEqual(counters["sparse_seek_failures"], 1)
+        self.assertEqual(counters["bytes_read_hash_full"], 2 ** 20 + 4)
+        self.assertNotIn("bytes_skipped_holes", counters)
+        os.remove(str(path))
+    
     def test_file_equals_different_size(self):
         # Test files that have different sizes
         f1 = File(self.test_path.joinpath("root_file1"), 100, None, False)
@@ -386,5 +620,1153 @@ class TestFileHashing(unittest.TestCase):
         # Delete testing directory
         shutil.rmtree(self.test_path, ignore_errors=True)
 
+class TestExternalMatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_4")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        self.dir_a = self.test_path.joinpath("a")
+        self.dir_b = self.test_path.joinpath("b")
+        os.makedirs(str(self.dir_a.joinpath("sub")))
+        os.makedirs(str(self.dir_b.joinpath(".git")))
+        
+        # Copied under the same name
+        make_small_file(self.dir_a.joinpath("same"), size=100)
+        make_small_file(self.dir_b.joinpath("same"), size=100)
+        # Same size and name, different contents
+        make_small_file(self.dir_a.joinpath("sub", "changed"), size=2000)
+        make_small_file(self.dir_b.joinpath("changed"), size=2000, char='b')
+        # Same contents, different name
+        make_small_file(self.dir_a.joinpath("renamed1"), size=300, char='c')
+        make_small_file(self.dir_b.joinpath("renamed2"), size=300, char='c')
+        # Only in one directory
+        make_small_file(self.dir_a.joinpath("only_a"), size=400)
+        # Ignored
+        make_small_file(self.dir_a.joinpath("empty"), size=0)
+        make_small_file(self.dir_b.joinpath(".git", "only_a"), size=400)
+        
+        # Lots of files, so that a small memory limit needs several runs
+        for i in range(50):
+            make_small_file(self.dir_a.joinpath("many{}".format(i)), size=500 + i)
+            make_small_file(self.dir_b.joinpath("many{}".format(i)), size=500 + i)
+    
+    def run_match(self, match_reqs, memory_limit=1000):
+        """ Returns the sets of matched and unmatched relative paths """
+        matched = set()
+        unmatched = set()
+        roots = [str(self.dir_a), str(self.dir_b)]
+        for is_match, members in external_match(roots, match_reqs, memory_limit):
+            for dir_index, rel_path in members:
+                self.assertFalse((dir_index, rel_path) in matched | unmatched)
+                (matched if is_match else unmatched).add((dir_index, rel_path))
+        return matched, unmatched
+    
+    def test_match_filename(self):
+        matched, unmatched = self.run_match({"filename": True})
+        self.assertTrue((0, "same") in matched)
+        self.assertTrue((0, os.path.join("sub", "changed")) in matched)
+        self.assertTrue((0, "renamed1") in unmatched)
+        self.assertTrue((0, "only_a") in unmatched)
+        self.assertTrue((1, "many49") in matched)
+        self.assertEqual(len(matched), 104)
+        self.assertFalse((0, "empty") in matched | unmatched)
+    
+    def test_match_hash(self):
+        matched, unmatched = self.run_match({"hash": True})
+        self.assertTrue((0, "renamed1") in matched)
+        self.assertTrue((1, "renamed2") in matched)
+        self.assertTrue((1, "changed") in unmatched)
+        self.assertTrue((0, "only_a") in unmatched)
+    
+    def test_memory_limit_same_result(self):
+        self.assertEqual(self.run_match({"filename": True}, 1000),
+            self.run_match({"filename": True}, 2 ** 20))
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestArchiveDirectory(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_5")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        self.tree_path = self.test_path.joinpath("tree")
+        os.makedirs(str(self.tree_path.joinpath("dir1", "sub")))
+        os.makedirs(str(self.tree_path.joinpath("empty")))
+        make_small_file(self.tree_path.joinpath("root_file"), size=100)
+        make_small_file(self.tree_path.joinpath("dir1", "big"), size=2 ** 17,
+            char='b')
+        make_small_file(self.tree_path.joinpath("dir1", "sub", "file"),
+            size=1024, char='c')
+        
+        self.dir_ = Directory(str(self.tree_path))
+        self.dir_.scan()
+        
+        self.archives = []
+        for archive_format in ["gztar", "zip"]:
+            self.archives.append(shutil.make_archive(
+                str(self.test_path.joinpath("archive")), archive_format,
+                str(self.tree_path)))
+    
+    def test_is_archive(self):
+        for archive_path in self.archives:
+            self.assertTrue(is_archive(archive_path))
+        self.assertFalse(is_archive(str(self.tree_path)))
+        self.assertFalse(is_archive(str(self.tree_path.joinpath("root_file"))))
+    
+    def test_tree_same_as_scan(self):
+        for archive_path in self.archives:
+            archive_dir = ArchiveDirectory(archive_path)
+            archive_dir.scan()
+            
+            # Modification times are left out, since zip stores them coarsely
+            self.assertEqual(describe_directory(self.dir_),
+                describe_directory(archive_dir))
+    
+    def test_members_match_files(self):
+        match_reqs = {
+            "hash": True,
+            "filename": True
+        }
+        for archive_path in self.archives:
+            archive_dir = ArchiveDirectory(archive_path, hash_members=True)
+            archive_dir.scan()
+            
+            for path in [PurePath("root_file"), PurePath("dir1/big"),
+                         PurePath("dir1/sub/file")]:
+                archive_file = archive_dir.member_files[path]
+                disk_file = [file_ for file_ in self.dir_.file_list
+                             if file_.get_path() == path][0]
+                self.assertEqual(archive_file.hash_full,
+                    disk_file.find_hash_full(self.dir_.root_path))
+                self.assertTrue(File.equals(archive_file, archive_dir.root_path,
+                    disk_file, self.dir_.root_path, match_reqs))
+    
+    def test_odd_tar_members(self):
+        archive_path = str(self.test_path.joinpath("odd.tar"))
+        with tarfile.open(archive_path, "w") as archive:
+            archive.add(str(self.tree_path.joinpath("root_file")), "a")
+            # Below a file member
+            archive.add(str(self.tree_path.joinpath("root_file")), "a/b")
+            link = tarfile.TarInfo("link")
+            link.type = tarfile.LNKTYPE
+            link.linkname = "a"
+            archive.addfile(link)
+            missing = tarfile.TarInfo("missing_link")
+            missing.type = tarfile.LNKTYPE
+            missing.linkname = "nowhere"
+            archive.addfile(missing)
+        
+        stats.reset()
+        archive_dir = ArchiveDirectory(archive_path, hash_members=True)
+        archive_dir.scan()
+        self.assertEqual(sorted(str(path) for path in archive_dir.member_files),
+                         ["a", "link"])
+        link_file = archive_dir.member_files[PurePath("link")]
+        self.assertEqual(link_file.size, 100)
+        self.assertEqual(link_file.hash_full,
+                         archive_dir.member_files[PurePath("a")].hash_full)
+        self.assertEqual(
+            stats.snapshot()["counters"]["archive_members_skipped"], 2)
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_6")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        self.source_path = self.test_path.joinpath("source")
+        self.target_path = self.test_path.joinpath("target")
+        self.other_path = self.test_path.joinpath("other")
+        os.makedirs(str(self.source_path.joinpath("sub")))
+        os.makedirs(str(self.target_path))
+        os.makedirs(str(self.other_path))
+        
+        make_small_file(self.source_path.joinpath("matched"), size=100)
+        make_small_file(self.target_path.joinpath("matched"), size=100)
+        make_small_file(self.source_path.joinpath("sub", "big"), size=2 ** 17,
+            char='b')
+        make_small_file(self.source_path.joinpath("small"), size=10, char='c')
+        # Only matches a third directory, so it is still missing in target
+        make_small_file(self.other_path.joinpath("small"), size=10, char='c')
+        make_small_file(self.source_path.joinpath("exists"), size=10)
+        make_small_file(self.target_path.joinpath("exists"), size=20)
+        make_small_file(self.source_path.joinpath("changed"), size=11)
+        
+        self.dir_ = Directory(str(self.source_path))
+        self.target_dir = Directory(str(self.target_path))
+        self.other_dir = Directory(str(self.other_path))
+        for dir_ in (self.dir_, self.target_dir, self.other_dir):
+            dir_.scan()
+        self.matcher = Matcher([self.dir_, self.target_dir, self.other_dir],
+                               {"hash": True})
+        self.matcher.find_duplicates()
+        self.files = {str(file_.get_path()): file_
+                      for file_ in self.dir_.file_list}
+        # Grows after the scan
+        make_small_file(self.source_path.joinpath("changed"), size=30)
+    
+    def test_plan_copies(self):
+        self.assertTrue(self.files["small"].matched)
+        plan = plan_copies(self.dir_, self.target_dir, self.matcher)
+        self.assertEqual(set(str(entry[1]) for entry in plan),
+            set(str(self.source_path.joinpath(path)) for path in
+                ["sub/big", "small", "exists", "changed"]))
+        for file_, source_path, target_path in plan:
+            self.assertEqual(target_path,
+                self.target_path.joinpath(file_.get_path()))
+        
+        # The other directory already has small
+        plan = plan_copies(self.dir_, self.other_dir, self.matcher)
+        self.assertNotIn("small", [str(entry[0].get_path()) for entry in plan])
+        self.assertIn("matched", [str(entry[0].get_path()) for entry in plan])
+    
+    def test_plan_copies_not_local(self):
+        self.dir_.local = False
+        self.assertEqual(plan_copies(self.dir_, self.target_dir, self.matcher),
+                         [])
+    
+    def test_copy_unreadable(self):
+        # A path through a regular file raises NotADirectoryError
+        copier = Copier(workers=1)
+        self.assertEqual(copier.copy_file(self.files["small"],
+            self.source_path.joinpath("missing", "small"),
+            self.target_path.joinpath("small")), FAILED)
+        self.assertEqual(copier.copy_file(self.files["small"],
+            self.source_path.joinpath("small", "x"),
+            self.target_path.joinpath("small")), FAILED)
+    
+    def test_copy_errors_after_copying(self):
+        copier = Copier(workers=1)
+        source_path = self.source_path.joinpath("small")
+        target_path = self.target_path.joinpath("small")
+        # Copying the times is best-effort
+        with mock.patch("shutil.copystat", side_effect=PermissionError):
+            self.assertEqual(copier.copy_file(self.files["small"], source_path,
+                                              target_path), COPIED)
+        os.remove(str(target_path))
+        
+        # The copy vanishing before it is verified fails only that file
+        with mock.patch.object(Copier, "verify", side_effect=FileNotFoundError):
+            results = copier.run([(self.files["small"], source_path,
+                                   target_path)])
+        self.assertEqual([result for _, result in results], [FAILED])
+        self.assertFalse(os.path.exists(str(target_path)))
+    
+    def test_copy(self):
+        # Hashed during matching, so the copy is checked against it
+        self.files[os.path.join("sub", "big")].find_hash_full(
+            self.dir_.root_path)
+        
+        copier = Copier(workers=2, bandwidth_limit=2 ** 30, chunk_size=2 ** 15)
+        results = {str(entry[0].get_path()): result for entry, result in
+                   copier.run(plan_copies(self.dir_, self.target_dir,
+                                          self.matcher))}
+        self.assertEqual(results, {
+            os.path.join("sub", "big"): COPIED,
+            "small": COPIED,
+            "exists": EXISTS,
+            "changed": CHANGED
+        })
+        
+        copied = File(self.target_path.joinpath("sub", "big"), 2 ** 17, None,
+            False)
+        self.assertEqual(copied.find_hash_full(self.target_path.joinpath("sub")),
+            self.files[os.path.join("sub", "big")].hash_full)
+        # The existing file was left alone
+        self.assertEqual(os.stat(str(self.target_path.joinpath("exists"))).st_size,
+            20)
+        self.assertFalse(os.path.exists(str(self.target_path.joinpath("changed"))))
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestMatcher(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_7")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        self.path_a = self.test_path.joinpath("a")
+        self.path_b = self.test_path.joinpath("b")
+        os.makedirs(str(self.path_a.joinpath("sub")))
+        os.makedirs(str(self.path_b))
+        
+        make_small_file(self.path_a.joinpath("same"), size=100)
+        make_small_file(self.path_b.joinpath("same"), size=100)
+        make_small_file(self.path_a.joinpath("sub", "only_a"), size=200)
+        make_small_file(self.path_a.joinpath("empty"), size=0)
+        
+        self.dirs = [Directory(str(self.path_a)), Directory(str(self.path_b))]
+        for dir_ in self.dirs:
+            dir_.scan()
+        self.matcher = Matcher(self.dirs, {"filename": True})
+        self.matcher.find_duplicates()
+    
+    def counts(self, dir_index, path="."):
+        dir_file = self.dirs[dir_index].directory_map_file[PurePath(path)]
+        return dir_file.to_match, dir_file.to_match_total
+    
+    def test_find_duplicates(self):
+        same_a = self.dirs[0].find_file(PurePath("same"))
+        same_b = self.dirs[1].find_file(PurePath("same"))
+        self.assertTrue(same_a.matched)
+        self.assertEqual(self.matcher.match_dict[same_a], [same_a, same_b])
+        self.assertFalse(self.dirs[0].find_file(PurePath("sub/only_a")).matched)
+        # The empty file is ignored, so only the unmatched file is left
+        self.assertEqual(self.counts(0), (1, 2))
+        self.assertEqual(self.counts(1), (0, 1))
+    
+    def test_ignored_flags(self):
+        os.makedirs(str(self.path_a.joinpath("sub", ".git", "objects")))
+        make_small_file(self.path_a.joinpath("sub", ".git", "objects", "x"))
+        make_small_file(self.path_a.joinpath("sub", ".git", "HEAD"))
+        make_small_file(self.path_a.joinpath(".git"))
+        dir_ = Directory(str(self.path_a))
+        dir_.scan()
+        files = list(dir_.file_list)
+        self.assertEqual(self.matcher.ignored_flags(files),
+                         [self.matcher.ignore_file(file_) for file_ in files])
+        self.assertEqual(sum(self.matcher.ignored_flags(files)), 6)
+    
+    def test_filename_index_lazy(self):
+        # Only built once matching on filenames needs it
+        dir_ = Directory(str(self.path_a))
+        dir_.scan()
+        self.assertIsNone(dir_.filename_map)
+        same = dir_.find_file(PurePath("same"))
+        self.assertEqual(dir_.find_candidates(same), [same])
+        self.assertIsNone(dir_.filename_map)
+        self.assertEqual(dir_.find_candidates(same, {"filename": True}), [same])
+        self.assertEqual(dir_.filename_map[(100, "same")], [same])
+        
+        # Kept up to date from then on
+        make_small_file(self.path_a.joinpath("sub", "same"), size=100)
+        added = dir_.add_path(PurePath("sub/same"))
+        self.assertEqual(dir_.filename_map[(100, "same")], [same] + added)
+        dir_.remove_file(same)
+        self.assertEqual(dir_.filename_map[(100, "same")], added)
+    
+    def test_filename_index(self):
+        # Same size as "same", but a different name
+        make_small_file(self.path_b.joinpath("other"), size=100)
+        self.matcher.refresh_paths(1, [PurePath("other")])
+        other = self.dirs[1].find_file(PurePath("other"))
+        self.assertEqual(self.dirs[1].filename_map[(100, "other")], [other])
+        self.assertEqual(len(self.dirs[1].size_map[100]), 2)
+        
+        stats.reset()
+        self.matcher.rematch_sizes([100])
+        # Only the file with the same name was compared
+        self.assertEqual(stats.snapshot()["counters"]["candidate_pairs"], 1)
+        self.assertFalse(other.matched)
+        
+        os.remove(str(self.path_b.joinpath("other")))
+        self.matcher.refresh_paths(1, [PurePath("other")])
+        self.assertNotIn((100, "other"), self.dirs[1].filename_map)
+    
+    def test_refresh_paths_create(self):
+        make_small_file(self.path_b.joinpath("only_a"), size=200)
+        self.matcher.refresh_paths(1, [PurePath("only_a")])
+        
+        self.assertTrue(self.dirs[0].find_file(PurePath("sub/only_a")).matched)
+        self.assertEqual(self.counts(0), (0, 2))
+        self.assertEqual(self.counts(0, "sub"), (0, 1))
+        self.assertEqual(self.counts(1), (0, 2))
+    
+    def test_refresh_paths_delete(self):
+        os.remove(str(self.path_b.joinpath("same")))
+        self.matcher.refresh_paths(1, [PurePath("same")])
+        
+        same_a = self.dirs[0].find_file(PurePath("same"))
+        self.assertFalse(same_a.matched)
+        self.assertFalse(same_a in self.matcher.match_dict)
+        self.assertEqual(self.counts(0), (2, 2))
+        self.assertEqual(self.counts(1), (0, 0))
+        self.assertFalse(100 in self.dirs[1].size_map)
+    
+    def test_refresh_paths_directory(self):
+        # Move a whole directory from a to b
+        shutil.move(str(self.path_a.joinpath("sub")), str(self.path_b))
+        self.matcher.refresh_paths(0, [PurePath("sub")])
+        self.matcher.refresh_paths(1, [PurePath("sub")])
+        
+        self.assertFalse(PurePath("sub") in self.dirs[0].directory_map)
+        self.assertEqual(self.counts(0), (0, 1))
+        self.assertEqual(self.counts(1), (1, 2))
+        self.assertEqual(self.counts(1, "sub"), (1, 1))
+        self.assertEqual(len(self.dirs[0].file_list), 3)
+    
+    @unittest.skipUnless(watch_supported(), "inotify is only on Linux")
+    def test_watcher(self):
+        watcher = Watcher(self.dirs[0])
+        try:
+            make_small_file(self.path_a.joinpath("sub", "new"), size=10)
+            os.makedirs(str(self.path_a.joinpath("newdir")))
+            os.remove(str(self.path_a.joinpath("same")))
+            self.assertEqual(watcher.read_changes(timeout=5),
+                set([PurePath("sub/new"), PurePath("newdir"),
+                     PurePath("same")]))
+            
+            # The new directory is watched as well
+            make_small_file(self.path_a.joinpath("newdir", "file"), size=10)
+            self.assertEqual(watcher.read_changes(timeout=5),
+                set([PurePath("newdir/file")]))
+        finally:
+            watcher.close()
+    
+    @unittest.skipUnless(watch_supported(), "inotify is only on Linux")
+    def test_watcher_symlink(self):
+        # Changes inside a linked directory are not reported, since the
+        # scan does not list what is inside it
+        os.symlink(os.path.abspath(str(self.path_b)),
+                   str(self.path_a.joinpath("linked")))
+        dir_ = Directory(str(self.path_a))
+        dir_.scan()
+        self.assertIn(PurePath("linked"), dir_.directory_map_file)
+        watcher = Watcher(dir_)
+        try:
+            make_small_file(self.path_b.joinpath("new"), size=10)
+            make_small_file(self.path_a.joinpath("sub", "new"), size=10)
+            self.assertEqual(watcher.read_changes(timeout=5),
+                             set([PurePath("sub/new")]))
+        finally:
+            watcher.close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestBenchmarkGenerator(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_8")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+    
+    def describe_tree(self, path):
+        """ Lists (relative path, size, 1k hash) of every file below path """
+        dir_ = Directory(str(path))
+        dir_.scan()
+        return sorted((str(file_.get_path()), file_.size,
+                       file_.find_hash_1k(dir_.root_path))
+                      for file_ in dir_.file_list if not file_.isdir)
+    
+    def test_deterministic(self):
+        trees = []
+        for run in range(2):
+            path = self.test_path.joinpath(str(run))
+            stats = generate_tree(str(path), files=50, depth=2, fanout=3,
+                size_mu=7, max_size=2 ** 14, seed=42)
+            trees.append((stats, self.describe_tree(path.joinpath("a")),
+                          self.describe_tree(path.joinpath("b"))))
+        self.assertEqual(trees[0], trees[1])
+        self.assertEqual(trees[0][0]["files_a"], 50)
+    
+    def test_duplicates_match(self):
+        stats = generate_tree(str(self.test_path), files=50, depth=1,
+            fanout=2, size_mu=7, max_size=2 ** 14, duplicate_ratio=0.4,
+            hardlink_ratio=0.5, seed=1)
+        dirs = [Directory(str(self.test_path.joinpath(root)))
+                for root in ["a", "b"]]
+        for dir_ in dirs:
+            dir_.scan()
+        matcher = Matcher(dirs, {"filename": True, "hash": True})
+        matcher.find_duplicates()
+        
+        matched = [file_ for file_ in dirs[0].file_list if file_.matched
+                   and not file_.isdir]
+        self.assertEqual(len(matched), stats["duplicates"])
+        self.assertTrue(stats["hardlinks"] > 0)
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_9")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        for root in ["a", "b"]:
+            os.makedirs(str(self.test_path.joinpath(root, "sub")))
+            make_small_file(self.test_path.joinpath(root, "sub", "file"),
+                size=2000)
+        stats.reset()
+    
+    def test_counters(self):
+        dirs = [Directory(str(self.test_path.joinpath(root)))
+                for root in ["a", "b"]]
+        for dir_ in dirs:
+            dir_.scan()
+        # Compare pair by pair (see TestSmallFiles for the fast path)
+        matcher = Matcher(dirs, {"hash": True}, small_file_size=0)
+        matcher.find_duplicates()
+        # Already hashed
+        dirs[0].find_file(PurePath("sub/file")).find_hash_full(dirs[0].root_path)
+        
+        snapshot = stats.snapshot()
+        counters = snapshot["counters"]
+        # Root, sub and file in each directory
+        self.assertEqual(counters["stat_calls"], 6)
+        self.assertEqual(counters["files_opened"], 4)
+        self.assertEqual(counters["bytes_read_hash_1k"], 2048)
+        self.assertEqual(counters["bytes_read_hash_full"], 4000)
+        self.assertEqual(counters["hash_cache_hits"], 1)
+        self.assertEqual(counters["candidate_pairs"], 1)
+        self.assertEqual(counters["matches"], 1)
+        self.assertEqual(snapshot["phases"]["scan"]["count"], 2)
+        self.assertEqual(snapshot["phases"]["match"]["count"], 1)
+    
+    def test_trace(self):
+        tracer.enable()
+        try:
+            dirs = [Directory(str(self.test_path.joinpath(root)))
+                    for root in ["a", "b"]]
+            for dir_ in dirs:
+                dir_.scan()
+            matcher = Matcher(dirs, {"hash": True}, small_file_size=0)
+            matcher.find_duplicates()
+            
+            trace_path = self.test_path.joinpath("trace.json")
+            tracer.export(str(trace_path))
+        finally:
+            tracer.enabled = False
+            tracer.events = []
+        
+        with open(str(trace_path)) as f:
+            events = json.load(f)["traceEvents"]
+        names = [event["name"] for event in events if event["ph"] == "X"]
+        # Root and sub in each directory
+        self.assertEqual(names.count("scan directory"), 4)
+        self.assertEqual(names.count("find_hash_1k"), 2)
+        self.assertEqual(names.count("find_hash_full"), 2)
+        self.assertEqual(names.count("match bucket"), 3)
+        self.assertEqual(names.count("match"), 1)
+        hash_event = [event for event in events
+                      if event["name"] == "find_hash_full"][0]
+        self.assertEqual(hash_event["args"]["path"], os.path.join("sub", "file"))
+        self.assertTrue(hash_event["dur"] >= 0)
+    
+    def test_trace_workers(self):
+        # Spans recorded in worker processes end up in the parent's trace
+        tracer.enable()
+        try:
+            dirs = [Directory(str(self.test_path.joinpath(root)))
+                    for root in ["a", "b"]]
+            for dir_ in dirs:
+                dir_.scan_sharded(processes=2)
+            matcher = Matcher(dirs, {"hash": True}, processes=2)
+            matcher.find_duplicates()
+            events = list(tracer.events)
+        finally:
+            tracer.enabled = False
+            tracer.events = []
+        
+        pids = {}
+        for event in events:
+            pids.setdefault(event["name"], set()).add(event["pid"])
+        for name in ["scan shard", "scan directory", "match rows"]:
+            self.assertTrue(pids[name] - {os.getpid()}, name)
+        for name in ["share columns", "match pairs", "prefetch small hashes"]:
+            self.assertEqual(pids[name], {os.getpid()})
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestRateLimit(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        start = time.monotonic()
+        # The first second's worth is a burst, the rest is paced
+        for _ in range(15):
+            bucket.acquire(100)
+        elapsed = time.monotonic() - start
+        self.assertTrue(0.4 < elapsed < 1.0)
+        
+        bucket = TokenBucket()
+        start = time.monotonic()
+        bucket.acquire(10 ** 12)
+        self.assertTrue(time.monotonic() - start < 0.1)
+    
+    def test_backoff(self):
+        try:
+            limiter.set_limits(2 ** 20, 100, latency_threshold=0.01)
+            limiter.record_latency(0.05)
+            limiter.record_latency(0.05)
+            self.assertEqual(limiter.factor, 0.25)
+            self.assertEqual(limiter.ops.rate, 25)
+            for _ in range(1000):
+                limiter.record_latency(0.001)
+            self.assertEqual(limiter.factor, 1.0)
+            self.assertEqual(limiter.bytes.rate, 2 ** 20)
+            
+            limiter.scale_limits(0.5)
+            self.assertEqual(limiter.ops.rate, 50)
+        finally:
+            limiter.set_limits()
+    
+    def test_requested_scale(self):
+        # As from a signal handler: nothing changes until the next wait
+        try:
+            limiter.set_limits(ops_per_second=1000)
+            version = limiter.limits_version
+            limiter.request_scale(0.5)
+            limiter.request_scale(0.5)
+            self.assertEqual(limiter.ops.rate, 1000)
+            limiter.wait_op()
+            self.assertEqual(limiter.ops.rate, 250)
+            self.assertEqual(limiter.limits_version, version + 2)
+        finally:
+            limiter.set_limits()
+    
+    def test_shares(self):
+        # Worker processes split the limits instead of each getting them all
+        try:
+            limiter.set_limits(2 ** 20, 100, latency_threshold=0.01)
+            self.assertEqual(limiter.shares(4), (2 ** 18, 25, 0.01))
+            limiter.set_limits(ops_per_second=100)
+            self.assertEqual(limiter.shares(4), (None, 25, None))
+        finally:
+            limiter.set_limits()
+    
+    def test_limited_scan(self):
+        test_path = PurePath("./test/testdir_10")
+        shutil.rmtree(test_path, ignore_errors=True)
+        os.makedirs(str(test_path))
+        try:
+            for i in range(10):
+                make_small_file(test_path.joinpath("file{}".format(i)))
+            
+            # 11 stat calls and 10 opens, paced at 200 per second
+            limiter.set_limits(ops_per_second=200)
+            limiter.ops.set_rate(200, 1)
+            start = time.monotonic()
+            directory = Directory(str(test_path))
+            directory.scan()
+            for file_ in directory.file_list:
+                if not file_.isdir:
+                    file_.find_hash_1k(directory.root_path)
+            elapsed = time.monotonic() - start
+        finally:
+            limiter.set_limits()
+            shutil.rmtree(test_path, ignore_errors=True)
+        
+        self.assertEqual(len(directory.file_list), 11)
+        self.assertTrue(elapsed > 0.05)
+
+class TestEstimate(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_11")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        self.generated = generate_tree(str(self.test_path), files=300,
+                                       depth=2, fanout=3, size_mu=6.0,
+                                       size_sigma=1.0, seed=3)
+        self.sample_dir = Directory(str(self.test_path.joinpath("a")))
+        self.sample_dir.scan()
+        self.true_fraction = (self.generated["duplicates"] /
+                              self.generated["files_a"])
+    
+    def test_all_sampled(self):
+        other_dir = Directory(str(self.test_path.joinpath("b")))
+        for scan_other in [False, True]:
+            if scan_other:
+                other_dir.scan()
+            estimator = Estimator(self.sample_dir, other_dir,
+                                  {"filename": True, "hash": True}, seed=0)
+            result = estimator.run()
+            self.assertEqual(result["samples"], 300)
+            self.assertAlmostEqual(result["matched_fraction"],
+                                   self.true_fraction)
+            low, high = result["matched_fraction_interval"]
+            self.assertAlmostEqual(low, high)
+    
+    def test_intervals_narrow(self):
+        other_dir = Directory(str(self.test_path.joinpath("b")))
+        estimator = Estimator(self.sample_dir, other_dir,
+                              {"filename": True, "hash": True}, seed=0)
+        widths = []
+        for num_samples in [20, 100, 200]:
+            result = estimator.run(max_samples=num_samples)
+            self.assertEqual(result["samples"], num_samples)
+            low, high = result["matched_fraction_interval"]
+            self.assertTrue(low <= self.true_fraction <= high)
+            widths.append(high - low)
+            low, high = result["matched_bytes_interval"]
+            self.assertTrue(0 <= low <= result["matched_bytes"] <= high <=
+                            result["total_bytes"])
+        self.assertTrue(widths[0] > widths[1] > widths[2])
+    
+    def test_all_samples_equal(self):
+        # Every file is at the same path in itself, so every sample matches
+        other_dir = Directory(str(self.test_path.joinpath("a")))
+        estimator = Estimator(self.sample_dir, other_dir, {"filename": True},
+                              seed=0)
+        result = estimator.run(target_margin=0.05, batch_size=2)
+        self.assertTrue(result["samples"] > 2)
+        low, high = result["matched_fraction_interval"]
+        self.assertTrue(low < result["matched_fraction"] <= high)
+        self.assertTrue(low < 1.0)
+        self.assertTrue((high - low) / 2 <= 0.05)
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestScanJob(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_12")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        os.makedirs(str(self.test_path.joinpath("sub")))
+        make_small_file(self.test_path.joinpath("sub", "file"))
+    
+    def test_progress(self):
+        job = start_scan(str(self.test_path), {})
+        # Nothing has to listen; the progress is there to look at
+        while not job.progress.finished:
+            time.sleep(0.001)
+        self.assertEqual(len(job.directory.file_list), 3)
+        self.assertEqual(job.progress.state, (1, 1, None))
+        self.assertEqual(job.progress.fraction(), 1.0)
+        self.assertIsNone(job.progress.error)
+    
+    def test_failed_scan(self):
+        # Nothing listens on port 1
+        job = start_scan("agent://127.0.0.1:1", {})
+        deadline = time.monotonic() + 10
+        while not job.progress.finished and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(job.progress.finished)
+        self.assertIsInstance(job.progress.error, OSError)
+    
+    def test_event_bus(self):
+        bus = EventBus()
+        def post_events(thread_index):
+            for i in range(1000):
+                bus.post("event", thread_index, i)
+        threads = [threading.Thread(target=post_events, args=(thread_index,))
+                   for thread_index in range(4)]
+        for thread in threads:
+            thread.start()
+        events = []
+        while any(thread.is_alive() for thread in threads):
+            events.extend(bus.drain())
+        for thread in threads:
+            thread.join()
+        events.extend(bus.drain())
+        
+        self.assertEqual(len(events), 4000)
+        self.assertEqual(bus.drain(), [])
+        # Each thread's events arrive in the order they were posted
+        for thread_index in range(4):
+            self.assertEqual([args[1] for name, args in events
+                              if args[0] == thread_index], list(range(1000)))
+        
+        progress = Progress()
+        self.assertEqual(progress.fraction(), 0.0)
+        progress.publish(1, 4, "item")
+        self.assertEqual(progress.fraction(), 0.25)
+    
+    def test_no_gui_import(self):
+        # The GUI toolkit is only imported once the scans are running
+        output = subprocess.check_output([sys.executable, "-c",
+            "import sys, alreadyhave; print('gi' in sys.modules)"],
+            universal_newlines=True)
+        self.assertEqual(output.strip(), "False")
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_13")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        generate_tree(str(self.test_path), files=60, depth=1, fanout=3,
+                      size_mu=7.0, size_sigma=1.0, seed=5)
+        # Serve b over loopback, compare it with a local a
+        self.agent = Agent(str(self.test_path.joinpath("b")), token="secret")
+        self.agent.start(port=0)
+        self.url = "agent://{}:{}".format(*self.agent.address)
+    
+    def test_scan_and_match(self):
+        local_b = Directory(str(self.test_path.joinpath("b")))
+        local_b.scan()
+        agent_b = AgentDirectory(self.url, token="secret")
+        agent_b.scan()
+        self.assertEqual(describe_directory(agent_b),
+                         describe_directory(local_b))
+        
+        results = []
+        for dir_b in [local_b, agent_b]:
+            dir_a = Directory(str(self.test_path.joinpath("a")))
+            dir_a.scan()
+            matcher = Matcher([dir_a, dir_b], {"hash": True})
+            stats.reset()
+            matcher.find_duplicates()
+            results.append(sorted(str(file_.get_path())
+                                  for file_ in matcher.match_dict))
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(len(results[1]) > 0)
+        
+        # Each hash was found once, and many per request
+        hashed = (sum(1 for file_ in agent_b.file_list if file_.hash_1k) +
+                  sum(1 for file_ in agent_b.file_list
+                      if file_.hash_full and file_.size > 1024))
+        counters = stats.snapshot()["counters"]
+        self.assertEqual(counters["agent_hashes"], hashed)
+        self.assertTrue(counters["agent_requests"] < hashed / 4)
+        agent_b.client.close()
+    
+    def test_refused(self):
+        agent_b = AgentDirectory(self.url, token="wrong")
+        with self.assertRaises(OSError):
+            agent_b.scan()
+        agent_b.client.close()
+        
+        agent_b = AgentDirectory(self.url, token="secret")
+        with self.assertRaises(OSError):
+            agent_b.list_dir("../a")
+        entries = agent_b.list_dir(".")
+        self.assertEqual(sorted(str(entry[0]) for entry in entries if entry[1]),
+                         ["d0", "d1", "d2"])
+        agent_b.client.close()
+    
+    def test_symlink_escape(self):
+        root = self.test_path.joinpath("b")
+        os.symlink(os.path.abspath(str(self.test_path.joinpath("a"))),
+                   str(root.joinpath("outside")))
+        os.symlink("d0", str(root.joinpath("inside")))
+        agent_b = AgentDirectory(self.url, token="secret")
+        names = [str(entry[0]) for entry in agent_b.list_dir(".")]
+        self.assertIn("inside", names)
+        self.assertNotIn("outside", names)
+        with self.assertRaises(OSError):
+            agent_b.list_dir("outside")
+        agent_b.client.close()
+    
+    def test_missing_hash_cached(self):
+        agent_b = AgentDirectory(self.url, token="secret")
+        agent_b.scan()
+        file_ = next(file_ for file_ in agent_b.file_list
+                     if not file_.isdir and file_.size > 1024)
+        os.remove(str(self.test_path.joinpath("b", file_.get_path())))
+        stats.reset()
+        self.assertIsNone(file_.find_hash_full())
+        self.assertIsNone(file_.find_hash_full())
+        self.assertEqual(stats.snapshot()["counters"]["agent_requests"], 1)
+        agent_b.client.close()
+    
+    def test_bad_message(self):
+        # A client that sends garbage is disconnected, and the agent keeps
+        # serving others
+        sock = socket.create_connection(self.agent.address)
+        sock.sendall(struct.pack(">I", 5) + b"nope!")
+        self.assertEqual(sock.recv(1), b"")
+        sock.close()
+        
+        # Requests that are not objects get an error back
+        sock = socket.create_connection(self.agent.address)
+        for message in [[], 1]:
+            send_message(sock, message)
+            self.assertIn("error", receive_message(sock))
+        # Large messages are refused until the token was sent
+        sock.sendall(struct.pack(">I", 2 ** 20))
+        self.assertEqual(sock.recv(1), b"")
+        sock.close()
+        
+        agent_b = AgentDirectory(self.url, token="secret")
+        self.assertTrue(len(agent_b.list_dir(".")) > 0)
+        agent_b.client.close()
+    
+    def tearDown(self):
+        self.agent.shutdown()
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestParallelMatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_14")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        generate_tree(str(self.test_path), files=400, depth=2, fanout=3,
+                      size_mu=4.0, size_sigma=1.5, seed=7)
+        # Same name and size as a file in a, but older
+        make_small_file(self.test_path.joinpath("a", "old"), size=10)
+        make_small_file(self.test_path.joinpath("b", "old"), size=10)
+        os.utime(str(self.test_path.joinpath("b", "old")), (1, 1))
+    
+    def match(self, match_reqs, processes):
+        dirs = [Directory(str(self.test_path.joinpath(root)))
+                for root in ["a", "b"]]
+        for dir_ in dirs:
+            dir_.scan()
+        matcher = Matcher(dirs, match_reqs, processes)
+        matcher.find_duplicates()
+        groups = [[str(file_.get_path()) for file_ in matcher.match_dict[file_]]
+                  for dir_ in dirs for file_ in dir_.file_list
+                  if file_ in matcher.match_dict]
+        return groups, [describe_directory(dir_) for dir_ in dirs]
+    
+    def test_same_as_serial(self):
+        for match_reqs in [{}, {"filename": True}, {"modtime": True},
+                           {"filename": True, "zero": True},
+                           {"filename": True, "hash": True}]:
+            serial = self.match(match_reqs, 0)
+            self.assertTrue(len(serial[0]) > 0)
+            self.assertEqual(self.match(match_reqs, 2), serial)
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+def describe_matches(matcher):
+    """ The match groups and matched flags of a Matcher, by relative path """
+    roots = {file_: str(dir_.root_path) for dir_ in matcher.dirs
+             for file_ in dir_.file_list}
+    groups = {id(group): group for group in matcher.match_dict.values()}
+    return {
+        "groups": sorted([(roots[file_], str(file_.get_path()))
+                          for file_ in group] for group in groups.values()),
+        "matched": sorted((str(dir_.root_path), str(file_.get_path()))
+                          for dir_ in matcher.dirs
+                          for file_ in dir_.file_list if file_.matched)
+    }
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.test_path = PurePath("./test/testdir_15")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        generate_tree(str(self.test_path), files=300, depth=2, fanout=3,
+                      size_mu=4.0, size_sigma=1.5, seed=5)
+        self.session_path = str(self.test_path.joinpath("compare.session"))
+    
+    def compare(self, match_reqs):
+        dirs = [Directory(str(self.test_path.joinpath(root)))
+                for root in ["a", "b"]]
+        for dir_ in dirs:
+            dir_.scan()
+        matcher = Matcher(dirs, match_reqs)
+        matcher.find_duplicates()
+        return matcher
+    
+    def test_save_load(self):
+        matcher = self.compare({"hash": True, "filename": True})
+        save_session(self.session_path, matcher)
+        restored = load_session(self.session_path)
+        
+        self.assertEqual(restored.match_reqs, matcher.match_reqs)
+        self.assertEqual(describe_matches(restored), describe_matches(matcher))
+        self.assertTrue(len(restored.match_dict) > 0)
+        for dir_, restored_dir in zip(matcher.dirs, restored.dirs):
+            self.assertEqual(restored_dir.root_path, dir_.root_path)
+            self.assertEqual(describe_directory(restored_dir),
+                             describe_directory(dir_))
+            self.assertEqual(
+                [(file_.basename, file_.modified, file_.hash_1k,
+                  file_.hash_full) for file_ in restored_dir.file_list],
+                [(file_.basename, file_.modified, file_.hash_1k,
+                  file_.hash_full) for file_ in dir_.file_list])
+            # Nothing changed since
+            self.assertEqual(changed_paths(restored_dir), set())
+    
+    def test_symlinks(self):
+        # A linked directory is not scanned below, and a broken link is
+        # skipped, so neither shows up as changed
+        root = self.test_path.joinpath("a")
+        linked = next(name for name in sorted(os.listdir(str(root)))
+                      if os.path.isdir(str(root.joinpath(name))))
+        os.symlink(os.path.abspath(str(root.joinpath(linked))),
+                   str(root.joinpath("linked")))
+        os.symlink("missing", str(root.joinpath("broken")))
+        save_session(self.session_path, self.compare({"filename": True}))
+        
+        restored = load_session(self.session_path)
+        self.assertIsNotNone(restored.dirs[0].find_file("linked"))
+        for dir_ in restored.dirs:
+            self.assertEqual(changed_paths(dir_), set())
+    
+    def test_lazy(self):
+        save_session(self.session_path, self.compare({"filename": True}))
+        session = Session(self.session_path)
+        self.assertEqual(session.root_paths,
+                         [self.test_path.joinpath("a"),
+                          self.test_path.joinpath("b")])
+        stats.reset()
+        dir_ = session.directory(1)
+        self.assertIs(session.directory(1), dir_)
+        loaded = lambda: stats.snapshot()["counters"].get(
+            "session_files_loaded", 0)
+        # Nothing is made until it is looked up
+        self.assertEqual(loaded(), 0)
+        num_files = len(dir_.file_list)
+        self.assertEqual(loaded(), 0)
+        
+        children = dir_.directory_map[PurePath(".")]
+        self.assertTrue(0 < loaded() < num_files)
+        file_ = next(child for child in children if not child.isdir)
+        self.assertIn(file_, dir_.size_map[file_.size])
+        self.assertIs(dir_.find_file(file_.get_path()), file_)
+        
+        # Every File is only made once
+        files = list(dir_.file_list)
+        self.assertEqual(len(files), num_files)
+        self.assertTrue(all(child in files for child in children))
+        self.assertEqual(len(dir_.size_map), len(set(
+            file_.size for file_ in files if not file_.isdir)))
+        session.close()
+    
+    def test_load_is_lazy(self):
+        save_session(self.session_path, self.compare({"filename": True}))
+        stats.reset()
+        matcher = load_session(self.session_path)
+        self.assertNotIn("session_files_loaded", stats.snapshot()["counters"])
+        # A file brings its match group along
+        file_ = next(file_ for file_ in matcher.dirs[0].file_list
+                     if file_ in matcher.match_dict)
+        self.assertTrue(all(any(other in dir_.file_list
+                                for dir_ in matcher.dirs)
+                            for other in matcher.match_dict[file_]))
+    
+    def test_refresh(self):
+        match_reqs = {"filename": True}
+        save_session(self.session_path, self.compare(match_reqs))
+        
+        # Remove, change and add files and a directory
+        root = self.test_path.joinpath("b")
+        files = [file_ for file_ in self.compare(match_reqs).dirs[1].file_list
+                 if not file_.isdir]
+        os.remove(str(root.joinpath(files[0].get_path())))
+        with open(str(root.joinpath(files[1].get_path())), "a") as f:
+            f.write("changed")
+        os.mkdir(str(root.joinpath("new")))
+        shutil.copy(str(self.test_path.joinpath("a", files[2].get_path())),
+                    str(root.joinpath("new")))
+        
+        restored = load_session(self.session_path)
+        paths = changed_paths(restored.dirs[1])
+        self.assertEqual(paths, {files[0].get_path(), files[1].get_path(),
+                                 PurePath("new")})
+        restored.refresh_paths(1, sorted(paths))
+        
+        rescanned = self.compare(match_reqs)
+        self.assertEqual(describe_matches(restored), describe_matches(rescanned))
+        for dir_, rescanned_dir in zip(restored.dirs, rescanned.dirs):
+            self.assertEqual(describe_directory(dir_),
+                             describe_directory(rescanned_dir))
+    
+    def test_not_a_session(self):
+        with open(self.session_path, "wb") as f:
+            f.write(b"not a session at all, but long enough")
+        with self.assertRaises(ValueError):
+            Session(self.session_path)
+    
+    def tearDown(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestSummary(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_16")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        generate_tree(str(self.test_path), files=600, depth=2, fanout=3,
+                      size_mu=4.0, size_sigma=1.5, seed=9)
+        self.summary_path = str(self.test_path.joinpath("a.summary"))
+    
+    def test_same_as_external_match(self):
+        roots = [str(self.test_path.joinpath(root)) for root in ["a", "b"]]
+        for match_reqs in [{"filename": True}, {"modtime": True},
+                           {"hash": True}, {"hash": True, "filename": True}]:
+            num_entries = build_summary(roots[0], self.summary_path,
+                                        match_reqs)
+            summary = Summary(self.summary_path)
+            self.assertEqual(summary.num_entries, num_entries)
+            self.assertEqual(summary.match_reqs, match_reqs)
+            results = dict(check_summary(summary, roots[1]))
+            summary.close()
+            
+            expected = {}
+            for matched, members in external_match(roots, match_reqs):
+                rel_paths_a = sorted(rel_path for root_index, rel_path
+                                     in members if root_index == 0)
+                for root_index, rel_path in members:
+                    if root_index == 1:
+                        expected[rel_path] = rel_paths_a if matched else []
+            self.assertTrue(any(expected.values()))
+            self.assertTrue(not all(expected.values()))
+            self.assertEqual({rel_path: sorted(matches) for rel_path, matches
+                              in results.items()}, expected)
+    
+    def test_filter(self):
+        root = str(self.test_path.joinpath("a"))
+        build_summary(root, self.summary_path, {"filename": True},
+                      error_rate=0.01)
+        summary = Summary(self.summary_path)
+        # Everything in the summary is found
+        for size, basename, mtime, rel_path in scan_records(
+                root, {"filename": True}):
+            self.assertTrue(summary.might_contain(key_digest(
+                {"filename": True}, size, basename, mtime)))
+        # Few keys that are not in it get through the filter
+        false_positives = sum(
+            summary.might_contain(key_digest({"filename": True}, size,
+                                             "missing", 0.0))
+            for size in range(1, 10001))
+        self.assertTrue(false_positives < 500)
+        summary.close()
+    
+    def test_not_a_summary(self):
+        with open(self.summary_path, "wb") as f:
+            f.write(b"not a summary")
+        with self.assertRaises(ValueError):
+            Summary(self.summary_path)
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
+class TestSmallFiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_path = PurePath("./test/testdir_17")
+        shutil.rmtree(self.test_path, ignore_errors=True)
+        # Mostly under 4KiB, with many files of each size
+        generate_tree(str(self.test_path), files=500, depth=2, fanout=3,
+                      size_mu=7.0, size_sigma=0.8, max_size=8192, seed=11)
+    
+    def match(self, match_reqs, small_file_size):
+        dirs = [Directory(str(self.test_path.joinpath(root)))
+                for root in ["a", "b"]]
+        for dir_ in dirs:
+            dir_.scan()
+        matcher = Matcher(dirs, match_reqs, small_file_size=small_file_size)
+        stats.reset()
+        matcher.find_duplicates()
+        return ([(str(file_.get_path()), file_.matched,
+                  [str(match.get_path())
+                   for match in matcher.match_dict.get(file_, [])])
+                 for dir_ in dirs for file_ in dir_.file_list],
+                [describe_directory(dir_) for dir_ in dirs],
+                stats.snapshot()["counters"])
+    
+    def test_same_as_pairwise(self):
+        for match_reqs in [{"hash": True}, {"hash": True, "filename": True},
+                           {"hash": True, "modtime": True}]:
+            *pairwise, _ = self.match(match_reqs, 0)
+            *small, counters = self.match(match_reqs, 4096)
+            self.assertEqual(small, pairwise)
+            self.assertTrue(counters["small_files_hashed"] > 0)
+    
+    def test_find_hashes_whole(self):
+        root = self.test_path.joinpath("a")
+        dir_ = Directory(str(root))
+        dir_.scan()
+        files = [file_ for file_ in dir_.file_list if not file_.isdir]
+        dir_.find_hashes_whole(files, workers=4, batch_size=16)
+        for file_ in files:
+            expected = File(str(file_.get_path()), file_.size, None, False,
+                            file_.parent_dir)
+            self.assertEqual(file_.hash_1k, expected.find_hash_1k(root))
+            self.assertEqual(file_.hash_full, expected.find_hash_full(root))
+    
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_path, ignore_errors=True)
+
 if __name__ == "__main__":
     unittest.main()
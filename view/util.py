@@ -0,0 +1,40 @@
+"""Helpers for showing files, which do not need the GUI toolkit."""
+
+import os
+import pathlib
+
+# For opening files on a right click
+import subprocess
+import platform
+
+def is_subdir(parent_dir, _dir):
+    """ Tests if _dir is a subdirectory of parent_dir """
+    return pathlib.Path(parent_dir).resolve() in pathlib.Path(_dir).resolve().parents
+
+def sizeof_format(num, suffix="B"):
+    """ Makes a human-readable file size.
+        Adapted from https://stackoverflow.com/questions/1094841 """
+    if num < 1024:
+        # Don't include the decimal place for bytes
+        return "{bytes} {suffix}".format(bytes=num, suffix=suffix)
+    num /= 1024.0
+    for unit in ['Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "{:3.2f} {unit}{suffix}".format(num, unit=unit, suffix=suffix)
+        num /= 1024.0
+    return "{:3.2f} {unit}{suffix}".format(num, unit=unit, suffix=suffix)
+
+def open_file_external(filepath):
+    """ Opens a file with its default application, depending on the platform.
+        Adapted from https://stackoverflow.com/questions/434597 """
+    if platform.system() == 'Darwin':
+        # macOS
+        subprocess.call(('open', filepath))
+    elif platform.system() == 'Windows':
+        # Windows
+        os.startfile(filepath)
+    elif platform.system() == 'Linux':
+        # Linux
+        subprocess.call(('xdg-open', filepath))
+    else:
+        print("I don't know how to open files on this platform yet:", platform.system())
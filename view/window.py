@@ -0,0 +1,624 @@
+"""The main window, showing the directories side by side."""
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk, GObject, GLib
+
+import pathlib
+import queue
+import threading
+from pathlib import PurePath
+
+from model.sync import Copier, plan_copies, COPIED
+from model.matcher import Matcher
+from model.watch import Watcher
+from model.ratelimit import limiter
+from model.progress import Progress, EventBus
+from model.session import changed_paths
+from model.stats import stats
+from model.trace import tracer
+from view.util import is_subdir, sizeof_format, open_file_external
+
+# Progress is shown and events are handled this many times per second,
+# however fast the workers send them
+FRAME_RATE = 20
+
+class AppWindow(Gtk.Window):
+    def __init__(self, scan_jobs, match_reqs, copier=None, watch=False,
+                 match_processes=0, matcher=None, match_options=None):
+        """ scan_jobs: A started ScanJob for each directory
+            match_options: Other keyword arguments for the Matcher, such as
+                           small_file_size
+            matcher: A Matcher that already has the matches of the
+                     directories, such as one restored from a session """
+        Gtk.Window.__init__(self, title="AlreadyHave")
+        self.set_default_size(1200, 600)
+        
+        # Application vertical parent box
+        self.vertbox = Gtk.Box()
+        self.vertbox.props.orientation = Gtk.Orientation.VERTICAL
+        self.add(self.vertbox)
+        
+        # Add "find duplicates" progress bar
+        self.cmp_progressbar = Gtk.ProgressBar()
+        self.cmp_progressbar.set_show_text(True)
+        self.cmp_progressbar.set_ellipsize(2)
+        self.cmp_progressbar.set_text("Scanning directories...")
+        self.vertbox.pack_start(self.cmp_progressbar, False, False, 0)
+        
+        # Box containing each of the "columns" (directories open)
+        self.colsbox = Gtk.Box()
+        self.colsbox.props.spacing = 5
+        self.colsbox.props.homogeneous = True
+        self.vertbox.pack_start(self.colsbox, True, True, 0)
+        
+        # Status panel with live statistics
+        self.stats_label = Gtk.Label()
+        self.stats_label.set_xalign(0.0)
+        self.stats_label.set_line_wrap(True)
+        self.vertbox.pack_start(self.stats_label, False, False, 0)
+        GLib.timeout_add(500, self.update_stats_panel)
+        
+        # Read limits, adjustable while scanning and hashing (0 = unlimited)
+        limits_box = Gtk.Box()
+        limits_box.props.spacing = 5
+        self.read_limit_spin = Gtk.SpinButton.new_with_range(0, 10000, 1)
+        self.ops_limit_spin = Gtk.SpinButton.new_with_range(0, 100000, 10)
+        for label, spin in [
+                ("Read limit (MiB/s):", self.read_limit_spin),
+                ("Files/stat calls per second:", self.ops_limit_spin)]:
+            spin.connect("value-changed", self.set_read_limits)
+            limits_box.pack_start(Gtk.Label(label=label), False, False, 0)
+            limits_box.pack_start(spin, False, False, 0)
+        self.show_read_limits()
+        self.vertbox.pack_start(limits_box, False, False, 0)
+        
+        self.dir_paths = [job.directory.root_path for job in scan_jobs]
+        # Match requirements
+        self.match_reqs = match_reqs
+        self.dirs = [job.directory for job in scan_jobs]
+        self.dirs_cd = [PurePath(".")] * len(scan_jobs)
+        self.dirs_list_stores = []
+        self.progress_bars = []
+        self.tree_views = []
+        self.toolbar_buttons = []
+        self.entries = []
+        
+        # Finds the matches between the directories, unless they were
+        # restored
+        self.restored = matcher is not None
+        if matcher is None:
+            matcher = Matcher(self.dirs, self.match_reqs, match_processes,
+                              **(match_options or {}))
+        self.matcher = matcher
+        # Whether the matches were found and shown
+        self.matched = False
+        
+        # Used to copy unmatched files between directories
+        self.copier = copier if copier is not None else Copier()
+        
+        # Keep the view current after comparing, if requested
+        self.watch = watch
+        self.watchers = {}
+        # (dir_id, changed paths) for the thread that applies them, which is
+        # started with the first change
+        self.refresh_queue = None
+        # Held while a worker changes the matches or the directory structure,
+        # and while the main loop reads them
+        self.matcher_lock = threading.Lock()
+        
+        # Number of directories currently loaded
+        self.num_dirs_loaded = 0
+        
+        # Workers publish progress and post events here, and render_frame
+        # picks them up
+        self.scan_jobs = scan_jobs
+        self.compare_progress = Progress()
+        self.events = EventBus()
+        # Progress bar -> the progress state it shows
+        self.shown_progress = {}
+        # Directories whose finished scan was handled
+        self.scans_finished = set()
+        
+        for dir_index, dirpath in enumerate(self.dir_paths):
+            # Add this directory (column)
+            thiscol = Gtk.Box()
+            thiscol.props.orientation = Gtk.Orientation.VERTICAL
+            self.colsbox.pack_start(thiscol, True, True, 0)
+            
+            # Progress bar for scanning the directory
+            progress_bar = Gtk.ProgressBar()
+            progress_bar.set_show_text(True)
+            progress_bar.set_ellipsize(2)
+            self.progress_bars.append(progress_bar)
+            thiscol.pack_start(progress_bar, False, True, 0)
+            
+            # Add entry (with directory name in it)
+            entry = Gtk.Entry()
+            entry.set_text(str(pathlib.Path(dirpath).resolve()))
+            entry.connect("activate", self.set_dir, dir_index)
+            self.entries.append(entry)
+            thiscol.pack_start(entry, False, True, 0)
+            
+            # Add toolbar with actions
+            toolbar = Gtk.Toolbar()
+            toolbutton_up_dir = Gtk.ToolButton()
+            toolbutton_up_dir.set_label("Up")
+            toolbutton_up_dir.set_is_important(True)
+            toolbutton_up_dir.set_icon_name("gtk-go-up")
+            toolbutton_up_dir.set_sensitive(False)
+            toolbutton_up_dir.connect("clicked", self.go_up_dir, dir_index)
+            
+            # Add the "Go up a directory" button to the end of the toolbar
+            toolbar.insert(toolbutton_up_dir, -1)
+            
+            # Copy files that no other directory has into this one
+            toolbutton_copy = Gtk.ToolButton()
+            toolbutton_copy.set_label("Copy Missing Here")
+            toolbutton_copy.set_is_important(True)
+            toolbutton_copy.set_icon_name("gtk-copy")
+            toolbutton_copy.set_tooltip_text("Copy the unmatched files of the "
+                "other directories here, keeping their relative paths")
+            toolbutton_copy.set_sensitive(False)
+            toolbutton_copy.connect("clicked", self.copy_missing, dir_index)
+            toolbar.insert(toolbutton_copy, -1)
+            thiscol.pack_start(toolbar, False, True, 0)
+            
+            self.toolbar_buttons.append({
+                "up": toolbutton_up_dir,
+                "copy": toolbutton_copy
+            })
+            
+            # Create ListStore
+            # Filename, Size, Modified Date, File Index, row_color
+            list_store = Gtk.ListStore(str, GObject.TYPE_INT64, str, GObject.TYPE_PYOBJECT, str)
+            self.dirs_list_stores.append(list_store)
+            
+            # Set sorting
+            def filename_compare(model, row1, row2, dir_index):
+                sort_column, _ = model.get_sort_column_id()
+                _file1 = model.get_value(row1, 3)
+                _file2 = model.get_value(row2, 3)
+                
+                if _file1.isdir != _file2.isdir:
+                    return -1 if _file1.isdir else 1
+                
+                if _file1.basename.lower() != _file2.basename.lower():
+                    return -1 if _file1.basename.lower() < _file2.basename.lower() else 1
+                
+                # These should never be equal (cannot have two files named the same)
+                return -1 if _file1.basename < _file2.basename else 1
+            
+            list_store.set_sort_func(0, filename_compare, dir_index)
+            list_store.set_sort_column_id(0, Gtk.SortType.ASCENDING)
+            
+            # Add tree view
+            tree_view = Gtk.TreeView(model=list_store)
+            self.tree_views.append(tree_view)
+            
+            for i, column_title in [(0, "Filename"), (1, "Size"), (2, "Last Modified")]:
+                renderer = Gtk.CellRendererText()
+                column = Gtk.TreeViewColumn(column_title, renderer, text=i, background=4)
+                column.set_resizable(True)
+                column.set_sort_column_id(i)
+                if column_title == "Size":
+                    # Set custom data function for file sizes
+                    column.set_cell_data_func(renderer, self.render_file_size)
+                    # Align header and data to the right
+                    column.set_alignment(1.0)
+                    renderer.set_alignment(1.0, 0.0)
+                tree_view.append_column(column)
+            
+            # Handle selections
+            selected_row = tree_view.get_selection()
+            tree_view.connect("row-activated", self.row_activated)
+            tree_view.connect("button-press-event", self.row_button_press, dir_index)
+            
+            # Add ScrollableWindow to house the tree view
+            tree_view_scrollable = Gtk.ScrolledWindow()
+            tree_view_scrollable.set_policy(Gtk.PolicyType.AUTOMATIC,
+                Gtk.PolicyType.AUTOMATIC)
+            tree_view_scrollable.set_propagate_natural_width(True)
+            tree_view_scrollable.set_propagate_natural_height(True)
+            tree_view_scrollable.add(tree_view)
+            thiscol.pack_start(tree_view_scrollable, True, True, 0)
+        
+        # The scans started before the window, and the first frame catches
+        # up with them
+        GLib.timeout_add(1000 // FRAME_RATE, self.render_frame)
+
+    def render_file_size(self, tree_column, cell, tree_model, _iter, data):
+        """ Renders a file size in a human-readable format in the TreeView """
+        file_size = tree_model.get_value(_iter, 1)
+        if file_size >= 0:
+            cell.set_property("text", sizeof_format(file_size))
+        else:
+            # Hide for directories
+            cell.set_property("text", "")
+
+    def set_dir(self, entry, dir_id):
+        """ Set the directory for this entry, if it's valid.
+            If it's not valid, set the entry's text to the current directory. """
+        good_dir = False
+        entry_dir = pathlib.Path(entry.get_text())
+        if entry_dir.is_dir():
+            # Equal to the root directory
+            if entry_dir == pathlib.Path(self.dirs[dir_id].root_path).resolve():
+                good_dir = True
+            elif is_subdir(self.dirs[dir_id].root_path, entry_dir):
+                good_dir = True
+        
+        if good_dir:
+            self.list_dir_contents(dir_id, entry_dir
+                .relative_to(pathlib.Path(self.dirs[dir_id].root_path).resolve()))
+        else:
+            # Get a Path object so that it can be resolved
+            root_path_path = pathlib.Path(self.dirs[dir_id].root_path)
+            entry.set_text(str(root_path_path.joinpath(self.dirs_cd[dir_id]).resolve()))
+    
+    def go_up_dir(self, button, dir_id):
+        if self.dirs_cd[dir_id] != PurePath("."):
+            self.list_dir_contents(dir_id, self.dirs_cd[dir_id].parent)
+    
+    @tracer.traced("gui list_dir_contents")
+    def list_dir_contents(self, dir_id, directory):
+        """ Shows the contents of "directory" in the TreeView """
+        self.dirs_cd[dir_id] = directory
+        
+        # Update entry
+        root_path_path = pathlib.Path(self.dirs[dir_id].root_path)
+        self.entries[dir_id].set_text(
+            str(root_path_path.joinpath(self.dirs_cd[dir_id]).resolve()))
+        
+        # Update directory up button
+        enable_up_button = self.dirs_cd[dir_id] != PurePath(".")
+        self.toolbar_buttons[dir_id]["up"].set_sensitive(enable_up_button)
+        
+        # Clear old view
+        self.dirs_list_stores[dir_id].clear()
+        
+        # Populate, while no refresh changes the directory structure. Each row
+        # keeps its File, so that it stays right until the rows are redone
+        with self.matcher_lock:
+            # A refresh may remove the directory after it was checked
+            for _file in self.dirs[dir_id].directory_map.get(directory, []):
+                self.add_file_row(dir_id, _file)
+    
+    def add_file_row(self, dir_id, _file):
+        """ Adds a row for _file to the TreeView of directory dir_id """
+        if _file.isdir:
+            # Set the color to be a bit lighter if the directory was
+            # only partially matched
+            dir_name = _file.get_path()
+            
+            if dir_name in self.dirs[dir_id].directory_map_file:
+                print("{} {} / {}".format(_file.get_path(), _file.to_match,
+                    _file.to_match_total))
+                if _file.to_match == 0:
+                    if _file.to_match_total == 0:
+                        # Empty directory, or directory with exclusively empty subdirectories
+                        # Color: Gainsboro
+                        color = "#DCDCDC"
+                    else:
+                        # All items in this directory are matched
+                        color = "greenyellow"
+                elif _file.to_match < _file.to_match_total:
+                    # Some files in this directory are matched
+                    color = "palegreen"
+                else:
+                    # No files in this directory are matched
+                    color = "white"
+            else:
+                # TODO: Remove
+                print("Warning?? {} for {} not in {}"
+                    .format(dir_name, _file.get_path(),
+                            [self.dirs[dir_id].directory_map_file.keys()]))
+                color = "white"
+        else:
+            color = "greenyellow" if _file.matched else "white"
+            if self.matcher.ignore_file(_file):
+                color = "#DCDCDC"
+        self.dirs_list_stores[dir_id].append([_file.basename, _file.size,
+            str(_file.modified), _file, color])
+    
+    def finish_scan(self, dir_id):
+        error = self.scan_jobs[dir_id].progress.error
+        if error is not None:
+            print("Scanning {} failed: {}".format(self.dirs[dir_id].root_path,
+                                                  error))
+        print(str(self.dirs[dir_id].root_path) + " finished scanning "
+            + str(len(self.dirs[dir_id].file_list)) + " files.")
+        # Add top directory to list store
+        self.list_dir_contents(dir_id, self.dirs_cd[dir_id])
+        
+        # Remove progress bar
+        print("Should hide progress bar {}".format(dir_id))
+        self.progress_bars[dir_id].hide()
+        
+        # Begin finding potential collisions if all directories are loaded
+        self.num_dirs_loaded += 1
+        if self.num_dirs_loaded == len(self.dirs):
+            if self.restored:
+                # Show the restored matches now and catch up with the
+                # filesystem afterwards
+                self.show_matches()
+                self.refresh_restored()
+            else:
+                self.find_duplicates()
+    
+    def find_duplicates(self):
+        """ Finds duplicate files in separate directories """
+        self.cmp_progressbar.show()
+        thread = threading.Thread(target=self.run_find_duplicates)
+        thread.daemon = True
+        thread.start()
+    
+    def run_find_duplicates(self):
+        """ Matches the directories, away from the main loop """
+        self.matcher.find_duplicates(lambda fraction, text:
+            self.compare_progress.publish(fraction, 1, text))
+        self.events.post("matched")
+    
+    def refresh_restored(self):
+        """ Finds what changed on the filesystem since the restored session
+            was saved, away from the main loop """
+        self.cmp_progressbar.show()
+        thread = threading.Thread(target=self.run_refresh_restored)
+        thread.daemon = True
+        thread.start()
+    
+    def run_refresh_restored(self):
+        for dir_id, dir_ in enumerate(self.dirs):
+            if not dir_.local:
+                continue
+            self.compare_progress.publish(dir_id, len(self.dirs),
+                "Looking for changes in " + str(dir_.root_path))
+            paths = changed_paths(dir_)
+            if paths:
+                self.events.post("changed", dir_id, paths)
+        self.events.post("refreshed")
+    
+    def show_matches(self):
+        """ Shows the results of find_duplicates """
+        self.cmp_progressbar.hide()
+        for i in range(len(self.dirs)):
+            self.list_dir_contents(i, PurePath("."))
+            if self.dirs[i].local:
+                self.toolbar_buttons[i]["copy"].set_sensitive(True)
+        self.matched = True
+        
+        # Restored directories are watched once they caught up
+        if self.watch and not self.restored:
+            self.start_watching()
+    
+    def start_watching(self):
+        """ Watches every directory for changes after the first comparison """
+        for dir_id, dir_ in enumerate(self.dirs):
+            if not dir_.local:
+                continue
+            watcher = Watcher(dir_)
+            change_function = (lambda x: lambda paths: self.events.post(
+                "changed", x, paths))(dir_id)
+            watcher.start(change_function)
+            self.watchers[dir_id] = watcher
+    
+    def apply_changes(self, dir_id, paths):
+        """ Hands changed paths from a watcher to the refresh thread, which
+            matches only the affected sizes again, away from the main loop """
+        watcher = self.watchers.get(dir_id)
+        if watcher is not None and watcher.overflowed:
+            print("Too many changes at once in {}; restart to see all of them"
+                .format(self.dirs[dir_id].root_path))
+            watcher.overflowed = False
+        
+        if self.refresh_queue is None:
+            self.refresh_queue = queue.Queue()
+            thread = threading.Thread(target=self.run_refresh_paths)
+            thread.daemon = True
+            thread.start()
+        self.refresh_queue.put((dir_id, sorted(paths)))
+    
+    def run_refresh_paths(self):
+        """ Applies queued changes one batch at a time, then has the main
+            loop show the rows on screen again """
+        while True:
+            dir_id, paths = self.refresh_queue.get()
+            with tracer.span("gui refresh_paths"), self.matcher_lock:
+                self.matcher.refresh_paths(dir_id, paths)
+            GLib.idle_add(self.show_refreshed)
+    
+    def show_refreshed(self):
+        """ Shows the rows on screen again after run_refresh_paths """
+        for i in range(len(self.dirs)):
+            if self.dirs_cd[i] not in self.dirs[i].directory_map:
+                # The directory on screen was removed
+                self.dirs_cd[i] = PurePath(".")
+            self.list_dir_contents(i, self.dirs_cd[i])
+        # Only run once
+        return False
+    
+    def copy_missing(self, button, dir_id):
+        """ Copies the files that were not matched in any other directory
+            into directory dir_id """
+        plan = []
+        for other_id, other_dir in enumerate(self.dirs):
+            if other_id != dir_id:
+                plan.extend(plan_copies(other_dir, self.dirs[dir_id],
+                                        self.matcher))
+        
+        for buttons in self.toolbar_buttons:
+            buttons["copy"].set_sensitive(False)
+        self.cmp_progressbar.show()
+        
+        update_function = lambda done, total, path: (
+            self.compare_progress.publish(done, total, "Copying " + str(path)))
+        thread = threading.Thread(target=self.run_copy_plan,
+                                  args=(plan, update_function))
+        thread.daemon = True
+        thread.start()
+    
+    def run_copy_plan(self, plan, update_function):
+        """ Runs a copy plan, then marks the copied files as matched """
+        results = self.copier.run(plan, update_function)
+        
+        result_counts = {}
+        with self.matcher_lock:
+            for (file_, source_path, target_path), result in results:
+                result_counts[result] = result_counts.get(result, 0) + 1
+                if result == COPIED:
+                    self.matcher.propagate_matched(file_)
+                else:
+                    print("Not copied ({}): {}".format(result, source_path))
+        print("Copy results:", result_counts)
+        self.events.post("copied")
+    
+    def show_copied(self):
+        """ Shows the results of run_copy_plan """
+        self.cmp_progressbar.hide()
+        for i in range(len(self.dirs)):
+            self.list_dir_contents(i, self.dirs_cd[i])
+            if self.dirs[i].local:
+                self.toolbar_buttons[i]["copy"].set_sensitive(True)
+    
+    @tracer.traced("gui render_frame")
+    def render_frame(self):
+        """ Shows the latest progress of every worker and handles the
+            events posted since the last frame """
+        for dir_id, job in enumerate(self.scan_jobs):
+            if dir_id in self.scans_finished:
+                continue
+            if job.progress.finished:
+                self.scans_finished.add(dir_id)
+                self.finish_scan(dir_id)
+            else:
+                self.show_progress(self.progress_bars[dir_id], job.progress)
+        self.show_progress(self.cmp_progressbar, self.compare_progress)
+        
+        # Changes to the same directory are applied together
+        changed = {}
+        for name, args in self.events.drain():
+            if name == "changed":
+                dir_id, paths = args
+                changed.setdefault(dir_id, set()).update(paths)
+            elif name == "matched":
+                self.show_matches()
+            elif name == "refreshed":
+                self.cmp_progressbar.hide()
+                if self.watch:
+                    self.start_watching()
+            elif name == "copied":
+                self.show_copied()
+        for dir_id, paths in changed.items():
+            self.apply_changes(dir_id, paths)
+        
+        # Limits scaled by signals, even while nothing is being read
+        limiter.apply_requested_scales()
+        if limiter.limits_version != self.shown_limits_version:
+            self.show_read_limits()
+        
+        # Keep the timeout running
+        return True
+    
+    def update_stats_panel(self):
+        """ Shows the current statistics in the status panel """
+        snapshot = stats.snapshot()
+        parts = ["{}: {:,}".format(name.replace("_", " "), value)
+                 for name, value in sorted(snapshot["counters"].items())]
+        parts.extend("{} time: {:.2f} s wall, {:.2f} s CPU".format(
+                         name, phase["wall_seconds"], phase["cpu_seconds"])
+                     for name, phase in sorted(snapshot["phases"].items()))
+        self.stats_label.set_text("   ".join(parts))
+        # Keep the timeout running
+        return True
+    
+    def set_read_limits(self, spin_button):
+        """ Applies the read limits from the spin buttons """
+        read_limit = self.read_limit_spin.get_value()
+        ops_limit = self.ops_limit_spin.get_value()
+        limiter.set_limits(read_limit * 2 ** 20 if read_limit else None,
+                           ops_limit or None, limiter.latency_threshold)
+    
+    def show_read_limits(self):
+        """ Shows the current read limits in the spin buttons, without
+            setting them again """
+        for spin, value in [
+                (self.read_limit_spin,
+                 limiter.bytes_per_second and limiter.bytes_per_second / 2 ** 20),
+                (self.ops_limit_spin, limiter.ops_per_second)]:
+            spin.handler_block_by_func(self.set_read_limits)
+            spin.set_value(value or 0)
+            spin.handler_unblock_by_func(self.set_read_limits)
+        self.shown_limits_version = limiter.limits_version
+    
+    def show_progress(self, progress_bar, progress):
+        """ Shows a Progress in a progress bar, if it changed since the
+            last frame """
+        state = progress.state
+        if state is None or self.shown_progress.get(progress_bar) is state:
+            return
+        self.shown_progress[progress_bar] = state
+        stats.count("gui_updates")
+        done, total, item = state
+        progress_bar.set_fraction(done / total if total else 0.0)
+        progress_bar.set_text(str(item))
+    
+    def row_activated(self, tree_view, path, column):
+        dir_id = self.tree_views.index(tree_view)
+        print("Row activated:", path, "Index:", dir_id)
+        
+        _file = self.dirs_list_stores[dir_id][path][3]
+        
+        # The directory may have been removed since the rows were listed
+        if _file.isdir and _file.get_path() in self.dirs[dir_id].directory_map:
+            self.list_dir_contents(dir_id, _file.get_path())
+    
+    def row_button_press(self, tree_view, event, dir_id):
+        selection = tree_view.get_selection()
+        
+        # Re-position selection
+        path_full = tree_view.get_path_at_pos(event.x, event.y)
+        if path_full is None:
+            return
+        new_path, col, x, y = path_full
+        if new_path:
+            selection.unselect_all()
+            selection.select_path(new_path)
+        
+        model, tree_iter = selection.get_selected()
+        
+        if tree_iter is not None:
+            # Create context menu on right-click
+            if event.button == 3:
+                menu = Gtk.Menu()
+                
+                # Open in default application
+                item_open = Gtk.MenuItem(label="Open")
+                def open_file(filename):
+                    full_path = (self.dirs[dir_id].root_path
+                            .joinpath(self.dirs_cd[dir_id])
+                            .joinpath(PurePath(filename)))
+                    open_file_external(full_path)
+                item_open.connect("activate", lambda x: open_file(model[tree_iter][0]))
+                menu.append(item_open)
+                
+                # Find matches
+                item_find_matches = Gtk.MenuItem(label="Show Matches")
+                
+                file_ = model[tree_iter][3]
+                def show_matches(file_):
+                    # Look up matches
+                    print("\nMatches:")
+                    with self.matcher_lock:
+                        for other_file in self.matcher.match_dict.get(file_, []):
+                            if other_file is not file_:
+                                print(other_file.get_path())
+                with self.matcher_lock:
+                    has_matches = file_ in self.matcher.match_dict
+                if has_matches:
+                    item_find_matches.connect("activate", lambda x: show_matches(file_))
+                else:
+                    item_find_matches.set_sensitive(False)
+                menu.append(item_find_matches)
+                
+                menu.show_all()
+                menu.popup_at_pointer(None)